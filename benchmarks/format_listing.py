@@ -0,0 +1,89 @@
+"""Micro-benchmark of the listing formatters.
+
+Formats a synthetic directory listing (100k entries by default) with
+AbstractedFS.format_list() and format_mlsx() and prints the CPU time
+per entry, e.g.:
+
+    python benchmarks/format_listing.py --entries 100000 --repeat 5
+"""
+import os
+import sys
+import time
+import json
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from fs.info import Info
+
+from fstpy.filesystems import AbstractedFS, _Listing
+
+
+class _CommandChannel(object):
+    use_gmt_times = True
+    unicode_errors = 'replace'
+    username = None
+
+
+def make_listing(entries):
+    now = time.time()
+    listing = _Listing()
+    for i in range(entries):
+        name = 'file-%07d.dat' % i
+        isdir = i % 10 == 0
+        raw = {
+            'basic': {'name': name, 'is_dir': isdir},
+            'details': {'size': i * 37, 'type': 1 if isdir else 2,
+                        # a mix of recent and old entries, a few
+                        # sharing the same minute
+                        'modified': now - (i % 5000) * 3600 - i % 7,
+                        'accessed': None, 'created': None,
+                        'metadata_changed': None},
+            'lstat': {'st_mode': 0o40755 if isdir else 0o100644,
+                      'st_nlink': 1, 'st_dev': 2049, 'st_ino': 1000 + i},
+            'stat': {'st_mode': 0o40755 if isdir else 0o100644},
+            'access': {'uid': 1000, 'gid': 1000},
+            'link': {'target': None},
+        }
+        listing.append(name)
+        listing.infos[name] = Info(raw)
+    return listing
+
+
+def run(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.process_time()
+        size = sum(len(chunk) for chunk in func())
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--entries', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    afs = AbstractedFS(u'mem://', _CommandChannel())
+    # every Info carries the stat/lstat/link namespaces, as on OSFS
+    afs._has_lstat_info = afs._has_stat_info = afs._has_link_info = True
+    afs.readlink = None
+    listing = make_listing(args.entries)
+    facts = ['type', 'size', 'perm', 'modify', 'unix.mode', 'unix.uid',
+             'unix.gid', 'unique']
+    results = {}
+    for name, func in [
+            ('format_list', lambda: afs.format_list(u'/', listing)),
+            ('format_mlsx', lambda: afs.format_mlsx(u'/', listing,
+                                                    'elradfmw', facts))]:
+        elapsed, size = run(func, args.repeat)
+        results[name] = {'entries': args.entries, 'seconds': elapsed,
+                         'us_per_entry': elapsed * 1e6 / args.entries,
+                         'bytes': size}
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,548 @@
+"""Load test of an fstpy server.
+
+Starts an fstpy FTP (or FTPS) server in a child process over one of the
+benchmark backends:
+
+ - mem: a MemoryFS
+ - osfs: an OSFS on a temporary directory
+ - fakes3: an in-memory stand-in for an object store, with ranged reads
+   and multipart uploads (as S3FS has), every call of which is delayed
+   by --latency seconds
+
+then drives concurrent clients through a set of scenarios (login,
+LIST/MLSD of a large directory, small STOR/RETR, large streaming
+transfers), reporting for each one the throughput, p50/p99 latency,
+backend calls and server RSS. Results are written as JSON; given
+--compare, the differences with a previous run are printed, e.g.:
+
+    python benchmarks/loadtest.py --backend mem --backend fakes3 \\
+        --output after.json --compare before.json
+"""
+import os
+import io
+import sys
+import ssl
+import json
+import logging
+import time
+import ftplib
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import collections
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import fs
+import fs.opener
+import fs.memoryfs
+import fs.osfs
+
+from fstpy import streams
+
+USERNAME = 'bench'
+PASSWORD = 'bench'
+
+SCENARIOS = ['login', 'list', 'mlsd', 'small_stor', 'small_retr',
+             'large_stor', 'large_retr']
+
+
+# --- Benchmark backends (server side)
+
+class CountingFS(object):
+    """Proxy of a filesystem counting the backend calls made through
+    it and delaying each of them by latency seconds.
+    """
+
+    calls = collections.Counter()
+    latency = 0.0
+    _lock = threading.Lock()
+
+    counted = frozenset([
+        'getinfo', 'scandir', 'listdir', 'openbin', 'open', 'remove',
+        'removedir', 'removetree', 'makedir', 'makedirs', 'move', 'copy',
+        'setinfo', 'exists', 'isdir', 'isfile', 'getsize'])
+
+    def __init__(self, fs_obj, kind):
+        self._fs = fs_obj
+        self.kind = kind
+
+    @classmethod
+    def count(cls, name):
+        with cls._lock:
+            cls.calls[name] += 1
+        if cls.latency:
+            time.sleep(cls.latency)
+
+    def __getattr__(self, name):
+        attr = getattr(self._fs, name)
+        if name not in self.counted:
+            return attr
+
+        def call(*args, **kwargs):
+            self.count(name)
+            return attr(*args, **kwargs)
+        return call
+
+    def close(self):
+        # the backend is shared by all the instances opened
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BenchOpener(fs.opener.Opener):
+    """Opens bench://<kind>/ URLs (kind being "mem", "osfs" or
+    "fakes3"), all sharing the same backend instance per kind.
+    """
+
+    protocols = ['bench']
+    osfs_root = None
+    _backends = {}
+
+    def open_fs(self, fs_url, parse_result, writeable, create, cwd):
+        kind = parse_result.resource.strip('/').split('/')[0]
+        backend = self._backends.get(kind)
+        if backend is None:
+            if kind == 'osfs':
+                backend = fs.osfs.OSFS(self.osfs_root)
+            elif kind in ('mem', 'fakes3'):
+                backend = fs.memoryfs.MemoryFS()
+            else:
+                raise fs.opener.errors.OpenerError(
+                    'unknown benchmark backend %r' % kind)
+            self._backends[kind] = backend
+        return CountingFS(backend, kind)
+
+
+def _fakes3_range_fetcher(fs_obj, path):
+    if not isinstance(fs_obj, CountingFS) or fs_obj.kind != 'fakes3':
+        return None
+    backend = fs_obj._fs
+
+    def fetch(offset, length):
+        CountingFS.count('get_range')
+        with backend.openbin(path) as f:
+            f.seek(offset)
+            return f.read(length)
+    return fetch
+
+
+class _FakeS3MultipartUpload(object):
+    """Multipart upload to the fakes3 backend, see
+    fstpy.streams._S3MultipartUpload.
+    """
+
+    min_part_size = 5 * 1024 * 1024
+
+    def __init__(self, backend, path):
+        self.backend = backend
+        self.path = path
+        self.parts = {}
+
+    def start(self):
+        CountingFS.count('create_multipart_upload')
+
+    def upload_part(self, number, data):
+        CountingFS.count('upload_part')
+        self.parts[number] = bytes(data)
+        return {'PartNumber': number, 'ETag': str(number)}
+
+    def copy_part(self, number):
+        CountingFS.count('upload_part_copy')
+        self.parts[number] = self.backend.readbytes(self.path)
+        return {'PartNumber': number, 'ETag': str(number)}
+
+    def read(self):
+        CountingFS.count('get_object')
+        return self.backend.readbytes(self.path)
+
+    def complete(self, parts):
+        CountingFS.count('complete_multipart_upload')
+        self.backend.writebytes(self.path, b''.join(
+            self.parts[part['PartNumber']] for part in parts))
+        self.parts = {}
+
+    def put(self, data):
+        CountingFS.count('put_object')
+        self.backend.writebytes(self.path, bytes(data))
+
+    def abort(self):
+        CountingFS.count('abort_multipart_upload')
+        self.parts = {}
+
+
+def _fakes3_multipart_upload(fs_obj, path):
+    if not isinstance(fs_obj, CountingFS) or fs_obj.kind != 'fakes3':
+        return None
+    return _FakeS3MultipartUpload(fs_obj._fs, path)
+
+
+def _rss():
+    """Return the current and peak RSS of this process, in KiB."""
+    rss = peak = None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1])
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1])
+    except IOError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss, peak
+
+
+def _make_certificate(directory):
+    from OpenSSL import crypto
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.get_subject().CN = 'localhost'
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(24 * 60 * 60)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, 'sha256')
+    path = os.path.join(directory, 'server.pem')
+    with open(path, 'wb') as f:
+        f.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+        f.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+    return path
+
+
+def serve(conn, backend, mode, workers, latency, osfs_root, certfile):
+    """Child process: run the server, answering the requests of the
+    benchmark driver on conn.
+    """
+    from pyftpdlib.log import config_logging
+    from pyftpdlib.servers import FTPServer, ThreadedFTPServer
+    from fstpy import handlers
+    from fstpy.authorizers import DummyAuthorizer
+    from fstpy.filesystems import AbstractedFS
+
+    config_logging(level=logging.WARNING)
+    BenchOpener.osfs_root = osfs_root
+    fs.opener.registry.install(BenchOpener)
+    streams.range_fetchers.append(_fakes3_range_fetcher)
+    streams.multipart_uploaders.append(_fakes3_multipart_upload)
+
+    url = 'bench://%s' % backend
+    authorizer = DummyAuthorizer(url)
+    authorizer.add_user(USERNAME, PASSWORD, '/', perm='elradfmwMT')
+    if certfile:
+        handler = handlers.TLS_FTPHandler
+        handler.certfile = certfile
+    else:
+        handler = handlers.FTPHandler
+    handler.authorizer = authorizer
+    if mode == 'async':
+        handler.backend_workers = workers
+        AbstractedFS.pool.max_size = workers
+        AbstractedFS.pool.max_leases = 1
+        server_class = FTPServer
+    else:
+        server_class = ThreadedFTPServer
+    server = server_class(('127.0.0.1', 0), handler)
+    server.max_cons = 0
+    conn.send(server.address[1])
+
+    root = BenchOpener().open_fs(url, fs.opener.parse(url), True, False,
+                                 '.')._fs
+
+    def control():
+        while True:
+            request = conn.recv()
+            if request[0] == 'populate':
+                _, path, count, size = request
+                root.makedirs(path, recreate=True)
+                data = b'x' * size
+                for i in range(count):
+                    root.writebytes('%s/file-%07d' % (path, i), data)
+                conn.send(None)
+            elif request[0] == 'reset':
+                with CountingFS._lock:
+                    CountingFS.calls.clear()
+                conn.send(None)
+            elif request[0] == 'stats':
+                with CountingFS._lock:
+                    calls = dict(CountingFS.calls)
+                conn.send({'calls': calls, 'rss': _rss()})
+            elif request[0] == 'stop':
+                server.close_all()
+                conn.send(None)
+                return
+
+    thread = threading.Thread(target=control)
+    thread.daemon = True
+    thread.start()
+    CountingFS.latency = latency
+    server.serve_forever(handle_exit=False)
+
+
+# --- Driver (client side)
+
+class Server(object):
+    """The server child process, see serve()."""
+
+    def __init__(self, backend, mode, workers, latency, tls):
+        self.tmpdir = tempfile.mkdtemp(prefix='fstpy-bench-')
+        certfile = _make_certificate(self.tmpdir) if tls else None
+        self.tls = tls
+        self._conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=serve, args=(child_conn, backend, mode, workers, latency,
+                                self.tmpdir, certfile))
+        self.process.daemon = True
+        self.process.start()
+        self.port = self._conn.recv()
+
+    def request(self, *request):
+        self._conn.send(request)
+        return self._conn.recv()
+
+    def connect(self):
+        if self.tls:
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            ftp = ftplib.FTP_TLS(context=context, timeout=60)
+        else:
+            ftp = ftplib.FTP(timeout=60)
+        ftp.connect('127.0.0.1', self.port)
+        ftp.login(USERNAME, PASSWORD)
+        if self.tls:
+            ftp.prot_p()
+        ftp.voidcmd('TYPE I')
+        return ftp
+
+    def stop(self):
+        try:
+            self.request('stop')
+        finally:
+            self.process.join(10)
+            if self.process.is_alive():
+                self.process.terminate()
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+def _percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100.0 *
+                                           (len(values) - 1))))
+    return values[index]
+
+
+def run_scenario(server, scenario, args):
+    """Run scenario with args.clients concurrent clients, return its
+    results.
+    """
+    clients = args.clients
+    if scenario == 'login':
+        ops, size = args.logins, 0
+    elif scenario in ('list', 'mlsd'):
+        ops, size = args.listings, 0
+    elif scenario.startswith('small'):
+        ops, size = args.small_files, args.small_size
+    else:
+        ops, size = clients, args.large_size
+    payload = b'x' * size
+
+    def op(ftp, i, client):
+        if scenario == 'login':
+            server.connect().quit()
+        elif scenario == 'list':
+            ftp.retrlines('LIST /big', lambda line: None)
+        elif scenario == 'mlsd':
+            ftp.retrlines('MLSD /big', lambda line: None)
+        elif scenario == 'small_stor':
+            ftp.storbinary('STOR /small/file-%07d' % i, io.BytesIO(payload))
+        elif scenario == 'small_retr':
+            ftp.retrbinary('RETR /small/file-%07d' % i, lambda data: None)
+        elif scenario == 'large_stor':
+            ftp.storbinary('STOR /large-%d' % client, io.BytesIO(payload),
+                           blocksize=1024 * 1024)
+        elif scenario == 'large_retr':
+            ftp.retrbinary('RETR /large-%d' % client, lambda data: None,
+                           blocksize=1024 * 1024)
+
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = iter(range(ops))
+
+    def client(number):
+        ftp = server.connect() if scenario != 'login' else None
+        try:
+            while True:
+                with lock:
+                    i = next(counter, None)
+                if i is None:
+                    return
+                start = time.time()
+                try:
+                    op(ftp, i, number)
+                except (ftplib.Error, OSError, EOFError):
+                    with lock:
+                        errors[0] += 1
+                    continue
+                with lock:
+                    latencies.append(time.time() - start)
+        finally:
+            if ftp is not None:
+                ftp.quit()
+
+    server.request('reset')
+    threads = [threading.Thread(target=client, args=(n,))
+               for n in range(clients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    stats = server.request('stats')
+    done = len(latencies)
+    return {
+        'scenario': scenario,
+        'ops': done,
+        'errors': errors[0],
+        'seconds': elapsed,
+        'ops_per_sec': done / elapsed if elapsed else None,
+        'mb_per_sec': done * size / elapsed / 1e6 if size and elapsed
+        else None,
+        'p50_ms': _ms(_percentile(latencies, 50)),
+        'p99_ms': _ms(_percentile(latencies, 99)),
+        'backend_calls': stats['calls'],
+        'backend_calls_total': sum(stats['calls'].values()),
+        'rss_kb': stats['rss'][0],
+        'rss_peak_kb': stats['rss'][1],
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+def run(args):
+    results = []
+    for backend in args.backend:
+        for mode in args.mode:
+            server = Server(backend, mode, args.workers,
+                            args.latency if backend == 'fakes3' else 0.0,
+                            args.tls)
+            try:
+                server.request('populate', '/big', args.listing_size, 0)
+                server.request('populate', '/small', 0, 0)
+                for scenario in args.scenario:
+                    result = run_scenario(server, scenario, args)
+                    result.update(backend=backend, mode=mode, tls=args.tls)
+                    results.append(result)
+                    print('%-7s %-8s %-11s %8.1f ops/s  p50 %8.2f ms  '
+                          'p99 %8.2f ms  %7d calls  errors %d' % (
+                              backend, mode, scenario,
+                              result['ops_per_sec'] or 0,
+                              result['p50_ms'] or 0, result['p99_ms'] or 0,
+                              result['backend_calls_total'],
+                              result['errors']))
+            finally:
+                server.stop()
+    return results
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    """Print the changes of throughput and latency from the results
+    old to the results new.
+    """
+    def key(result):
+        return result['backend'], result['mode'], result['tls'], \
+            result['scenario']
+
+    previous = dict((key(result), result) for result in old['results'])
+    print('\nchanges from %s:' % (old['meta'].get('revision') or 'previous'))
+    for result in new['results']:
+        before = previous.get(key(result))
+        if before is None:
+            continue
+        changes = []
+        for metric in ('ops_per_sec', 'p50_ms', 'p99_ms',
+                       'backend_calls_total', 'rss_peak_kb'):
+            if before.get(metric) and result.get(metric) is not None:
+                changes.append('%s %+.1f%%' % (
+                    metric, (result[metric] - before[metric]) * 100.0 /
+                    before[metric]))
+        print('%-7s %-8s %-11s %s' % (result['backend'], result['mode'],
+                                       result['scenario'],
+                                       '  '.join(changes)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend', action='append',
+                        choices=['mem', 'osfs', 'fakes3'])
+    parser.add_argument('--mode', action='append',
+                        choices=['async', 'threaded'])
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS)
+    parser.add_argument('--tls', action='store_true',
+                        help='use FTPS (explicit TLS)')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=16,
+                        help='backend workers in async mode')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds added to every fakes3 call')
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--listings', type=int, default=50)
+    parser.add_argument('--listing-size', type=int, default=10000)
+    parser.add_argument('--small-files', type=int, default=500)
+    parser.add_argument('--small-size', type=int, default=4096)
+    parser.add_argument('--large-size', type=int, default=64 * 1024 * 1024)
+    parser.add_argument('--output', default='loadtest.json')
+    parser.add_argument('--compare', help='results of a previous run')
+    args = parser.parse_args()
+    args.backend = args.backend or ['mem', 'osfs', 'fakes3']
+    args.mode = args.mode or ['async', 'threaded']
+    args.scenario = args.scenario or SCENARIOS
+
+    results = run(args)
+    output = {
+        'meta': {
+            'revision': _git_revision(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'args': vars(args),
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Micro-benchmark of the path translation of AbstractedFS.
+
+Runs ftp2fs() and validpath() the way a command does over a set of
+client paths (absolute and relative, some needing normalization) and
+prints the CPU time per path, e.g.:
+
+    python benchmarks/path_translation.py --paths 100000 --repeat 5
+"""
+import os
+import sys
+import time
+import json
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from fstpy.filesystems import AbstractedFS
+
+
+class _CommandChannel(object):
+    username = None
+
+
+def make_paths(count, distinct):
+    rnd = random.Random(0)
+    names = ['data', 'incoming', 'reports', '2024', 'file.csv', '..', '.']
+    paths = []
+    for _ in range(distinct):
+        path = '/'.join(rnd.choice(names) for _ in range(rnd.randint(1, 5)))
+        if rnd.random() < 0.5:
+            path = '/' + path
+        paths.append(path)
+    return [paths[i % distinct] for i in range(count)]
+
+
+def run(afs, paths, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.process_time()
+        for path in paths:
+            afs.validpath(afs.ftp2fs(path))
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--paths', type=int, default=100000)
+    parser.add_argument('--distinct', type=int, default=200,
+                        help='distinct paths, as a session reuses a few')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    afs = AbstractedFS(u'mem://', _CommandChannel())
+    afs.cwd = u'/data/incoming'
+    paths = make_paths(args.paths, args.distinct)
+    elapsed = run(afs, paths, args.repeat)
+    print(json.dumps({'paths': args.paths, 'seconds': elapsed,
+                      'us_per_path': elapsed * 1e6 / args.paths},
+                     indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
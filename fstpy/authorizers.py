@@ -1,9 +1,33 @@
 import os
 import fs 
+import fs.errors
+import fs.path
 import sys
-from hashlib import md5
+import hmac
+import time
+import threading
+import functools
+
+import pyftpdlib.authorizers
+
+from .cache import MetadataCache
+from .credentials import open_store, verify_password
+
+
+class _PermNode(object):
+    """A node of the per-user tree of permission overrides, one per
+    path component.
+    rule is a (perm, recursive, order) tuple for directories having
+    an override, order being the position of the override in the
+    user's "operms" dict.
+    """
+
+    __slots__ = ('children', 'rule')
+
+    def __init__(self):
+        self.children = {}
+        self.rule = None
 
-import pyftpdlib
 
 class DummyAuthorizer(pyftpdlib.authorizers.DummyAuthorizer):
     """Basic "dummy" authorizer class, suitable for subclassing to
@@ -17,21 +41,75 @@ class DummyAuthorizer(pyftpdlib.authorizers.DummyAuthorizer):
     independent interface for managing "virtual" FTP users. System
     dependent authorizers can by written by subclassing this base
     class and overriding appropriate methods as necessary.
+    Besides add_user(), users can come from a CredentialStore (see
+    fstpy.credentials): they are looked up when they log in, and
+    looked up again at every login so that changes to the store
+    apply without restarting.
     """
 
     read_perms = "elr"
     write_perms = "adfmwMT"
+    # max number of has_perm() decisions remembered
+    perm_cache_size = 10000
+    # seconds whether a path is a directory is remembered, for the
+    # non recursive overrides (see _resolve_perm()), 0 asks the
+    # backend every time
+    isdir_ttl = 5.0
+    # max number of paths whose type is remembered
+    isdir_cache_size = 10000
+    # how stored passwords which are not scrypt hashes are compared
+    legacy_passwords = 'plain'
+    # seconds a successful login is remembered, so that the password
+    # hash is not verified again, 0 disables it
+    login_cache_ttl = 300
+    # the fstpy.metrics.Metrics logins and permission checks are timed
+    # in, None disables it
+    metrics = None
 
-    def __init__(self, fs_url, cred_file=None):
+    def __init__(self, fs_url, cred_file=None, store=None):
+        """
+         - (str) fs_url: the PyFilesystem2 URL users' homes are on.
+         - (str) cred_file: the path of the credential store (see
+           fstpy.credentials.open_store()).
+         - (instance) store: a CredentialStore, instead of cred_file.
+        """
         super().__init__()
         self.fs_url = fs_url
-        self.fs = fs.open_fs(fs_url)
+        # opened on first use, see the fs property
+        self._fs = None
+        self._fs_pid = None
         self.user_table = {}
-        if cred_file != None:
-            with open(cred_file, 'r') as f:
-                for l in f.readlines():
-                    i = l.split(';')
-                    self.add_user(*i)
+        self._perm_trees = {}
+        self._perm_cache = {}
+        # backend path: whether it is a directory
+        self._isdir_cache = MetadataCache(self.isdir_cache_size,
+                                          self.isdir_ttl)
+        if store is None and cred_file is not None:
+            store = open_store(cred_file)
+        self.store = store
+        self._login_cache = {}
+        self._login_key = os.urandom(16)
+        self._lock = threading.Lock()
+
+    @property
+    def fs(self):
+        """The filesystem users' homes are on, opened by each process
+        on first use: its network clients must not be inherited across
+        fork().
+        """
+        if self._fs is None or self._fs_pid != os.getpid():
+            self._fs = fs.open_fs(self.fs_url)
+            self._fs_pid = os.getpid()
+        return self._fs
+
+    def warm_up(self):
+        """Open the filesystem and the credential store connection of
+        this process in advance (e.g. in a worker process right after
+        fork()) so that the first login does not wait for them.
+        """
+        self.fs.getinfo('/')
+        if self.store is not None:
+            self.store.get('')
 
     def add_user(self, username, password, homedir, perm='elr',
                  msg_login="Login successful.", msg_quit="Goodbye."):
@@ -61,32 +139,153 @@ class DummyAuthorizer(pyftpdlib.authorizers.DummyAuthorizer):
             homedir = homedir.decode('utf8')
         if not self.fs.isdir(homedir):
             raise ValueError('no such directory: %r' % homedir)
+        self._set_user(username, password, homedir, perm, msg_login,
+                       msg_quit)
 
-        self.fs = fs.open_fs(self.fs_url+homedir)
+    def _set_user(self, username, password, homedir, perm, msg_login,
+                  msg_quit, record=None):
         self._check_permissions(username, perm)
+        old = self.user_table.get(username)
         dic = {'pwd': str(password),
                'home': self.fs_url+homedir,
                #'root': self.fs_url+homedir,
                'perm': perm,
-               'operms': {},
+               'operms': old['operms'] if old is not None else {},
                'msg_login': str(msg_login),
-               'msg_quit': str(msg_quit)
+               'msg_quit': str(msg_quit),
+               'record': record,
                }
         self.user_table[username] = dic
+        self._compile_perms(username)
 
+    def load_user(self, username):
+        """Refresh username's entry from the credential store, if
+        any; the user is revoked if it is no longer in the store.
+        Users added with add_user() are left alone.
+        """
+        if self.store is None:
+            return
+        current = self.user_table.get(username)
+        if current is not None and current['record'] is None:
+            return
+        record = self.store.get(username)
+        with self._lock:
+            if record is None:
+                if current is not None and not current.get('revoked'):
+                    self._revoke_user(username)
+            elif current is None or current['record'] != record:
+                self._set_user(record.username, record.password,
+                               record.homedir, record.perm,
+                               record.msg_login, record.msg_quit, record)
+
+    def _revoke_user(self, username):
+        """Take all the permissions of username away and refuse its
+        logins.  The entry is kept for the sessions it still has in
+        this process: their commands are denied rather than failing
+        on a missing user.
+        """
+        user = self.user_table[username]
+        self.user_table[username] = dict(user, perm='', operms={},
+                                         revoked=True)
+        self._compile_perms(username)
+
+    def has_user(self, username):
+        """Whether the user exists and was not revoked."""
+        user = self.user_table.get(username)
+        return user is not None and not user.get('revoked')
+
+    def check_password(self, username, password):
+        """Whether password is the one of username, remembering
+        successful verifications for login_cache_ttl seconds.
+        """
+        stored = self.user_table[username]['pwd']
+        key = hmac.new(self._login_key,
+                       ('%s\0%s\0%s' % (username, stored, password)
+                        ).encode('utf8'), 'sha256').digest()
+        now = time.time()
+        if self._login_cache.get(key, 0) > now:
+            return True
+        if not verify_password(password, stored, self.legacy_passwords):
+            return False
+        if self.login_cache_ttl:
+            if len(self._login_cache) >= 10000:
+                self._login_cache = {}
+            self._login_cache[key] = now + self.login_cache_ttl
+        return True
+
+    def prepare_authentication(self, username, password):
+        """Do the expensive part of validate_authentication() (store
+        lookup, password hashing) in advance, typically from a worker
+        thread; the following validate_authentication() call with the
+        same credentials is then served from memory.
+        """
+        self.load_user(username)
+        if self.has_user(username):
+            self.check_password(username, password)
+
+    def validate_authentication(self, username, password, handler):
+        """Raises AuthenticationFailed if supplied username and
+        password don't match the stored credentials, else return
+        None.
+        """
+        if self.metrics is not None:
+            # not passed positionally, so that it is never logged
+            validate = functools.partial(self._validate_authentication,
+                                         password=password)
+            return self.metrics.call('fstpy_auth_check', 'login', username,
+                                     validate, username)
+        return self._validate_authentication(username, password)
+
+    def _validate_authentication(self, username, password):
+        self.load_user(username)
+        msg = "Authentication failed."
+        if not self.has_user(username):
+            if username == 'anonymous':
+                msg = "Anonymous access not allowed."
+            raise pyftpdlib.authorizers.AuthenticationFailed(msg)
+        if username != 'anonymous':
+            if not self.check_password(username, password):
+                raise pyftpdlib.authorizers.AuthenticationFailed(msg)
+
+    def remove_user(self, username):
+        """Remove a user from the virtual users table."""
+        del self.user_table[username]
+        self._perm_trees.pop(username, None)
+        self._perm_cache.clear()
 
     def override_perm(self, username, directory, perm, recursive=False):
-        """Override permissions for a given directory."""
+        """Override permissions for a given directory.
+        directory is a path relative to the user's home directory
+        (e.g. "/incoming").
+        """
         self._check_permissions(username, perm)
-        if not self.fs.isdir(directory):
-            raise ValueError('no such directory: %r' % directory)
-        directory = os.path.normcase(os.path.realpath(directory))
-        home = os.path.normcase(self.get_home_dir(username))
-        if directory == home:
-            raise ValueError("can't override home directory permissions")
-        if not self._issubpath(directory, home):
+        try:
+            directory = fs.path.abspath(fs.path.normpath(directory))
+        except fs.errors.IllegalBackReference:
             raise ValueError("path escapes user home directory")
+        if directory == '/':
+            raise ValueError("can't override home directory permissions")
+        with fs.open_fs(self.get_home_dir(username)) as home_fs:
+            if not home_fs.isdir(directory):
+                raise ValueError('no such directory: %r' % directory)
         self.user_table[username]['operms'][directory] = perm, recursive
+        self._compile_perms(username)
+
+    def _compile_perms(self, username):
+        """Build the tree of username's permission overrides and forget
+        the decisions taken so far. To be called every time the
+        "operms" dict of the user changes.
+        """
+        root = _PermNode()
+        operms = self.user_table[username]['operms']
+        for order, (directory, (perm, recursive)) in \
+                enumerate(operms.items()):
+            node = root
+            for part in fs.path.iteratepath(directory):
+                node = node.children.setdefault(part, _PermNode())
+            node.rule = (perm, recursive, order)
+        self._perm_trees[username] = root
+        self._perm_cache.clear()
 
 
     def has_perm(self, username, perm, path=None):
@@ -95,28 +294,168 @@ class DummyAuthorizer(pyftpdlib.authorizers.DummyAuthorizer):
         Expected perm argument is one of the following letters:
         "elradfmwMT".
         """
-        if path is None:
-            return perm in self.user_table[username]['perm']
+        if self.metrics is not None:
+            return self.metrics.call('fstpy_auth_check', 'has_perm',
+                                     username, self._has_perm, username,
+                                     perm, path)
+        return self._has_perm(username, perm, path)
+
+    def has_tree_perm(self, username, perm, path):
+        """Whether the user has permission over directory path and
+        everything below it, whatever the tree holds (e.g. before a
+        recursive delete).  Decided from the overrides alone: none of
+        those below path may take perm away, and a non recursive
+        override only grants perm over its directory and the files
+        directly inside it, the directories below it need perm from a
+        recursive override or the user's permissions.
+        """
+        if not self.has_perm(username, perm, path):
+            return False
+        prefix = path.rstrip('/') + '/'
+        if not all(perm in operm for directory, (operm, _) in
+                   self.user_table[username]['operms'].items()
+                   if directory.startswith(prefix)):
+            return False
+        node = self._perm_trees[username]
+        # the recursive rules of the directories above path
+        inherited = []
+        for part in fs.path.iteratepath(path):
+            if node.rule is not None and node.rule[1]:
+                inherited.append(node.rule)
+            node = node.children.get(part)
+            if node is None:
+                return self._rules_grant(username, perm, inherited)
+        return self._tree_grants(username, perm, node, inherited)
 
-        path = os.path.normcase(path)
-        for dir in self.user_table[username]['operms'].keys():
-            operm, recursive = self.user_table[username]['operms'][dir]
-            if self._issubpath(path, dir):
-                if recursive:
-                    return perm in operm
-                if (path == dir or os.path.dirname(path) == dir and not
-                        self.fs.isdir(path)):
-                    return perm in operm
+    def _tree_grants(self, username, perm, node, inherited):
+        """Whether perm is granted over everything below the
+        directory of node, inherited being the recursive rules of the
+        directories above it.
+        """
+        rules = inherited
+        if node.rule is not None and node.rule[1]:
+            rules = inherited + [node.rule]
+        if not self._rules_grant(username, perm, rules):
+            # its subdirectories without an override of their own
+            return False
+        if node.rule is not None and not node.rule[1] and \
+                not self._rules_grant(username, perm, rules + [node.rule]):
+            # the files directly inside it
+            return False
+        return all(self._tree_grants(username, perm, child, rules)
+                   for child in node.children.values())
 
+    def _rules_grant(self, username, perm, rules):
+        """Whether perm is granted by the first of rules, (perm,
+        recursive, order) tuples, or by the user's permissions if
+        there is none.
+        """
+        if rules:
+            return perm in min(rules, key=lambda rule: rule[2])[0]
         return perm in self.user_table[username]['perm']
 
+    def is_read_only(self, username):
+        """Whether the user has no write permission anywhere, its
+        permission overrides included.
+        """
+        user = self.user_table[username]
+        perms = [user['perm']] + [
+            perm for perm, _ in user['operms'].values()]
+        return not any(p in self.write_perms for perm in perms for p in perm)
 
-class MD5Authorizer(DummyAuthorizer):
+    def _has_perm(self, username, perm, path):
+        if path is None:
+            return perm in self.user_table[username]['perm']
 
-    def validate_authentication(self, username, password, handler):
-        _hash = md5(password.encode('utf8')).hexdigest()
+        key = (username, perm, path)
         try:
-            if self.user_table[username]['pwd'] != _hash:
-                raise KeyError
+            return self._perm_cache[key]
         except KeyError:
-            raise pyftpdlib.authorizers.AuthenticationFailed
\ No newline at end of file
+            pass
+        operm, cacheable = self._resolve_perm(username, path)
+        result = perm in operm
+        if cacheable:
+            if len(self._perm_cache) >= self.perm_cache_size:
+                self._perm_cache.clear()
+            self._perm_cache[key] = result
+        return result
+
+    def _backend_path(self, username, path):
+        """Return the path on the filesystem of path, relative to the
+        user's home.
+        """
+        homedir = self.user_table[username]['home'][len(self.fs_url):]
+        return fs.path.join(homedir or '/', fs.path.relpath(path))
+
+    def _isdir(self, username, path):
+        """Whether path, relative to the user's home, is a directory,
+        asking the backend once every isdir_ttl seconds at most.
+        """
+        real = self._backend_path(username, path)
+        isdir = self._isdir_cache.get(real)
+        if isdir is None:
+            isdir = self.fs.isdir(real)
+            self._isdir_cache.put(real, isdir)
+        return isdir
+
+    def invalidate_path(self, username, path, tree=False):
+        """Forget what is known of path, relative to the user's home,
+        and of everything below it if tree (e.g. once it was written
+        to by a session).
+        """
+        real = self._backend_path(username, path)
+        if tree:
+            self._isdir_cache.invalidate_tree(real)
+        else:
+            self._isdir_cache.invalidate(real)
+
+    def _resolve_perm(self, username, path):
+        """Return the permissions string applying to path, and
+        whether the decision may be cached.
+        As with a linear scan of the "operms" dict, the first override
+        (in insertion order) covering path wins: a recursive override
+        covers the whole tree below its directory, a non recursive one
+        the directory itself and the files directly inside it.
+        Telling the files from the subdirectories takes a backend
+        call, whose answer is remembered for isdir_ttl seconds (see
+        invalidate_path()): those decisions are not cached, the path
+        may change type.
+        """
+        parts = fs.path.iteratepath(path)
+        node = self._perm_trees[username]
+        nodes = []
+        for part in parts:
+            node = node.children.get(part)
+            if node is None:
+                break
+            nodes.append(node)
+        best = None
+        cacheable = True
+        depth = len(parts)
+        for i, node in enumerate(nodes, 1):
+            if node.rule is None:
+                continue
+            operm, recursive, order = node.rule
+            if best is not None and order > best[1]:
+                continue
+            if recursive or i == depth:
+                best = (operm, order)
+            elif i == depth - 1:
+                # directories with an override of their own need no
+                # backend call
+                if len(nodes) == depth and nodes[-1].rule is not None:
+                    continue
+                cacheable = False
+                if not self._isdir(username, path):
+                    best = (operm, order)
+        if best is not None:
+            return best[0], cacheable
+        return self.user_table[username]['perm'], cacheable
+
+
+class MD5Authorizer(DummyAuthorizer):
+    """DummyAuthorizer whose stored passwords are MD5 hex digests
+    (or scrypt hashes made by fstpy.credentials.hash_password()).
+    """
+
+    legacy_passwords = 'md5'
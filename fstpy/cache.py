@@ -0,0 +1,90 @@
+import time
+import threading
+import weakref
+import collections
+
+
+class MetadataCache(object):
+    """A bounded in-memory cache of fs.info.Info objects keyed by
+    filesystem path.
+    Entries are evicted in least recently used order once more than
+    max_entries are stored and expire ttl seconds after being cached.
+    The hits and misses attributes count lookups served from and
+    missed by the cache.
+    """
+
+    def __init__(self, max_entries=10000, ttl=5.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, path):
+        """Return the cached Info for path or None."""
+        with self._lock:
+            try:
+                expires, info = self._entries[path]
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires < time.time():
+                del self._entries[path]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(path)
+            self.hits += 1
+            return info
+
+    def put(self, path, info):
+        """Cache info for path."""
+        with self._lock:
+            self._entries[path] = (time.time() + self.ttl, info)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, path):
+        """Forget path."""
+        with self._lock:
+            self._entries.pop(path, None)
+
+    def invalidate_tree(self, path):
+        """Forget path and everything below it."""
+        prefix = path.rstrip('/') + '/'
+        with self._lock:
+            self._entries.pop(path, None)
+            for key in [k for k in self._entries if k.startswith(prefix)]:
+                del self._entries[key]
+
+    def clear(self):
+        """Forget everything."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return a dict with the cache counters."""
+        return {'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses}
+
+
+_shared_caches = weakref.WeakValueDictionary()
+_shared_lock = threading.Lock()
+
+
+def shared_cache(key, max_entries=10000, ttl=5.0):
+    """Return the MetadataCache shared by all sessions using key (e.g.
+    the same user on the same filesystem), creating it if needed.
+    A shared cache lives as long as at least one session uses it.
+    """
+    with _shared_lock:
+        cache = _shared_caches.get(key)
+        if cache is None:
+            cache = MetadataCache(max_entries, ttl)
+            _shared_caches[key] = cache
+        return cache
@@ -0,0 +1,245 @@
+import os
+import re
+import zlib
+import sqlite3
+import hashlib
+import threading
+import collections
+import concurrent.futures
+
+from pyftpdlib.log import logger
+
+from .contentcache import validator
+
+
+class _CRC32(object):
+    """CRC-32 with the interface of the hashlib objects."""
+
+    def __init__(self):
+        self._crc = 0
+
+    def update(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+
+    def hexdigest(self):
+        return '%08x' % (self._crc & 0xffffffff)
+
+
+# the supported algorithms, by their name in the HASH command
+ALGORITHMS = collections.OrderedDict([
+    ('SHA-256', hashlib.sha256),
+    ('SHA-1', hashlib.sha1),
+    ('SHA-512', hashlib.sha512),
+    ('MD5', hashlib.md5),
+    ('CRC32', _CRC32),
+])
+
+_MD5_ETAG = re.compile(r'^"?([0-9a-fA-F]{32})"?$')
+
+
+def etag_md5(info):
+    """Return the MD5 digest of a file as given by the backend (e.g.
+    the ETag of an S3 object uploaded in a single request and not
+    encrypted with KMS), or None if not known.
+    """
+    s3 = info.raw.get('s3', {})
+    if s3.get('server_side_encryption') == 'aws:kms':
+        return None
+    # multipart uploads have ETags like "<md5 of the parts>-<parts>"
+    match = _MD5_ETAG.match(s3.get('e_tag') or '')
+    return match.group(1).lower() if match else None
+
+
+def hash_file(file, algorithm, start=0, end=None, block_size=1024 * 1024):
+    """Return the hex digest of the bytes of the binary file object
+    file from start to end (excluded, the end of the file if None).
+    """
+    hasher = ALGORITHMS[algorithm]()
+    file.seek(start)
+    left = None if end is None else end - start
+    while left is None or left > 0:
+        data = file.read(block_size if left is None
+                         else min(block_size, left))
+        if not data:
+            break
+        hasher.update(data)
+        if left is not None:
+            left -= len(data)
+    return hasher.hexdigest()
+
+
+class HashingFile(object):
+    """Proxy for files being uploaded, hashing the data written with
+    algorithms as it streams through.  complete tells whether the
+    whole file was written and closed successfully, i.e. whether
+    hexdigests() are those of the file stored.
+    """
+
+    def __init__(self, file, algorithms):
+        self._file = file
+        self._hashers = [(name, ALGORITHMS[name]()) for name in algorithms]
+        self._aborted = False
+        self.complete = False
+        if hasattr(file, 'abort'):
+            self.abort = self._abort
+
+    def write(self, data):
+        n = self._file.write(data)
+        for _, hasher in self._hashers:
+            hasher.update(data)
+        return n
+
+    def _abort(self):
+        self._aborted = True
+        self._file.abort()
+
+    def close(self):
+        closed = self._file.closed
+        self._file.close()
+        if not closed and not self._aborted:
+            self.complete = True
+
+    def hexdigests(self):
+        return dict((name, hasher.hexdigest())
+                    for name, hasher in self._hashers)
+
+    def __getattr__(self, attr):
+        return getattr(self._file, attr)
+
+
+class ChecksumIndex(object):
+    """The checksums of the files of the backends, kept in an SQLite
+    database shared by all the processes using the same file.
+    Every checksum is recorded with the validator of the file it was
+    computed for (size, modification time and ETag), and only handed
+    out while the file is still that version.  Uploads are hashed
+    with algorithms as they stream through, and recorded once stored
+    by record(), in background.
+     - (str) path: the SQLite database.
+     - (list) algorithms: names of the algorithms uploads are hashed
+       with (see ALGORITHMS).
+    """
+
+    def __init__(self, path, algorithms=('SHA-256', 'SHA-1', 'MD5',
+                                         'CRC32'), workers=2):
+        for name in algorithms:
+            if name not in ALGORITHMS:
+                raise ValueError('unknown algorithm %r' % name)
+        self.path = path
+        self.algorithms = tuple(algorithms)
+        self.workers = workers
+        self._local = threading.local()
+        self._pid = None
+        self._check_fork()
+        with self._connection() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS checksums ('
+                'url TEXT NOT NULL, path TEXT NOT NULL, '
+                'algorithm TEXT NOT NULL, validator TEXT NOT NULL, '
+                'digest TEXT NOT NULL, '
+                'PRIMARY KEY (url, path, algorithm))')
+
+    def _check_fork(self):
+        # the executor threads are not inherited by a child process
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                self.workers)
+            # (url, path): future of the pending record() call
+            self._pending = {}
+
+    def _connection(self):
+        # sqlite3 connections can not be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, url, path, algorithm, validator):
+        """Return the digest of path for validator, or None."""
+        self._check_fork()
+        future = self._pending.get((url, path))
+        if future is not None:
+            # just uploaded: wait for it to be recorded
+            concurrent.futures.wait([future])
+        row = self._connection().execute(
+            'SELECT digest FROM checksums WHERE url = ? AND path = ? AND '
+            'algorithm = ? AND validator = ?',
+            (url, path, algorithm, validator)).fetchone()
+        return row[0] if row is not None else None
+
+    def put(self, url, path, validator, digests):
+        """Record digests, a dict of algorithm: digest, for the version
+        validator of path; those of other versions are forgotten.
+        """
+        with self._connection() as conn:
+            conn.execute(
+                'DELETE FROM checksums WHERE url = ? AND path = ? AND '
+                'validator != ?', (url, path, validator))
+            conn.executemany(
+                'INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?)',
+                [(url, path, algorithm, validator, digest)
+                 for algorithm, digest in digests.items()])
+
+    def forget(self, url, path, tree=False):
+        """Forget the digests of path, and of everything below it if
+        tree.
+        """
+        with self._connection() as conn:
+            if tree:
+                prefix = path.rstrip('/') + '/'
+                conn.execute(
+                    'DELETE FROM checksums WHERE url = ? AND (path = ? OR '
+                    'substr(path, 1, ?) = ?)',
+                    (url, path, len(prefix), prefix))
+            else:
+                conn.execute(
+                    'DELETE FROM checksums WHERE url = ? AND path = ?',
+                    (url, path))
+
+    def record(self, url, path, fs_obj, digests):
+        """Record in background the digests of the file just stored
+        at path on fs_obj; get() waits for it meanwhile.
+        """
+        self._check_fork()
+        key = (url, path)
+
+        def run(previous):
+            if previous is not None:
+                concurrent.futures.wait([previous])
+            try:
+                info = fs_obj.getinfo(path, namespaces=['details', 's3'])
+                self.put(url, path, validator(info), digests)
+            except Exception:
+                logger.exception('could not record the checksums of %r',
+                                 path)
+            finally:
+                with self._lock:
+                    if self._pending.get(key) is future:
+                        del self._pending[key]
+
+        with self._lock:
+            future = self._executor.submit(run, self._pending.get(key))
+            self._pending[key] = future
+        return future
+
+    def wait_for(self, url, path, future):
+        """Have the next record() and get() calls for path wait for
+        future to be done, e.g. that of a forget() of path run by
+        another thread.
+        """
+        self._check_fork()
+        key = (url, path)
+
+        def done(_):
+            with self._lock:
+                if self._pending.get(key) is future:
+                    del self._pending[key]
+
+        with self._lock:
+            self._pending[key] = future
+        future.add_done_callback(done)
@@ -0,0 +1,215 @@
+import os
+import shutil
+import hashlib
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class _FileLock(object):
+    """An exclusive lock held on path, excluding the other processes
+    and threads locking the same path (flock() locks belong to the
+    open file, every acquisition opens it again).
+    Without fcntl (Windows) only the threads of this process are
+    excluded.
+    """
+
+    _thread_locks = {}
+    _thread_locks_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = path
+        self._f = None
+        self._thread_lock = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self._f = open(self.path, 'a')
+            fcntl.flock(self._f.fileno(), fcntl.LOCK_EX)
+        else:
+            with self._thread_locks_lock:
+                self._thread_lock = self._thread_locks.setdefault(
+                    self.path, threading.Lock())
+            self._thread_lock.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        if self._f is not None:
+            fcntl.flock(self._f.fileno(), fcntl.LOCK_UN)
+            self._f.close()
+            self._f = None
+        else:
+            self._thread_lock.release()
+
+
+class ContentCache(object):
+    """An on-disk read-through cache of the content of remote files,
+    shared by all the processes using the same directory.
+    Entries are validated against the resource info of the remote
+    file (size, modification time and ETag when the backend provides
+    one): a file changed on the backend is fetched again.
+    A file requested by several sessions at the same time is only
+    fetched once, the others waiting for it; the least recently used
+    entries are removed once the cache is larger than max_size bytes.
+     - (str) directory: where cached files are stored.
+     - (int) max_size: the max total size of the cached files.
+     - (int) max_file_size: files larger than this are not cached.
+    """
+
+    def __init__(self, directory, max_size=10 * 1024 ** 3,
+                 max_file_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.hits = 0
+        self.misses = 0
+
+    def cacheable(self, info):
+        """Whether the file whose resource info is info can be
+        cached.
+        """
+        size = info.size
+        if size is None:
+            return False
+        if self.max_file_size is not None and size > self.max_file_size:
+            return False
+        return size <= self.max_size
+
+    def open(self, url, path, info, fetch):
+        """Return a local file object with the content of the remote
+        file path of the filesystem at url, fetching it with fetch()
+        (returning a binary file object reading the remote file) if
+        it is not cached yet or no longer valid.
+        Return None if the file changed while being fetched.
+        """
+        key = hashlib.sha256(
+            ('%s\0%s' % (url, path)).encode('utf8')).hexdigest()
+        version = hashlib.sha256(
+            validator(info).encode('utf8')).hexdigest()[:16]
+        entry_dir = os.path.join(self.directory, key[:2])
+        entry = os.path.join(entry_dir, '%s-%s' % (key, version))
+        file = self._open_entry(entry)
+        if file is not None:
+            self.hits += 1
+            return file
+        if not os.path.isdir(entry_dir):
+            try:
+                os.makedirs(entry_dir)
+            except OSError:
+                # made by another process in the meantime
+                pass
+        with _FileLock(os.path.join(entry_dir, key + '.lock')):
+            # another process may have fetched it while we waited
+            file = self._open_entry(entry)
+            if file is not None:
+                self.hits += 1
+                return file
+            self.misses += 1
+            if not self._fill(entry, fetch, info.size):
+                return None
+            self._remove_versions(entry_dir, key, entry)
+            file = self._open_entry(entry)
+        self._evict()
+        return file
+
+    def _open_entry(self, entry):
+        try:
+            file = open(entry, 'rb')
+        except (IOError, OSError):
+            return None
+        try:
+            # the mtime of entries is their last use
+            os.utime(entry, None)
+        except OSError:
+            pass
+        return file
+
+    def _fill(self, entry, fetch, size):
+        tmp = '%s.%d.%d.tmp' % (entry, os.getpid(), threading.get_ident())
+        try:
+            with fetch() as src:
+                with open(tmp, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+                    complete = dst.tell() == size
+            if complete:
+                os.rename(tmp, entry)
+                return True
+            os.remove(tmp)
+            return False
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def _remove_versions(self, entry_dir, key, entry):
+        """Remove the other versions of the file."""
+        prefix = key + '-'
+        for name in os.listdir(entry_dir):
+            path = os.path.join(entry_dir, name)
+            if name.startswith(prefix) and path != entry and \
+                    not name.endswith('.tmp'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _entries(self):
+        for sub in os.listdir(self.directory):
+            sub_dir = os.path.join(self.directory, sub)
+            if not os.path.isdir(sub_dir):
+                continue
+            for name in os.listdir(sub_dir):
+                if name.endswith('.lock') or name.endswith('.tmp'):
+                    continue
+                path = os.path.join(sub_dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield st.st_mtime, st.st_size, path
+
+    def size(self):
+        """Return the total size of the cached files."""
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        """Remove the least recently used entries until the cache is
+        no larger than max_size.
+        """
+        with _FileLock(os.path.join(self.directory, 'evict.lock')):
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_size:
+                    break
+                try:
+                    # files being sent keep their content until closed
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+
+    def clear(self):
+        """Remove all the cached files."""
+        for _, _, path in list(self._entries()):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def validator(info):
+    """Return the string identifying the version of a remote file
+    whose resource info (with the details and, on S3, the s3
+    namespaces) is info.
+    """
+    raw = info.raw
+    details = raw.get('details', {})
+    # the "s3" namespace of S3FS
+    etag = raw.get('s3', {}).get('e_tag')
+    return '%s:%s:%s' % (details.get('size'), details.get('modified'), etag)
@@ -0,0 +1,194 @@
+import os
+import hmac
+import time
+import base64
+import hashlib
+import sqlite3
+import threading
+import collections
+
+from pyftpdlib.log import logger
+
+
+UserRecord = collections.namedtuple(
+    'UserRecord',
+    ['username', 'password', 'homedir', 'perm', 'msg_login', 'msg_quit'])
+UserRecord.__new__.__defaults__ = ('elr', "Login successful.", "Goodbye.")
+
+
+# --- Password hashing
+
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+
+def hash_password(password, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    """Return a salted scrypt hash of password in the form
+    "scrypt$n$r$p$salt$hash", suitable for the credentials file.
+    """
+    salt = os.urandom(16)
+    digest = hashlib.scrypt(password.encode('utf8'), salt=salt, n=n, r=r,
+                            p=p)
+    return 'scrypt$%d$%d$%d$%s$%s' % (
+        n, r, p, base64.b64encode(salt).decode('ascii'),
+        base64.b64encode(digest).decode('ascii'))
+
+
+def verify_password(password, stored, legacy='plain'):
+    """Whether password matches the stored hash.
+    Hashes made by hash_password() are recognized by their prefix,
+    anything else is compared according to legacy: "plain" for clear
+    text passwords or "md5" for hex MD5 digests.
+    """
+    if stored.startswith('scrypt$'):
+        try:
+            _, n, r, p, salt, digest = stored.split('$')
+            salt = base64.b64decode(salt)
+            digest = base64.b64decode(digest)
+        except ValueError:
+            return False
+        computed = hashlib.scrypt(password.encode('utf8'), salt=salt,
+                                  n=int(n), r=int(r), p=int(p),
+                                  dklen=len(digest))
+        return hmac.compare_digest(computed, digest)
+    if legacy == 'md5':
+        password = hashlib.md5(password.encode('utf8')).hexdigest()
+    return hmac.compare_digest(password.encode('utf8'),
+                               stored.encode('utf8'))
+
+
+# --- Credential stores
+
+class CredentialStore(object):
+    """Base class of credential stores: the source the authorizers
+    look users up from, lazily, when they log in.
+    """
+
+    def get(self, username):
+        """Return the UserRecord of username or None."""
+        raise NotImplementedError('must be implemented in subclass')
+
+    def close(self):
+        pass
+
+
+class TextCredentialStore(CredentialStore):
+    """Credentials stored in a text file, one user per line:
+    username;password;homedir;perm;msg_login;msg_quit
+    Blank lines and lines starting with "#" are ignored, malformed
+    lines are skipped with a warning.
+    The file is parsed again when it changes, checking its mtime at
+    most every reload_interval seconds; the last version read is kept
+    if it can not be read.
+    """
+
+    reload_interval = 1.0
+
+    def __init__(self, path):
+        self.path = path
+        self._users = {}
+        self._mtime = None
+        self._checked = 0
+        self._lock = threading.Lock()
+        self._reload()
+
+    def _reload(self):
+        mtime = os.stat(self.path).st_mtime
+        if mtime == self._mtime:
+            return
+        users = {}
+        with open(self.path, 'r', encoding='utf8') as f:
+            # a version which can not be parsed is not tried again
+            self._mtime = mtime
+            for lineno, line in enumerate(f, 1):
+                line = line.rstrip('\r\n')
+                if not line.strip() or line.startswith('#'):
+                    continue
+                fields = line.split(';')
+                # msg_login, msg_quit and perm are optional
+                if not 3 <= len(fields) <= len(UserRecord._fields) or \
+                        not fields[0]:
+                    logger.warning('%s:%d: malformed credentials, line '
+                                   'skipped', self.path, lineno)
+                    continue
+                record = UserRecord(*fields)
+                users[record.username] = record
+        self._users = users
+
+    def get(self, username):
+        now = time.time()
+        if now - self._checked >= self.reload_interval:
+            with self._lock:
+                self._checked = now
+                # keep serving the last good version
+                try:
+                    self._reload()
+                except OSError:
+                    pass
+                except Exception:
+                    logger.exception('could not read %s', self.path)
+        return self._users.get(username)
+
+
+class SQLiteCredentialStore(CredentialStore):
+    """Credentials stored in an SQLite database, looked up by primary
+    key at every login, so changes apply without any reload.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS users ('
+                'username TEXT PRIMARY KEY, password TEXT NOT NULL, '
+                'homedir TEXT NOT NULL, perm TEXT NOT NULL, '
+                'msg_login TEXT NOT NULL, msg_quit TEXT NOT NULL)')
+
+    def _connection(self):
+        # sqlite3 connections can not be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, username):
+        row = self._connection().execute(
+            'SELECT username, password, homedir, perm, msg_login, msg_quit '
+            'FROM users WHERE username = ?', (username,)).fetchone()
+        return UserRecord(*row) if row is not None else None
+
+    def put(self, record):
+        """Add or replace a user."""
+        with self._connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO users VALUES '
+                         '(?, ?, ?, ?, ?, ?)', tuple(record))
+
+    def delete(self, username):
+        """Remove a user."""
+        with self._connection() as conn:
+            conn.execute('DELETE FROM users WHERE username = ?', (username,))
+
+    def import_text(self, path):
+        """Import all the users of a text credentials file."""
+        for record in TextCredentialStore(path)._users.values():
+            self.put(record)
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def open_store(path):
+    """Return the credential store for path, chosen by its extension:
+    ".db", ".sqlite" and ".sqlite3" are SQLite databases, anything
+    else a text file.
+    """
+    if os.path.splitext(path)[1] in ('.db', '.sqlite', '.sqlite3'):
+        return SQLiteCredentialStore(path)
+    return TextCredentialStore(path)
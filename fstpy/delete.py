@@ -0,0 +1,163 @@
+import shutil
+import threading
+import concurrent.futures
+
+import fs
+import fs.errors
+
+from .rename import _raise_first
+from .streams import delegate, fs_s3fs, syspath
+
+
+# --- Batch deletes
+
+class _S3BatchDeleter(object):
+    """Deletes the objects below an S3FS directory by pages of up to
+    batch_size keys: one ListObjectsV2 and one DeleteObjects request
+    per page, instead of a request per object.
+    """
+
+    # DeleteObjects takes at most 1000 keys
+    batch_size = 1000
+
+    def __init__(self, fs_obj):
+        self.client = fs_obj.client
+        self.bucket = fs_obj._bucket_name
+        self.path_to_dir_key = fs_obj._path_to_dir_key
+
+    def batches(self, path):
+        """Yield the lists of keys below path, directory markers
+        included.
+        """
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(
+                Bucket=self.bucket, Prefix=self.path_to_dir_key(path),
+                PaginationConfig={'PageSize': self.batch_size}):
+            keys = [obj['Key'] for obj in page.get('Contents', ())]
+            if keys:
+                yield keys
+
+    def delete(self, keys):
+        resp = self.client.delete_objects(
+            Bucket=self.bucket,
+            Delete={'Objects': [{'Key': key} for key in keys],
+                    'Quiet': True})
+        errors = resp.get('Errors')
+        if errors:
+            raise fs.errors.OperationFailed(
+                errors[0]['Key'],
+                msg='could not delete %d objects: %s' % (
+                    len(errors), errors[0].get('Message')))
+
+
+def _s3_batch_deleter(fs_obj):
+    if fs_s3fs is None or not isinstance(fs_obj, fs_s3fs.S3FS):
+        return None
+    return _S3BatchDeleter(fs_obj)
+
+
+# Factories called with a filesystem returning a batch deleter (see
+# _S3BatchDeleter) for it, or None if the filesystem is not supported.
+# Append to this list to support other backends.
+batch_deleters = [_s3_batch_deleter]
+
+
+class _FileBatchDeleter(object):
+    """Batch deleter of any filesystem, removing files one by one;
+    the directories left empty are removed afterwards.
+    """
+
+    def __init__(self, fs_obj, batch_size):
+        self.fs = fs_obj
+        self.batch_size = batch_size
+
+    def batches(self, path):
+        # listed in full first: directories must not change while
+        # being walked
+        files = list(self.fs.walk.files(path))
+        for i in range(0, len(files), self.batch_size):
+            yield files[i:i + self.batch_size]
+
+    def delete(self, paths):
+        for path in paths:
+            try:
+                self.fs.remove(path)
+            except fs.errors.ResourceNotFound:
+                pass
+
+
+# --- Recursive deletes
+
+class DeleteEngine(object):
+    """Removes directory trees from a PyFilesystem2 filesystem.
+    Local directories are removed natively.  On the other backends the
+    tree is listed and deleted by batches, up to workers of them at a
+    time: a single request per batch_size objects where the backend
+    has a batch delete (see batch_deleters), a request per file
+    otherwise.  progress(path, done) is called every progress_every
+    objects deleted.
+    """
+
+    progress_every = 1000
+    # files per batch on backends without batch deletes, so that even
+    # small trees are spread over the workers
+    file_batch_size = 50
+
+    def __init__(self, workers=8, batch_size=1000, progress=None):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.progress = progress
+
+    def removetree(self, fs_obj, path):
+        """Remove the directory path and everything below it; return
+        the number of objects deleted (on local filesystems, None).
+        """
+        if not fs_obj.getinfo(path).is_dir:
+            raise fs.errors.DirectoryExpected(path)
+        local = syspath(fs_obj, path)
+        if local is not None:
+            shutil.rmtree(local)
+            return None
+        inner, inner_path = delegate(fs_obj, path)
+        for factory in batch_deleters:
+            deleter = factory(inner)
+            if deleter is not None:
+                done = self._delete(path, deleter, inner_path)
+                break
+        else:
+            done = self._delete(
+                path, _FileBatchDeleter(fs_obj, self.file_batch_size), path)
+        # what is left are empty directories, or their markers
+        if fs_obj.exists(path):
+            fs_obj.removetree(path)
+        return done
+
+    def _delete(self, path, deleter, inner_path):
+        done = [0]
+        reported = [0]
+        lock = threading.Lock()
+
+        def delete(batch):
+            deleter.delete(batch)
+            with lock:
+                done[0] += len(batch)
+                if self.progress is not None and \
+                        done[0] - reported[0] >= self.progress_every:
+                    reported[0] = done[0]
+                    self.progress(path, done[0])
+
+        # listing goes on while the previous batches are deleted, a
+        # bounded number of them queued; stop at the first error
+        window = self.workers * 2
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            pending = set()
+            for batch in deleter.batches(inner_path):
+                if len(pending) >= window:
+                    finished, pending = concurrent.futures.wait(
+                        pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    _raise_first(finished, pending)
+                pending.add(executor.submit(delete, batch))
+            finished, _ = concurrent.futures.wait(pending)
+            _raise_first(finished, ())
+        return done[0]
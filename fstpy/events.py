@@ -0,0 +1,206 @@
+import os
+import json
+import queue
+import tempfile
+import threading
+
+from pyftpdlib.log import logger
+
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
+
+def format_event(event, fields):
+    """Return the message published for event.
+    "received" events keep the historical "<channel> <file>" format,
+    channel being the first component of the file path; the others
+    are published as "fstpy.<event> <json fields>".
+    """
+    if event == 'received':
+        path = fields['file']
+        parts = path.split('/')
+        channel = parts[1] if len(parts) > 1 else ''
+        return '%s %s' % (channel, path)
+    return 'fstpy.%s %s' % (event, json.dumps(fields, sort_keys=True))
+
+
+class EventPublisher(object):
+    """Publishes server events (files sent and received, logins...)
+    without ever blocking the caller.
+    publish() only appends the event to an in-memory queue; a
+    background thread drains it handing batches of up to batch_size
+    messages to send(messages).
+    When more than max_queue events are waiting the overflow policy
+    applies: "drop" discards the new event, "spill" appends it to a
+    file in spill_dir, published once the queue has drained. Events
+    published meanwhile are spilled too, keeping them in order.
+    Publishers are per process: after a fork the child gets its own
+    queue and thread, created on first use.
+     - (callable) send: called from the background thread with a list
+       of messages (str).
+    """
+
+    def __init__(self, send, max_queue=10000, batch_size=100,
+                 overflow='drop', spill_dir=None, formatter=format_event):
+        if overflow not in ('drop', 'spill'):
+            raise ValueError('invalid overflow policy %r' % overflow)
+        self.send = send
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.overflow = overflow
+        self.spill_dir = spill_dir or tempfile.gettempdir()
+        self.formatter = formatter
+        self.dropped = 0
+        self.spilled = 0
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._spill_lock = threading.Lock()
+        self._spilling = False
+
+    @property
+    def spill_path(self):
+        return os.path.join(self.spill_dir,
+                            'fstpy-events-%d.spill' % os.getpid())
+
+    def _ensure_started(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._queue = queue.Queue(self.max_queue)
+            self._spilling = os.path.exists(self.spill_path)
+            self._thread = threading.Thread(target=self._run,
+                                            name='fstpy-events')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def publish(self, event, **fields):
+        """Queue event for publication, never blocking."""
+        self._ensure_started()
+        message = self.formatter(event, fields)
+        if self.overflow == 'spill' and self._spill(message, force=False):
+            return
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            if self.overflow == 'spill':
+                self._spill(message)
+            else:
+                self.dropped += 1
+
+    def close(self):
+        """Publish what is still queued and stop the background
+        thread.
+        """
+        if self._pid == os.getpid() and self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            self._pid = None
+
+    # --- Background thread
+
+    def _run(self):
+        q = self._queue
+        while True:
+            batch = [q.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            batch = [m for m in batch if m is not None]
+            self._send(batch)
+            if q.empty():
+                self._replay_spilled()
+            if stop:
+                return
+
+    def _send(self, batch):
+        if not batch:
+            return
+        try:
+            self.send(batch)
+        except Exception:
+            logger.exception('could not publish %d events', len(batch))
+
+    def _spill(self, message, force=True):
+        """Append message to the spill file; unless force, only when
+        events are already being spilled. Return True if spilled.
+        """
+        with self._spill_lock:
+            if not force and not self._spilling:
+                return False
+            with open(self.spill_path, 'a') as f:
+                f.write(message.replace('\n', ' ') + '\n')
+            self._spilling = True
+            self.spilled += 1
+            return True
+
+    def _replay_spilled(self):
+        path = self.spill_path
+        with self._spill_lock:
+            if not self._spilling:
+                return
+            # events published from now on are newer than the spilled
+            # ones: they are queued, sent once the replay is done
+            replay = path + '.replay'
+            os.rename(path, replay)
+            self._spilling = False
+        with open(replay) as f:
+            batch = []
+            for line in f:
+                batch.append(line.rstrip('\n'))
+                if len(batch) == self.batch_size:
+                    self._send(batch)
+                    batch = []
+            self._send(batch)
+        os.remove(replay)
+
+
+class ZMQForwarder(object):
+    """Binds the public ZMQ PUB socket once, in the process starting
+    the server, and forwards to it the messages pushed by the worker
+    processes through a local IPC socket.
+    ZMQ contexts and sockets are not fork safe: workers must use
+    sender(), which opens a PUSH socket lazily in the process (and
+    thread) actually sending.
+    """
+
+    def __init__(self, pub_address, collect_address=None):
+        if zmq is None:
+            raise ImportError('pyzmq is required to publish events')
+        self.pub_address = pub_address
+        self.collect_address = collect_address or 'ipc://%s' % (
+            os.path.join(tempfile.gettempdir(),
+                         'fstpy-events-%d.ipc' % os.getpid()))
+        self._thread = None
+
+    def start(self):
+        """Bind the sockets and start forwarding in a daemon thread."""
+        context = zmq.Context()
+        pub = context.socket(zmq.PUB)
+        pub.bind(self.pub_address)
+        pull = context.socket(zmq.PULL)
+        pull.bind(self.collect_address)
+        self._thread = threading.Thread(target=zmq.proxy, args=(pull, pub),
+                                        name='fstpy-events-forwarder')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def sender(self):
+        """Return a send(messages) callable for EventPublisher."""
+        address = self.collect_address
+        local = threading.local()
+
+        def send(messages):
+            sock = getattr(local, 'sock', None)
+            if sock is None:
+                sock = zmq.Context().socket(zmq.PUSH)
+                sock.connect(address)
+                local.sock = sock
+            for message in messages:
+                sock.send_string(message)
+        return send
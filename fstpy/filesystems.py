@@ -1,9 +1,14 @@
 import os
 import fs 
+import fs.errors
+import fs.path
 import time
-import datetime
-import stat
-import tempfile
+import queue
+import uuid
+import errno
+import functools
+import itertools
+import threading
 from types import MethodType
 
 try:
@@ -17,8 +22,159 @@ try:
 except ImportError:
     from tarfile import filemode as _filemode
 
-import pyftpdlib
-from pyftpdlib._compat import u, unicode, PY3
+import pyftpdlib.filesystems
+from pyftpdlib._compat import u, unicode
+from pyftpdlib.log import logger
+
+from .cache import MetadataCache, shared_cache
+from .checksums import HashingFile, etag_md5, hash_file, validator
+from .metrics import InstrumentedFile, InstrumentedFS
+from .pool import default_pool, INFO_NAMESPACES
+from .delete import DeleteEngine
+from .rename import RenameEngine
+from .streams import (ByteBudget, MultipartWriter, RangedReader,
+                      default_read_budget, multipart_upload, range_fetcher,
+                      syspath)
+from .treeindex import SubtreeView
+from .walk import TreeWalker
+from .workers import BackendExecutor
+from . import vpath
+
+
+class _Listing(list):
+    """The list of names returned by AbstractedFS.listdir().
+    pyftpdlib sorts it in place and hands it back to format_list() and
+    format_mlsx(), which look up the Info objects collected by the
+    same scandir() call in the "infos" dict instead of issuing a new
+    stat() per entry.
+    """
+
+    def __init__(self, *args):
+        list.__init__(self, *args)
+        self.infos = {}
+
+
+class _StreamedListing(object):
+    """The listing of a large directory returned by
+    AbstractedFS.listdir(), yielding names while the backend is still
+    being listed.
+    Not being a list it is not sorted by pyftpdlib: entries come in
+    backend order. The first page, listed by the caller, is passed
+    to the constructor; a background thread iterates scandir() for
+    the entries following it, keeping up to prefetch pages of
+    page_size entries ready, and "infos" only holds the Info objects
+    of the page being iterated, so that memory stays bounded whatever
+    the size of the directory.
+    """
+
+    def __init__(self, first_page, scandir, page_size, prefetch):
+        self.infos = {}
+        self.first_page = first_page
+        self._pages = queue.Queue(max(prefetch, 1))
+        self._stop = threading.Event()
+        # the backend iterator is only ever used by this thread (some
+        # hold a lock while iterating)
+        thread = threading.Thread(target=self._list,
+                                  args=(scandir, page_size),
+                                  name='fstpy-listing')
+        thread.daemon = True
+        thread.start()
+
+    def _next_page(self):
+        page = self._pages.get()
+        if isinstance(page, Exception):
+            self.close()
+            raise page
+        return page
+
+    def close(self):
+        """Stop listing the backend."""
+        self._stop.set()
+
+    def __iter__(self):
+        try:
+            page = self.first_page
+            while page:
+                # format_list() and format_mlsx() hold a reference to
+                # this very dict
+                self.infos.clear()
+                self.infos.update((info.name, info) for info in page)
+                for info in page:
+                    yield info.name
+                page = self._next_page()
+        finally:
+            # the client may go away before the end of the listing
+            self.close()
+
+    def _list(self, scandir, page_size):
+        def put(item):
+            while not self._stop.is_set():
+                try:
+                    self._pages.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    pass
+
+        try:
+            infos = iter(scandir())
+            while not self._stop.is_set():
+                page = list(itertools.islice(infos, page_size))
+                put(page)
+                if not page:
+                    return
+        except Exception as err:
+            put(err)
+
+
+class _WriteFile(object):
+    """Proxy for files opened for writing, calling on_close() once
+    the file is closed (e.g. to invalidate cached metadata).
+    """
+
+    def __init__(self, file, on_close):
+        self._file = file
+        self._on_close = on_close
+
+    def close(self):
+        try:
+            self._file.close()
+        finally:
+            self._on_close()
+
+    def __getattr__(self, attr):
+        return getattr(self._file, attr)
+
+
+class _NamedFile(object):
+    """Proxy naming a file after the path of the file it stands for,
+    the name on_file_sent() and on_file_received() are called with.
+    """
+
+    def __init__(self, file, name):
+        self._file = file
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(self._file, attr)
+
+
+def _precomputable(method):
+    """Let method return (or raise) the outcome stored by
+    AbstractedFS.precompute() for the same arguments, if any.
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        if self._precomputed:
+            outcome = self._precomputed.pop((name,) + args, None)
+            if outcome is not None:
+                result, exc = outcome
+                if exc is not None:
+                    raise exc
+                return result
+        return method(self, *args)
+    return wrapper
 
 
 class AbstractedFS(pyftpdlib.filesystems.AbstractedFS):
@@ -35,8 +191,90 @@ class AbstractedFS(pyftpdlib.filesystems.AbstractedFS):
     FilesystemError exception can be raised from within any of
     the methods below in order to send a customized error string
     to the client.
+    Backend filesystems are leased from the process-wide pool
+    referenced by the "pool" class attribute.
+    Resource info is kept in a MetadataCache for metadata_ttl seconds
+    so that commands hitting the same path (e.g. CWD, SIZE, MDTM,
+    RETR) do not query the backend again; local writes invalidate it.
+    When the "metrics" class attribute is set, backend calls are
+    timed through an InstrumentedFS proxy.
     """
 
+    # the FSPool backend filesystems are leased from
+    pool = default_pool
+    # the fstpy.metrics.Metrics backend calls are recorded in, None
+    # disables instrumentation
+    metrics = None
+    # the fstpy.contentcache.ContentCache files are read through, None
+    # reads them from the backend every time
+    content_cache = None
+    # seconds resource info is cached for, 0 disables the cache
+    metadata_ttl = 5.0
+    # max number of resource info entries cached per session
+    metadata_cache_size = 10000
+    # share the cache between the sessions of the same user
+    share_metadata_cache = False
+    # stream RETR through ranged requests on backends supporting them
+    ranged_reads = True
+    # bytes fetched by every ranged request
+    read_chunk_size = 8 * 1024 * 1024
+    # max chunks fetched concurrently ahead of the one being sent, the
+    # reader starts with one and adds more while the client outpaces
+    # the backend
+    read_ahead = 4
+    # max bytes prefetched by the downloads of a session
+    read_session_bytes = 64 * 1024 * 1024
+    # max bytes prefetched by the downloads of all the sessions of the
+    # process (a ByteBudget shared by the sessions)
+    read_budget = default_read_budget
+    # stream STOR/APPE as multipart uploads on backends supporting them
+    multipart_uploads = True
+    # bytes sent by every uploaded part
+    upload_part_size = 8 * 1024 * 1024
+    # parts uploaded concurrently before writes start waiting
+    upload_max_in_flight = 4
+    # how open() for writing deals with missing parent directories:
+    # "create" makes them, once per session, "flat" never does (object
+    # stores where directories are just key prefixes)
+    parent_dirs = 'create'
+    # directories having at least this many entries are sent while
+    # being listed, a page of entries at a time, in backend order;
+    # 0 always lists them whole, sorted
+    listing_page_size = 1000
+    # pages listed in background ahead of the one being sent
+    listing_prefetch = 2
+    # listing lines encoded and handed to the data channel together
+    listing_batch_size = 100
+    # directories listed concurrently by recursive listings (see
+    # listtree()), and listed in background ahead of the one being sent
+    tree_listing_workers = 8
+    tree_listing_prefetch = 32
+    # threads moving the files of a directory renamed on an object store
+    rename_workers = 8
+    # directory where directory renames are journaled while in progress
+    # (see fstpy.rename.recover_renames()), None disables the journal
+    rename_journal_dir = None
+    # threads deleting the batches of a directory tree removed at once
+    # (see removetree())
+    delete_workers = 8
+    # an fstpy.treeindex.TreeIndex: sessions of read-only users on its
+    # url, or on a directory of it, answer listings and stats from it,
+    # without backend calls, and the other sessions there record their
+    # changes in it
+    tree_index = None
+    # max number of normalized paths memoized per session
+    path_memo_size = 1000
+    # an fstpy.staging.UploadStager: STOR is written to local disk and
+    # committed to the backend in background; None writes to the
+    # backend directly
+    stager = None
+    # an fstpy.checksums.ChecksumIndex: uploads are hashed while they
+    # stream through and their checksums, like those computed by
+    # checksum(), are remembered there; None computes them every time
+    checksum_index = None
+    # max chunks of a remote file fetched concurrently while hashing it
+    hash_read_ahead = 8
+
     def __init__(self, root_fs, cmd_channel):
         """
          - (str) root: the user "real" home directory (e.g. '/home/user')
@@ -48,12 +286,20 @@ class AbstractedFS(pyftpdlib.filesystems.AbstractedFS):
         # to reflect the real filesystem) users overriding this class
         # are responsible to set _cwd attribute as necessary.
         self._cwd = u('/')
-        self._fs = fs.open_fs(root_fs)
-        i = self._fs.getinfo('/', namespaces=['stat', 'lstat', 'details', 'access', 'link'])
-        self._has_access_info = i.has_namespace('access')
-        self._has_link_info = i.has_namespace('access')
-        self._has_stat_info = i.has_namespace('stat')
-        self._has_lstat_info = i.has_namespace('lstat')
+        self._root_fs = root_fs
+        # paths of the session normalized relative to the cwd
+        self._path_memo = vpath.PathMemo(self.path_memo_size)
+        self._leased_fs = self.pool.acquire(root_fs)
+        self._read_budget = ByteBudget(self.read_session_bytes)
+        self._fs = self._leased_fs
+        if self.metrics is not None:
+            self._fs = InstrumentedFS(self._fs, self.metrics,
+                                      getattr(cmd_channel, 'username', None))
+        caps = self.pool.capabilities(root_fs, self._leased_fs)
+        self._has_access_info = caps.access
+        self._has_link_info = caps.link
+        self._has_stat_info = caps.stat
+        self._has_lstat_info = caps.lstat
 
         if self._has_link_info:
             def readlink(self, path):
@@ -65,8 +311,208 @@ class AbstractedFS(pyftpdlib.filesystems.AbstractedFS):
             self.readlink = None
 
         self._root = u('/')#self._fs.root_path 
+        self._index = None
+        # the path of the session root on the indexed filesystem, the
+        # one its changes are recorded under
+        self._index_root = None
+        if self.tree_index is not None:
+            self._index_root = self.tree_index.locate(root_fs)
+        self._index_view = None
+        if self._index_root is not None:
+            username = getattr(cmd_channel, 'username', None)
+            is_read_only = getattr(
+                getattr(cmd_channel, 'authorizer', None), 'is_read_only',
+                None)
+            if username and is_read_only is not None and \
+                    is_read_only(username):
+                self._index = self.tree_index
+                # the index only knows the details namespace
+                self._has_access_info = self._has_link_info = False
+                self._has_stat_info = self._has_lstat_info = False
+                self.readlink = None
+        self._cache = self._make_metadata_cache(
+            root_fs, getattr(cmd_channel, 'username', None))
+        # directories known to exist, parents are not created twice
+        self._known_dirs = set([self._root])
+        # outcomes of calls made in advance, see precompute()
+        self._precomputed = {}
+        self._cmd_channel = None
         self.cmd_channel = cmd_channel
 
+    @property
+    def cmd_channel(self):
+        return self._cmd_channel
+
+    @cmd_channel.setter
+    def cmd_channel(self, channel):
+        # pyftpdlib detaches the command channel when the session is
+        # closed: that is the moment to give the backend to the pool.
+        detached = channel is None and self._cmd_channel is not None
+        self._cmd_channel = channel
+        if detached:
+            self.close()
+
+    @classmethod
+    def warm_up(cls, url, instances=1):
+        """Open instances filesystems for url in the pool in advance
+        (e.g. in a worker process right after fork()), probing their
+        capabilities, and map the tree index, so that the first
+        sessions find them ready.
+        """
+        leased = []
+        try:
+            for _ in range(instances):
+                fs_obj = cls.pool.acquire(url)
+                leased.append(fs_obj)
+                cls.pool.capabilities(url, fs_obj)
+                fs_obj.getinfo('/')
+        finally:
+            for fs_obj in leased:
+                cls.pool.release(url, fs_obj)
+        if cls.tree_index is not None:
+            cls.tree_index.snapshot()
+
+    def close(self):
+        """Release the backend filesystem to the pool."""
+        if self._fs is not None:
+            self.pool.release(self._root_fs, self._leased_fs)
+            self._fs = self._leased_fs = None
+            if self.metrics is not None:
+                self.metrics.flush()
+
+    def _make_metadata_cache(self, root_fs, username):
+        if not self.metadata_ttl:
+            return None
+        if self.share_metadata_cache and username:
+            return shared_cache((root_fs, username),
+                                self.metadata_cache_size, self.metadata_ttl)
+        return MetadataCache(self.metadata_cache_size, self.metadata_ttl)
+
+    def _getinfo(self, path):
+        """Return the resource info of path, serving it from the
+        metadata cache if possible.
+        """
+        snapshot = self._index_snapshot()
+        if snapshot is not None:
+            return snapshot.getinfo(path)
+        if self._cache is not None:
+            info = self._cache.get(path)
+            if info is not None:
+                return info
+        info = self._fs.getinfo(path, namespaces=INFO_NAMESPACES)
+        if self._cache is not None:
+            self._cache.put(path, info)
+        return info
+
+    def _getinfo_or_none(self, path):
+        try:
+            return self._getinfo(path)
+        except fs.errors.ResourceNotFound:
+            return None
+
+    def _forget_checksums(self, path, tree):
+        """Forget the checksums of path; in a worker thread when the
+        session has backend workers, the SQLite write does not block
+        the IOLoop.
+        """
+        channel = self.cmd_channel
+        workers = getattr(channel, 'backend_workers', 0)
+        if not workers:
+            self.checksum_index.forget(self._root_fs, path, tree)
+            return
+        executor = BackendExecutor.get(channel.ioloop, workers)
+        future = executor.submit(self.checksum_index.forget,
+                                 self._on_checksums_forgotten,
+                                 self._root_fs, path, tree)
+        # the checksums of an upload are recorded after
+        self.checksum_index.wait_for(self._root_fs, path, future)
+
+    def _on_checksums_forgotten(self, exc, url, path, tree):
+        if exc is not None:
+            logger.error('could not forget the checksums of %r: %r',
+                         path, exc)
+
+    def _index_snapshot(self):
+        """Return the TreeSnapshot the session reads from, if any."""
+        if self._index is None:
+            return None
+        snapshot = self._index.snapshot()
+        if snapshot is None or self._index_root == '/':
+            return snapshot
+        if self._index_view is None or \
+                self._index_view.snapshot is not snapshot:
+            self._index_view = SubtreeView(snapshot, self._index_root)
+        return self._index_view
+
+    def _invalidate(self, path, tree=False):
+        if self.checksum_index is not None:
+            self._forget_checksums(path, tree)
+        username = getattr(self.cmd_channel, 'username', None)
+        invalidate_path = getattr(
+            getattr(self.cmd_channel, 'authorizer', None),
+            'invalidate_path', None)
+        if username and invalidate_path is not None:
+            # the path may have changed type
+            invalidate_path(username, path, tree)
+        if self._index_root is not None:
+            # keyed on the path on the indexed filesystem, sessions
+            # whose home is below it change the same tree
+            index_path = vpath.join(self._index_root, path.lstrip('/'))
+            self.tree_index.mark_dirty(fs.path.dirname(index_path))
+            if tree:
+                self.tree_index.mark_dirty(index_path, recursive=True)
+        if tree:
+            prefix = path.rstrip('/') + '/'
+            self._known_dirs = set(
+                d for d in self._known_dirs
+                if d != path and not d.startswith(prefix))
+        if self._cache is not None:
+            if tree:
+                self._cache.invalidate_tree(path)
+            else:
+                self._cache.invalidate(path)
+
+    def _make_parent_dirs(self, filename):
+        """Make sure the parent directory of a file about to be
+        written exists, according to the parent_dirs strategy.
+        """
+        if self.parent_dirs == 'flat':
+            return
+        dirname = fs.path.dirname(filename)
+        if dirname in self._known_dirs:
+            return
+        self._fs.makedirs(dirname, recreate=True)
+        while dirname not in self._known_dirs:
+            self._known_dirs.add(dirname)
+            dirname = fs.path.dirname(dirname)
+
+    def precompute(self, name, *args):
+        """Call method name(*args) now, typically from a worker thread,
+        and keep its outcome: the next call to the same method with the
+        same arguments returns (or raises) it without hitting the
+        backend again.
+        Only methods wrapped by _precomputable support this.
+        """
+        try:
+            outcome = (getattr(self, name)(*args), None)
+        except Exception as err:
+            outcome = (None, err)
+        self._precomputed[(name,) + args] = outcome
+
+    def discard_precomputed(self):
+        """Forget precomputed outcomes nobody asked for, closing (or
+        aborting, for uploads) the files opened in advance.
+        """
+        precomputed, self._precomputed = self._precomputed, {}
+        for key, (result, exc) in precomputed.items():
+            if key[0] == 'open' and result is not None:
+                abort = getattr(result, 'abort', None)
+                if abort is not None:
+                    abort()
+                result.close()
+            elif key[0] == 'listtree' and result is not None:
+                result.close()
+
     # --- Pathname / conversion utilities
 
     def ftpnorm(self, ftppath):
@@ -79,99 +525,216 @@ class AbstractedFS(pyftpdlib.filesystems.AbstractedFS):
         Pathname returned is always absolutized.
         """
         assert isinstance(ftppath, unicode), ftppath
-        if os.path.isabs(ftppath):
-            p = os.path.normpath(ftppath)
-        else:
-            p = os.path.normpath(os.path.join(self.cwd, ftppath))
-        # normalize string in a standard web-path notation having '/'
-        # as separator.
-        if os.sep == "\\":
-            p = p.replace("\\", "/")
-        # os.path.normpath supports UNC paths (e.g. "//a/b/c") but we
-        # don't need them.  In case we get an UNC path we collapse
-        # redundant separators appearing at the beginning of the string
-        while p[:2] == '//':
-            p = p[1:]
+        p = self._path_memo.join(self.cwd, ftppath)
         # Anti path traversal: don't trust user input, in the event
         # that self.cwd is not absolute, return "/" as a safety measure.
-        # This is for extra protection, maybe not really necessary.
-        if not os.path.isabs(p):
+        if p[:1] != '/':
             p = u("/")
         return p
 
     def ftp2fs(self, ftppath):
         """Translate a "virtual" ftp pathname (typically the raw string
-        coming from client) into equivalent absolute "real" filesystem
-        pathname.
+        coming from client) into equivalent absolute backend pathname.
         Example (having "/home/user" as root directory):
         >>> ftp2fs("foo")
         '/home/user/foo'
-        Note: directory separators are system dependent.
         """
         assert isinstance(ftppath, unicode), ftppath
-        # as far as I know, it should always be path traversal safe...
-        if os.path.normpath(self.root) == os.sep:
-            return os.path.normpath(self.ftpnorm(ftppath))
-        else:
-            p = self.ftpnorm(ftppath)[1:]
-            return os.path.normpath(os.path.join(self.root, p))
+        p = self.ftpnorm(ftppath)
+        root = vpath.normpath(self.root)
+        if root == '/':
+            return p
+        if p == '/':
+            return root
+        return root + p
 
     def fs2ftp(self, fspath):
-        """Translate a "real" filesystem pathname into equivalent
-        absolute "virtual" ftp pathname depending on the user's
-        root directory.
+        """Translate a backend pathname into equivalent absolute
+        "virtual" ftp pathname depending on the user's root directory.
         Example (having "/home/user" as root directory):
         >>> fs2ftp("/home/user/foo")
         '/foo'
-        As for ftpnorm, directory separators are system independent
-        ("/") and pathname returned is always absolutized.
         On invalid pathnames escaping from user's root directory
         (e.g. "/home" when root is "/home/user") always return "/".
         """
         assert isinstance(fspath, unicode), fspath
-        if os.path.isabs(fspath):
-            p = os.path.normpath(fspath)
-        else:
-            p = os.path.normpath(os.path.join(self.root, fspath))
-        if not self.validpath(p):
+        root = vpath.normpath(self.root)
+        p = vpath.join(root, fspath)
+        if not vpath.is_within(root, p):
             return u('/')
-        p = p.replace(os.sep, "/")
-        p = p[len(self.root):]
-        if not p.startswith('/'):
-            p = '/' + p
-        return p
+        if root == '/':
+            return p
+        return p[len(root):] or u('/')
 
     def validpath(self, path):
         """Check whether the path belongs to user's home directory.
-        Expected argument is a "real" filesystem pathname.
-        If path is a symbolic link it is resolved to check its real
-        destination.
+        Expected argument is a backend pathname; paths are virtual,
+        hence checked as strings, backend symlinks being resolved by
+        the backend itself.
         Pathnames escaping from user's root directory are considered
         not valid.
         """
         assert isinstance(path, unicode), path
-        root = self.realpath(self.root)
-        path = self.realpath(path)
-        if not root.endswith(os.sep):
-            root = root + os.sep
-        if not path.endswith(os.sep):
-            path = path + os.sep
-        if path[0:len(root)] == root:
-            return True
-        return False
+        return vpath.is_within(vpath.normpath(self.root),
+                               vpath.join(u('/'), path))
 
     # --- Wrapper methods around open() and tempfile.mkstemp
 
+    @_precomputable
     def open(self, filename, mode):
         """Open a file returning its handler."""
         assert isinstance(filename, unicode), filename
-        self._fs.makedirs(os.path.dirname(filename), recreate=True)
-        return self._fs.open(filename, mode)
+        if mode.startswith('r') and '+' not in mode:
+            if self.stager is not None:
+                # read back what was uploaded, even if not committed yet
+                staged = self.stager.pending(self._root_fs, filename)
+                if staged is not None:
+                    try:
+                        return _NamedFile(open(staged, mode), filename)
+                    except (IOError, OSError):
+                        # committed in the meantime
+                        pass
+            if self.content_cache is not None and 'b' in mode:
+                info = self._getinfo(filename)
+                if self.content_cache.cacheable(info):
+                    file = self.content_cache.open(
+                        self._root_fs, filename, info,
+                        lambda: self._open_for_reading(filename, mode))
+                    if file is not None:
+                        return file
+            return self._open_for_reading(filename, mode)
+        self._make_parent_dirs(filename)
+        self._invalidate(filename)
+        file = None
+        if self.stager is not None and mode == 'wb':
+            file = self.stager.stage(
+                self._root_fs, filename,
+                getattr(self.cmd_channel, 'username', None))
+            file.committed.add_done_callback(
+                lambda future: self._invalidate(filename))
+        elif self.multipart_uploads and mode in ('wb', 'ab'):
+            upload = multipart_upload(self._fs, filename)
+            if upload is not None:
+                append_size = 0
+                if mode == 'ab':
+                    info = self._getinfo_or_none(filename)
+                    append_size = info.size if info is not None else 0
+                file = MultipartWriter(upload, filename,
+                                       self.upload_part_size,
+                                       self.upload_max_in_flight,
+                                       append_size)
+        if file is None:
+            file = _NamedFile(self._fs.open(filename, mode), filename)
+        if self.checksum_index is None or mode != 'wb':
+            return _WriteFile(self._instrument(file),
+                              lambda: self._invalidate(filename))
+        # whole uploads: their checksums are known once stored
+        hashing = HashingFile(file, self.checksum_index.algorithms)
+        committed = getattr(file, 'committed', None)
+        if committed is not None:
+            def on_committed(future):
+                if not future.cancelled() and future.exception() is None:
+                    self._record_checksums(filename, hashing)
+            committed.add_done_callback(on_committed)
+
+        def on_close():
+            self._invalidate(filename)
+            if committed is None:
+                self._record_checksums(filename, hashing)
+        return _WriteFile(self._instrument(hashing), on_close)
+
+    def _record_checksums(self, filename, hashing):
+        if hashing.complete:
+            self.checksum_index.record(self._root_fs, filename, self._fs,
+                                       hashing.hexdigests())
+
+    def _open_for_reading(self, filename, mode):
+        if 'b' in mode:
+            # a real file, sent with sendfile() on plain data channels
+            local = syspath(self._fs, filename)
+            if local is not None:
+                return self._instrument(_NamedFile(open(local, mode),
+                                                   filename))
+        if self.ranged_reads and 'b' in mode:
+            fetch = range_fetcher(self._fs, filename)
+            if fetch is not None:
+                return self._instrument(RangedReader(
+                    fetch, self.getsize(filename), filename,
+                    self.read_chunk_size, self.read_ahead,
+                    (self._read_budget, self.read_budget)))
+        return self._instrument(_NamedFile(self._fs.open(filename, mode),
+                                           filename))
+
+    def _instrument(self, file):
+        if self.metrics is None:
+            return file
+        return InstrumentedFile(file, self.metrics,
+                                getattr(self.cmd_channel, 'username', None))
+
+    @_precomputable
+    def checksum(self, path, algorithm, start=0, end=None):
+        """Return the hex digest of the content of file path computed
+        with algorithm (see fstpy.checksums.ALGORITHMS) from start to
+        end (excluded, the end of the file if None), and the offset
+        the range actually ended at.
+        Checksums of whole files are taken from the checksum index or,
+        for MD5, the ETag of the file when valid, without reading it;
+        the others are computed reading the file in parallel chunks.
+        """
+        assert isinstance(path, unicode), path
+        staged = None
+        if self.stager is not None:
+            staged = self.stager.pending(self._root_fs, path)
+        if staged is not None:
+            # not on the backend yet
+            try:
+                with open(staged, 'rb') as f:
+                    size = os.fstat(f.fileno()).st_size
+                    end = size if end is None else min(end, size)
+                    return hash_file(f, algorithm, start, end), end
+            except (IOError, OSError):
+                # committed in the meantime
+                pass
+        info = self._fs.getinfo(path, namespaces=['details', 's3'])
+        if info.is_dir:
+            raise fs.errors.FileExpected(path)
+        size = info.size
+        end = size if end is None else min(end, size)
+        whole = start == 0 and end == size
+        if whole and self.checksum_index is not None:
+            digest = self.checksum_index.get(self._root_fs, path, algorithm,
+                                             validator(info))
+            if digest is not None:
+                return digest, end
+        if whole and algorithm == 'MD5':
+            digest = etag_md5(info)
+            if digest is not None:
+                return digest, end
+        file = self._open_for_hashing(path, size)
+        try:
+            digest = hash_file(file, algorithm, start, end)
+        finally:
+            file.close()
+        if whole and self.checksum_index is not None:
+            self.checksum_index.put(self._root_fs, path, validator(info),
+                                    {algorithm: digest})
+        return digest, end
+
+    def _open_for_hashing(self, path, size):
+        local = syspath(self._fs, path)
+        if local is not None:
+            return open(local, 'rb')
+        fetch = range_fetcher(self._fs, path)
+        if fetch is not None:
+            return RangedReader(fetch, size, path, self.read_chunk_size,
+                                self.hash_read_ahead,
+                                (self._read_budget, self.read_budget))
+        return self._fs.openbin(path)
 
     def mkstemp(self, suffix='', prefix='', dir=None, mode='wb'):
-        """A wrap around tempfile.mkstemp creating a file with a unique
-        name.  Unlike mkstemp it returns an object with a file-like
-        interface.
+        """Create a file with a unique name in directory dir of the
+        backend (used by STOU), returning it opened for writing as
+        open() does.
         """
         class FileWrapper:
 
@@ -182,12 +745,15 @@ class AbstractedFS(pyftpdlib.filesystems.AbstractedFS):
             def __getattr__(self, attr):
                 return getattr(self.file, attr)
 
-        text = 'b' not in mode
+        if dir is None:
+            dir = self.ftp2fs(self.cwd)
         # max number of tries to find out a unique file name
-        tempfile.TMP_MAX = 50
-        fd, name = tempfile.mkstemp(suffix, prefix, dir, text=text)
-        file = os.fdopen(fd, mode)
-        return FileWrapper(file, name)
+        for _ in range(50):
+            name = fs.path.join(dir, u('%s%s%s') % (
+                prefix, uuid.uuid4().hex[:8], suffix))
+            if not self.lexists(name):
+                return FileWrapper(self.open(name, mode), name)
+        raise OSError(errno.EEXIST, 'No usable temporary file name found')
 
     # --- Wrapper methods around os.* calls
 
@@ -200,36 +766,132 @@ class AbstractedFS(pyftpdlib.filesystems.AbstractedFS):
         #self._fs = self._fs.mkdir(path)
         self.cwd = self.fs2ftp(path)
 
+    @_precomputable
     def mkdir(self, path):
         """Create the specified directory."""
         assert isinstance(path, unicode), path
         self._fs.makedir(path)
+        self._invalidate(path)
+        self._known_dirs.add(path)
 
+    @_precomputable
     def listdir(self, path):
-        """List the content of a directory."""
+        """List the content of a directory.
+        The returned list also carries the info of every entry (see
+        _Listing) so that formatting it does not cost one stat() per
+        entry.
+        Large directories (see listing_page_size) are not listed
+        whole: an iterable streaming their content is returned instead
+        (see _StreamedListing).  The others are listed inline, without
+        a background thread.
+        """
+        assert isinstance(path, unicode), path
+        snapshot = self._index_snapshot()
+        if snapshot is not None:
+            infos = snapshot.scandir(path)
+        elif self.listing_page_size:
+            size = self.listing_page_size
+            infos = list(self.listdirinfo(path, page=(0, size)))
+            if len(infos) == size:
+                # the first page is full: list the others in background
+                return _StreamedListing(
+                    infos,
+                    functools.partial(self.listdirinfo, path,
+                                      page=(size, None)),
+                    size, self.listing_prefetch)
+        else:
+            infos = self.listdirinfo(path)
+        listing = _Listing()
+        for info in infos:
+            listing.append(info.name)
+            listing.infos[info.name] = info
+            if self._cache is not None and snapshot is None:
+                self._cache.put(fs.path.join(path, info.name), info)
+        return listing
+
+    def listdirinfo(self, path, page=None):
+        """Return an iterator of fs.info.Info objects for the content
+        of a directory, fetched with a single scandir() call to the
+        backend.
+        The optional page argument is a (start, end) tuple passed to
+        scandir() in order to list very large directories a slice at a
+        time.
+        """
         assert isinstance(path, unicode), path
-        return self._fs.listdir(path)
+        snapshot = self._index_snapshot()
+        if snapshot is not None:
+            infos = snapshot.scandir(path)
+            return iter(infos if page is None else infos[page[0]:page[1]])
+        return self._fs.scandir(path, namespaces=INFO_NAMESPACES, page=page)
 
-    def listdirinfo(self, path):
-        """List the content of a directory."""
+    @_precomputable
+    def listtree(self, path):
+        """List a directory and everything below it, see
+        fstpy.walk.TreeWalker: return an iterator of (dirpath, infos)
+        tuples, dirpath relative to path, yielding the directories in
+        no particular order while the tree is still being listed.
+        """
         assert isinstance(path, unicode), path
-        return self._fs.listdir(path)
+        walker = TreeWalker(self.tree_listing_workers,
+                            self.tree_listing_prefetch)
+        snapshot = self._index_snapshot()
+        if snapshot is not None:
+            return walker.walk(self._fs, path, scandir=snapshot.scandir)
+        return walker.walk(self._fs, path, namespaces=INFO_NAMESPACES)
 
+    @_precomputable
     def rmdir(self, path):
         """Remove the specified directory."""
         assert isinstance(path, unicode), path
-        self._fs.rmdir(path)
+        self._fs.removedir(path)
+        self._invalidate(path, tree=True)
+
+    @_precomputable
+    def removetree(self, path):
+        """Remove the specified directory and everything below it, see
+        fstpy.delete.DeleteEngine; return the number of objects
+        deleted (None on local filesystems).
+        """
+        assert isinstance(path, unicode), path
+        engine = DeleteEngine(self.delete_workers,
+                              progress=self._on_delete_progress)
+        try:
+            return engine.removetree(self._fs, path)
+        finally:
+            self._invalidate(path, tree=True)
 
+    def _on_delete_progress(self, path, done):
+        logger.info('removing %r: %d objects deleted', path, done)
+        notify = getattr(self.cmd_channel, 'on_delete_progress', None)
+        if notify is not None:
+            notify(path, done)
+
+    @_precomputable
     def remove(self, path):
         """Remove the specified file."""
         assert isinstance(path, unicode), path
         self._fs.remove(path)
+        self._invalidate(path)
 
+    @_precomputable
     def rename(self, src, dst):
-        """Rename the specified src file to the dst filename."""
+        """Rename the specified src file or directory to the dst
+        filename, see fstpy.rename.RenameEngine.
+        """
         assert isinstance(src, unicode), src
         assert isinstance(dst, unicode), dst
-        self._fs.move(src, dst)
+        engine = RenameEngine(self.rename_workers, self.rename_journal_dir,
+                              self._log_rename_progress)
+        try:
+            engine.rename(self._fs, src, dst, url=self._root_fs)
+        finally:
+            self._invalidate(src, tree=True)
+            self._invalidate(dst, tree=True)
+
+    def _log_rename_progress(self, src, dst, done, total):
+        logger.info('renaming %r to %r: %d/%d files moved', src, dst, done,
+                    total)
+        self._invalidate(dst, tree=True)
 
     def chmod(self, path, mode):
         """Change file/directory mode."""
@@ -242,13 +904,13 @@ class AbstractedFS(pyftpdlib.filesystems.AbstractedFS):
         """Perform a stat() system call on the given path."""
         # on python 2 we might also get bytes from os.lisdir()
         # assert isinstance(path, unicode), path
-        return self._fs.getinfo(path, namespaces=['stat', 'lstat', 'details', 'access', 'link'])        
+        return self._getinfo(path)
 
     def stat(self, path):
         """Perform a stat() system call on the given path."""
         # on python 2 we might also get bytes from os.lisdir()
         # assert isinstance(path, unicode), path
-        return self._fs.getinfo(path, namespaces=['stat', 'lstat', 'details', 'access', 'link'])
+        return self._getinfo(path)
 
     def utime(self, path, timeval):
         """Perform a utime() call on the given path"""
@@ -260,19 +922,20 @@ class AbstractedFS(pyftpdlib.filesystems.AbstractedFS):
         """Like stat but does not follow symbolic links."""
         # on python 2 we might also get bytes from os.lisdir()
         # assert isinstance(path, unicode), path
-        return self._fs.getinfo(path, namespaces=['stat', 'lstat', 'details', 'access', 'link'])
+        return self._getinfo(path)
 
     # --- Wrapper methods around os.path.* calls
 
     def isfile(self, path):
         """Return True if path is a file."""
         assert isinstance(path, unicode), path
-        return self._fs.isfile(path)
+        info = self._getinfo_or_none(path)
+        return info is not None and info.is_file
 
     def islink(self, path):
         """Return True if path is a symbolic link."""
         assert isinstance(path, unicode), path
-        return self._fs.islink(path)
+        return self.getlinkinfo(self._getinfo(path))
 
     def getlinkinfo(self, info):
         if self._has_link_info:
@@ -283,12 +946,13 @@ class AbstractedFS(pyftpdlib.filesystems.AbstractedFS):
     def isdir(self, path):
         """Return True if path is a directory."""
         assert isinstance(path, unicode), path
-        return self._fs.isdir(path)
+        info = self._getinfo_or_none(path)
+        return info is not None and info.is_dir
 
     def getsize(self, path):
         """Return the size of the specified file in bytes."""
         assert isinstance(path, unicode), path
-        return self._fs.getsize(path)
+        return self._getinfo(path).size
 
     def getmtime(self, path):
         """Return the last modified time as a number of seconds since
@@ -297,19 +961,19 @@ class AbstractedFS(pyftpdlib.filesystems.AbstractedFS):
         return 0#self._fs.getmtime(path)
 
     def realpath(self, path):
-        """Return the canonical version of path eliminating any
-        symbolic links encountered in the path (if they are
-        supported by the operating system).
+        """Return the canonical version of path.  Paths are virtual:
+        they are only normalized, never resolved against the local
+        filesystem.
         """
         assert isinstance(path, unicode), path
-        return os.path.realpath(path)
+        return vpath.join(u('/'), path)
 
     def lexists(self, path):
         """Return True if path refers to an existing path, including
         a broken or circular symbolic link.
         """
         assert isinstance(path, unicode), path
-        return self._fs.exists(path)
+        return self._getinfo_or_none(path) is not None
 
     # --- Listing utilities
 
@@ -329,87 +993,74 @@ class AbstractedFS(pyftpdlib.filesystems.AbstractedFS):
         -rw-rw-rw-   1 owner   group    7045120 Sep 02  3:47 music.mp3
         drwxrwxrwx   1 owner   group          0 Aug 31 18:50 e-books
         -rw-rw-rw-   1 owner   group        380 Sep 02  3:40 module.py
+        Entries are yielded listing_batch_size lines at a time.
         """
-        @pyftpdlib.filesystems._memoize
-        def get_user_by_uid(uid):
-            return self.get_user_by_uid(uid)
-
-        @pyftpdlib.filesystems._memoize
-        def get_group_by_gid(gid):
-            return self.get_group_by_gid(gid)
-
         assert isinstance(basedir, unicode), basedir
         if self.cmd_channel.use_gmt_times:
             timefunc = time.gmtime
         else:
             timefunc = time.localtime
-        SIX_MONTHS = 180 * 24 * 60 * 60
-       
+        unicode_errors = self.cmd_channel.unicode_errors
+        batch_size = self.listing_batch_size
+        has_lstat_info = self._has_lstat_info
+        has_link_info = self._has_link_info
+        # owner and group are those of the server process for all the
+        # entries
+        owner = "%-8s %-8s" % (self.get_user_by_uid(os.getuid()),
+                               self.get_group_by_gid(os.getgid()))
         now = time.time()
+        # if modification time > 6 months shows "month year"
+        # else "month hh:mm";  this matches proftpd format, see:
+        # https://github.com/giampaolo/pyftpdlib/issues/187
+        six_months_ago = now - 180 * 24 * 60 * 60
+        modes = {}
+        mtimes = {}
+        infos = getattr(listing, 'infos', {})
+        lines = []
         for basename in listing:
-            if not PY3:
+            st = infos.get(basename)
+            if st is None:
                 try:
-                    file = os.path.join(basedir, basename)
-                except UnicodeDecodeError:
-                    # (Python 2 only) might happen on filesystem not
-                    # supporting UTF8 meaning os.listdir() returned a list
-                    # of mixed bytes and unicode strings:
-                    # http://goo.gl/6DLHD
-                    # http://bugs.python.org/issue683592
-                    file = os.path.join(bytes(basedir), bytes(basename))
-                    if not isinstance(basename, unicode):
-                        basename = unicode(basename, 'utf8', 'ignore')
-            else:
-                file = os.path.join(basedir, basename)
-            try:
-                st = self.lstat(file)
-            except (OSError, pyftpdlib.filesystems.FilesystemError):
-                if ignore_err:
-                    continue
-                raise
-
-            perms = _filemode(st.get('lstat', 'st_mode')  if self._has_lstat_info else 664)  # permissions
-            nlinks = st.get('lstat', 'st_nlink')  if self._has_lstat_info else None  # number of links to inode
+                    st = self.lstat(os.path.join(basedir, basename))
+                except (OSError, pyftpdlib.filesystems.FilesystemError):
+                    if ignore_err:
+                        continue
+                    raise
+
+            mode = st.get('lstat', 'st_mode') if has_lstat_info else 664
+            perms = modes.get(mode)
+            if perms is None:
+                perms = modes[mode] = _filemode(mode)
+            nlinks = st.get('lstat', 'st_nlink') if has_lstat_info else None
             if not nlinks:  # non-posix system, let's use a bogus value
                 nlinks = 1
-            size = st.size  # file size
-            uname = get_user_by_uid(os.getuid())
-            gname = get_group_by_gid(os.getgid())
-            mtime = timefunc(datetime.datetime.timestamp((st.modified)))
-            # if modification time > 6 months shows "month year"
-            # else "month hh:mm";  this matches proftpd format, see:
-            # https://github.com/giampaolo/pyftpdlib/issues/187
-            if (now - datetime.datetime.timestamp((st.modified))) > SIX_MONTHS:
-                fmtstr = "%d  %Y"
-            else:
-                fmtstr = "%d %H:%M"
-            try:
-                mtimestr = "%s %s" % (pyftpdlib.filesystems._months_map[mtime.tm_mon],
-                                      time.strftime(fmtstr, mtime))
-            except ValueError:
-                # It could be raised if last mtime happens to be too
-                # old (prior to year 1900) in which case we return
-                # the current time as last mtime.
-                mtime = timefunc()
-                mtimestr = "%s %s" % (pyftpdlib.filesystems._months_map[mtime.tm_mon],
-                                      time.strftime("%d %H:%M", mtime))
-
-            # same as stat.S_ISLNK(st.st_mode) but slighlty faster
-            #islink = (st.st_mode & 61440) == stat.S_IFLNK
-            islink = self.getlinkinfo(st)#st.islink
-            if islink and self.readlink is not None:
+            # entries modified in the same minute share the string
+            ts = st.get('details', 'modified')
+            key = None if ts is None else (ts // 60, ts >= six_months_ago)
+            mtimestr = mtimes.get(key)
+            if mtimestr is None:
+                if len(mtimes) >= 10000:
+                    mtimes.clear()
+                mtimestr = mtimes[key] = _list_mtime(ts, key, timefunc)
+
+            if has_link_info and st.is_link and self.readlink is not None:
                 # if the file is a symlink, resolve it, e.g.
                 # "symlink -> realfile"
                 try:
-                    basename = basename + " -> " + self.readlink(file)
+                    basename = basename + " -> " + self.readlink(
+                        os.path.join(basedir, basename))
                 except (OSError, pyftpdlib.filesystems.FilesystemError):
                     if not ignore_err:
                         raise
 
             # formatting is matched with proftpd ls output
-            line = "%s %3s %-8s %-8s %8s %s %s\r\n" % (
-                perms, nlinks, uname, gname, size, mtimestr, basename)
-            yield line.encode('utf8', self.cmd_channel.unicode_errors)
+            lines.append("%s %3s %s %8s %s %s\r\n" % (
+                perms, nlinks, owner, st.size, mtimestr, basename))
+            if len(lines) >= batch_size:
+                yield ''.join(lines).encode('utf8', unicode_errors)
+                lines = []
+        if lines:
+            yield ''.join(lines).encode('utf8', unicode_errors)
 
     def format_mlsx(self, basedir, listing, perms, facts, ignore_err=True):
         """Return an iterator object that yields the entries of a given
@@ -431,20 +1082,26 @@ class AbstractedFS(pyftpdlib.filesystems.AbstractedFS):
         type=file;size=156;perm=r;modify=20071029155301;unique=8012; music.mp3
         type=dir;size=0;perm=el;modify=20071127230206;unique=801e33; ebooks
         type=file;size=211;perm=r;modify=20071103093626;unique=192; module.py
+        Entries are yielded listing_batch_size lines at a time.
         """
         assert isinstance(basedir, unicode), basedir
         if self.cmd_channel.use_gmt_times:
             timefunc = time.gmtime
         else:
             timefunc = time.localtime
+        unicode_errors = self.cmd_channel.unicode_errors
+        batch_size = self.listing_batch_size
+        has_lstat_info = self._has_lstat_info
         permdir = ''.join([x for x in perms if x not in 'arw'])
         permfile = ''.join([x for x in perms if x not in 'celmp'])
         if ('w' in perms) or ('a' in perms) or ('f' in perms):
             permdir += 'c'
         if 'd' in perms:
             permdir += 'p'
+        # facts can be in any order but they are sent sorted by name:
+        # create, modify, perm, size, type, unique, unix.gid,
+        # unix.mode, unix.uid
         show_type = 'type' in facts
-        show_perm = 'perm' in facts
         show_size = 'size' in facts
         show_modify = 'modify' in facts
         show_create = 'create' in facts
@@ -452,75 +1109,67 @@ class AbstractedFS(pyftpdlib.filesystems.AbstractedFS):
         show_uid = 'unix.uid' in facts
         show_gid = 'unix.gid' in facts
         show_unique = 'unique' in facts
+        dir_perm = 'perm=%s;' % permdir if 'perm' in facts else ''
+        file_perm = 'perm=%s;' % permfile if 'perm' in facts else ''
+        file_type = 'type=file;' if show_type else ''
+        show_time = show_modify or show_create
+        minutes = {}
+        infos = getattr(listing, 'infos', {})
+        lines = []
         for basename in listing:
-            retfacts = dict()
-            if not PY3:
-                try:
-                    file = os.path.join(basedir, basename)
-                except UnicodeDecodeError:
-                    # (Python 2 only) might happen on filesystem not
-                    # supporting UTF8 meaning os.listdir() returned a list
-                    # of mixed bytes and unicode strings:
-                    # http://goo.gl/6DLHD
-                    # http://bugs.python.org/issue683592
-                    file = os.path.join(bytes(basedir), bytes(basename))
-                    if not isinstance(basename, unicode):
-                        basename = unicode(basename, 'utf8', 'ignore')
-            else:
-                file = os.path.join(basedir, basename)
             # in order to properly implement 'unique' fact (RFC-3659,
             # chapter 7.5.2) we are supposed to follow symlinks, hence
             # use os.stat() instead of os.lstat()
-            try:
-                st = self.stat(file)
-            except (OSError, pyftpdlib.filesystems.FilesystemError):
-                if ignore_err:
-                    continue
-                raise
-            # type + perm
+            st = infos.get(basename)
+            if st is None:
+                try:
+                    st = self.stat(os.path.join(basedir, basename))
+                except (OSError, pyftpdlib.filesystems.FilesystemError):
+                    if ignore_err:
+                        continue
+                    raise
+            line = []
+            if show_time:
+                # entries modified in the same minute share the
+                # "YYYYmmddHHMM" part (UTC offsets are whole minutes)
+                mtimestr = None
+                ts = st.get('details', 'modified')
+                if ts is not None:
+                    secs = int(ts // 1)
+                    minute = minutes.get(secs // 60)
+                    if minute is None:
+                        if len(minutes) >= 10000:
+                            minutes.clear()
+                        minute = minutes[secs // 60] = _mlsx_minute(
+                            secs, timefunc)
+                    # it is False if last mtime happens to be too old
+                    # (prior to year 1900)
+                    if minute:
+                        mtimestr = '%s%02d' % (minute, secs % 60)
+                if mtimestr is not None:
+                    if show_create:
+                        # on Windows we can provide also the creation
+                        # time
+                        line.append('create=%s;' % mtimestr)
+                    if show_modify:
+                        line.append('modify=%s;' % mtimestr)
             # same as stat.S_ISDIR(st.st_mode) but slightly faster
-            isdir = st.is_dir#(st.st_mode & 61440) == stat.S_IFDIR
-            if isdir:
+            if st.is_dir:
+                line.append(dir_perm)
+                if show_size:
+                    line.append('size=%s;' % st.size)
                 if show_type:
                     if basename == '.':
-                        retfacts['type'] = 'cdir'
+                        line.append('type=cdir;')
                     elif basename == '..':
-                        retfacts['type'] = 'pdir'
+                        line.append('type=pdir;')
                     else:
-                        retfacts['type'] = 'dir'
-                if show_perm:
-                    retfacts['perm'] = permdir
+                        line.append('type=dir;')
             else:
-                if show_type:
-                    retfacts['type'] = 'file'
-                if show_perm:
-                    retfacts['perm'] = permfile
-            if show_size:
-                retfacts['size'] = st.size  # file size
-            # last modification time
-            if show_modify:
-                try:
-                    retfacts['modify'] = time.strftime("%Y%m%d%H%M%S",
-                                                       timefunc(datetime.datetime.timestamp((st.modified))))
-                # it could be raised if last mtime happens to be too old
-                # (prior to year 1900)
-                except ValueError:
-                    pass
-            if show_create:
-                # on Windows we can provide also the creation time
-                try:
-                    retfacts['create'] = time.strftime("%Y%m%d%H%M%S",
-                                                       timefunc(datetime.datetime.timestamp(st.modified)))
-                except ValueError:
-                    pass
-            # UNIX only
-            if show_mode:
-                retfacts['unix.mode'] = oct(st.get('lstat', 'st_mode') & 511) if self._has_lstat_info else 664#oct(st.st_mode & 511)
-            if show_uid:
-                retfacts['unix.uid'] = st.uid if self._has_lstat_info else os.getuid()#st.st_uid
-            if show_gid:
-                retfacts['unix.gid'] = st.gid if self._has_lstat_info else os.getgid()#st.st_gid
-
+                line.append(file_perm)
+                if show_size:
+                    line.append('size=%s;' % st.size)
+                line.append(file_type)
             # We provide unique fact (see RFC-3659, chapter 7.5.2) on
             # posix platforms only; we get it by mixing st_dev and
             # st_ino values which should be enough for granting an
@@ -530,10 +1179,110 @@ class AbstractedFS(pyftpdlib.filesystems.AbstractedFS):
             # platforms should use some platform-specific method (e.g.
             # on Windows NTFS filesystems MTF records could be used).
             if show_unique:
-                retfacts['unique'] = "%xg%x" % (st.get('lstat', 'st_dev') if self._has_lstat_info else 0, st.get('lstat', 'st_ino') if self._has_lstat_info else 0)
+                if has_lstat_info:
+                    line.append('unique=%xg%x;' % (
+                        st.get('lstat', 'st_dev'), st.get('lstat', 'st_ino')))
+                else:
+                    line.append('unique=0g0;')
+            # UNIX only
+            if show_gid:
+                line.append('unix.gid=%s;' % (
+                    st.gid if has_lstat_info else os.getgid()))
+            if show_mode:
+                line.append('unix.mode=%s;' % (
+                    oct(st.get('lstat', 'st_mode') & 511)
+                    if has_lstat_info else 664))
+            if show_uid:
+                line.append('unix.uid=%s;' % (
+                    st.uid if has_lstat_info else os.getuid()))
+            line.append(' %s\r\n' % basename)
+            lines.append(''.join(line))
+            if len(lines) >= batch_size:
+                yield ''.join(lines).encode('utf8', unicode_errors)
+                lines = []
+        if lines:
+            yield ''.join(lines).encode('utf8', unicode_errors)
+
 
-            # facts can be in any order but we sort them by name
-            factstring = "".join(["%s=%s;" % (x, retfacts[x])
-                                  for x in sorted(retfacts.keys())])
-            line = "%s %s\r\n" % (factstring, basename)
-            yield line.encode('utf8', self.cmd_channel.unicode_errors)
+    def format_list_tree(self, basedir, tree, ignore_err=True):
+        """Return an iterator object that yields the entries of a
+        directory tree listed by listtree() emulating the
+        "/bin/ls -lAR" UNIX command output: the entries of every
+        directory come after its path relative to basedir.
+         - (str) basedir: the absolute dirname.
+         - (iterable) tree: the (dirpath, infos) tuples of listtree().
+         - (bool) ignore_err: see format_list().
+        This is how output appears to client:
+        .:
+        drwxrwxrwx   1 owner   group          0 Aug 31 18:50 e-books
+        -rw-rw-rw-   1 owner   group        380 Sep 02  3:40 module.py
+
+        ./e-books:
+        -rw-rw-rw-   1 owner   group    7045120 Sep 02  3:47 book.pdf
+        """
+        assert isinstance(basedir, unicode), basedir
+        unicode_errors = self.cmd_channel.unicode_errors
+        separator = ''
+        for rel, infos in tree:
+            header = '%s%s:\r\n' % (separator, './' + rel if rel else '.')
+            yield header.encode('utf8', unicode_errors)
+            separator = '\r\n'
+            listing = _Listing(info.name for info in infos)
+            listing.infos.update((info.name, info) for info in infos)
+            for data in self.format_list(vpath.join(basedir, rel), listing,
+                                         ignore_err):
+                yield data
+
+    def format_mlsx_tree(self, basedir, tree, perms, facts,
+                         ignore_err=True):
+        """Return an iterator object that yields the entries of a
+        directory tree listed by listtree() in the form of MLSD, named
+        by their path relative to basedir.
+         - (str) basedir: the absolute dirname.
+         - (iterable) tree: the (dirpath, infos) tuples of listtree().
+         - (str) perms: the string referencing the user permissions.
+         - (str) facts: the list of "facts" to be returned.
+         - (bool) ignore_err: see format_mlsx().
+        This is how output could appear to the client:
+        type=dir;size=0;perm=el;modify=20071127230206; ebooks
+        type=file;size=211;perm=r;modify=20071103093626; module.py
+        type=file;size=156;perm=r;modify=20071029155301; ebooks/book.pdf
+        """
+        assert isinstance(basedir, unicode), basedir
+        for rel, infos in tree:
+            listing = _Listing()
+            for info in infos:
+                name = rel + '/' + info.name if rel else info.name
+                listing.append(name)
+                listing.infos[name] = info
+            for data in self.format_mlsx(basedir, listing, perms, facts,
+                                         ignore_err):
+                yield data
+
+
+def _list_mtime(ts, key, timefunc):
+    """Return the time shown by format_list() for mtime ts."""
+    if ts is not None:
+        try:
+            mtime = timefunc(ts)
+            return "%s %s" % (pyftpdlib.filesystems._months_map[mtime.tm_mon],
+                              time.strftime("%d %H:%M" if key[1] else
+                                            "%d  %Y", mtime))
+        except ValueError:
+            pass
+    # It could be raised if last mtime happens to be too old (prior to
+    # year 1900) in which case we return the current time as last
+    # mtime.
+    mtime = timefunc()
+    return "%s %s" % (pyftpdlib.filesystems._months_map[mtime.tm_mon],
+                      time.strftime("%d %H:%M", mtime))
+
+
+def _mlsx_minute(secs, timefunc):
+    """Return the "YYYYmmddHHMM" string of the minute of secs, or
+    False if it can not be formatted.
+    """
+    try:
+        return time.strftime("%Y%m%d%H%M", timefunc(secs))
+    except ValueError:
+        return False
@@ -0,0 +1,595 @@
+import re
+
+import fs.errors
+import pyftpdlib.filesystems
+import pyftpdlib.handlers
+
+from .checksums import ALGORITHMS
+from .filesystems import AbstractedFS
+from .workers import BackendExecutor, PendingCall
+
+
+class _ReadintoProducer(object):
+    """Producer for binary files sent without sendfile() (e.g. remote
+    backends, TLS data channels), filling a buffer allocated once with
+    readinto() instead of allocating a new bytes object at every
+    read() as FileProducer does.  Chunks are memoryviews of the
+    buffer: asynchat only asks for the next one once the previous one
+    was sent whole.
+    """
+
+    def __init__(self, file, buffer_size):
+        self.file = file
+        self.type = 'i'
+        self._view = memoryview(bytearray(buffer_size))
+
+    def more(self):
+        try:
+            n = self.file.readinto(self._view)
+        except OSError as err:
+            raise pyftpdlib.handlers._FileReadWriteError(err)
+        if not n:
+            return b''
+        return self._view[:n]
+
+
+class _DTPHandlerMixin(object):
+    """Data channel behaviour shared by the plain and TLS handlers."""
+
+    # the filesystem of a login replaced during the transfer, released
+    # once it is over (see _FTPHandlerMixin._release_fs())
+    retired_fs = None
+
+    def close(self):
+        try:
+            self._close()
+        finally:
+            fs_obj, self.retired_fs = self.retired_fs, None
+            if fs_obj is not None:
+                fs_obj.close()
+
+    def _close(self):
+        # An upload streamed to the backend (e.g. a multipart upload)
+        # must be discarded rather than committed when the transfer
+        # did not complete: abort it before the file object gets
+        # closed and on_incomplete_file_received() is called.
+        if not self._closed and self.receive and \
+                not self.transfer_finished:
+            abort = getattr(self.file_obj, 'abort', None)
+            if abort is not None and not self.file_obj.closed:
+                abort()
+        committed = None
+        if not self._closed and self.receive and self.transfer_finished:
+            committed = getattr(self.file_obj, 'committed', None)
+        if committed is None:
+            return super().close()
+        # A staged upload (see fstpy.staging) is committed to the
+        # backend in background: the client is answered right away but
+        # on_file_received() is only called once the file is there.
+        cmd_channel, ioloop = self.cmd_channel, self.ioloop
+        received = []
+        cmd_channel.on_file_received = received.append
+        try:
+            super().close()
+        finally:
+            del cmd_channel.on_file_received
+        if not received:
+            return
+        call = PendingCall(ioloop)
+
+        def on_committed(future):
+            if future.cancelled() or future.exception() is not None:
+                call(cmd_channel.on_incomplete_file_received, received[0])
+            else:
+                call(cmd_channel.on_file_received, received[0])
+        committed.add_done_callback(on_committed)
+
+
+class DTPHandler(_DTPHandlerMixin, pyftpdlib.handlers.DTPHandler):
+    """DTPHandler aborting incomplete uploads on the backend."""
+
+
+# the checksum commands and the algorithm they use, None for the one
+# selected with OPTS HASH
+_HASH_CMDS = {
+    'HASH': None,
+    'XCRC': 'CRC32',
+    'XMD5': 'MD5',
+    'XSHA': 'SHA-1',
+    'XSHA1': 'SHA-1',
+    'XSHA256': 'SHA-256',
+    'XSHA512': 'SHA-512',
+}
+
+
+def _extend_proto_cmds(proto_cmds):
+    proto_cmds = proto_cmds.copy()
+    proto_cmds.update({
+        'SITE RMTREE': dict(
+            perm='d', auth=True, arg=True,
+            help='Syntax: SITE <SP> RMTREE <SP> dir-name (remove directory '
+                 'tree).'),
+        'HASH': dict(
+            perm='r', auth=True, arg=True,
+            help='Syntax: HASH <SP> file-name (get the checksum of a file, '
+                 'see OPTS HASH and RANG).'),
+        'SITE MLSDR': dict(
+            perm='l', auth=True, arg=None,
+            help='Syntax: SITE <SP> MLSDR [<SP> dir-name] (list directory '
+                 'tree in MLSD form).'),
+        'RANG': dict(
+            perm=None, auth=True, arg=True,
+            help='Syntax: RANG <SP> start <SP> end (set the byte range of '
+                 'HASH).'),
+    })
+    for cmd, algorithm in _HASH_CMDS.items():
+        if algorithm is not None:
+            proto_cmds[cmd] = dict(
+                perm='r', auth=True, arg=True,
+                help='Syntax: %s <SP> file-name (get the %s checksum of a '
+                     'file).' % (cmd, algorithm))
+    return proto_cmds
+
+
+# ls options of "LIST -R [dir]" and "STAT -R [dir]", e.g. -R, -lR, -laR
+_RECURSIVE_OPTS = re.compile(r'^-[a-zA-Z]*R[a-zA-Z]*$')
+
+
+class _FTPHandlerMixin(object):
+    """Control channel behaviour shared by the plain and TLS handlers.
+    When backend_workers is > 0 the blocking calls a command is about
+    to make (password check, listing, stat, open, remove, rename...)
+    are run in advance on a pool of that many threads; the command
+    itself is processed once they are done, picking up their outcome,
+    so that the IO loop keeps serving the other sessions in the
+    meantime.  Commands received in the meantime are queued and
+    processed in order afterwards.
+    The waits of the transfers themselves are not moved off the IO
+    loop: RETR waiting for a chunk of a ranged read, STOR held back
+    while too many parts of a multipart upload are in flight, and the
+    opening of the session filesystem at login (a new backend client
+    when the pool has none ready) still block the other sessions of
+    the IO loop for that long.
+    With site_rmtree, SITE RMTREE removes a directory and everything
+    below it in a single command (see AbstractedFS.removetree()), as
+    RMD does with recursive_rmd; the user needs the "d" permission
+    over the whole tree.  A removal stopped by an error is answered
+    with a 550 reply telling how many objects were deleted.
+    HASH (with OPTS HASH and RANG, as in draft-bryan-ftpext-hash) and
+    the XCRC, XMD5, XSHA1, XSHA256 and XSHA512 commands return the
+    checksum of a file computed on the server (see
+    AbstractedFS.checksum()), so that clients can verify a transfer
+    without downloading the file again.
+    LIST -R and STAT -R list a directory and everything below it as
+    "ls -lAR" does, SITE MLSDR in the form of MLSD with the paths of
+    the entries relative to the directory: mirroring a tree takes a
+    single command instead of one per directory.  Entries are sent
+    while the tree is still being listed (see AbstractedFS.listtree()).
+    """
+
+    # number of threads running backend calls, 0 runs them inline
+    backend_workers = 0
+    # bytes read at a time by RETR when not using sendfile()
+    retr_buffer_size = 256 * 1024
+    # whether SITE RMTREE is available
+    site_rmtree = False
+    # whether RMD removes non empty directories too
+    recursive_rmd = False
+    # the algorithm of HASH until changed with OPTS HASH
+    hash_algorithm = 'SHA-256'
+
+    _queued_lines = None
+    # the command (ABOR or QUIT) cancelling the one being prepared
+    _cancelled_by = None
+    # whether the LIST or STAT command being processed has the -R option
+    _list_recursive = False
+    # objects removed so far by the SITE RMTREE (or RMD) in progress
+    _delete_progress = None
+    # the (start, end) byte range of the next HASH set by RANG
+    _hash_range = None
+
+    def __init__(self, conn, server, ioloop=None):
+        super().__init__(conn, server, ioloop)
+        if not self.site_rmtree and 'SITE RMTREE' in self.proto_cmds:
+            self.proto_cmds = self.proto_cmds.copy()
+            del self.proto_cmds['SITE RMTREE']
+
+    def flush_account(self):
+        super().flush_account()
+        self._release_fs()
+
+    def handle_auth_success(self, home, password, msg_login):
+        # the filesystem of the previous login, if any, is replaced
+        self._release_fs()
+        super().handle_auth_success(home, password, msg_login)
+
+    def _release_fs(self):
+        """Give the filesystem of the session back to the pool, once
+        the transfer in progress, if any, is over.
+        """
+        fs_obj, self.fs = self.fs, None
+        if fs_obj is None:
+            return
+        if self.data_channel is not None and \
+                self.data_channel.transfer_in_progress():
+            self.data_channel.retired_fs = fs_obj
+        else:
+            fs_obj.close()
+
+    def push_dtp_data(self, data, isproducer=False, file=None, cmd=None):
+        if isproducer and type(data) is pyftpdlib.handlers.FileProducer \
+                and data.type == 'i' and hasattr(data.file, 'readinto'):
+            data = _ReadintoProducer(data.file, self.retr_buffer_size)
+        return super().push_dtp_data(data, isproducer, file, cmd)
+
+    def pre_process_command(self, line, cmd, arg):
+        if self._queued_lines is not None:
+            # ABOR, QUIT and STAT (also sent after a Telnet IP/Synch
+            # sequence) do not wait for the command being prepared
+            if cmd[-4:] in ('ABOR', 'QUIT') or \
+                    (cmd[-4:] == 'STAT' and not arg.strip()):
+                self._interrupt_prepared_command(line, cmd, arg)
+            else:
+                self._queued_lines.append((line, cmd, arg))
+            return
+        if cmd in ('LIST', 'STAT'):
+            opts, _, rest = arg.strip().partition(' ')
+            self._list_recursive = bool(_RECURSIVE_OPTS.match(opts))
+            if self._list_recursive:
+                # without a path, the current directory: an empty STAT
+                # argument asks for the server status
+                arg = rest.strip() or '.'
+        super().pre_process_command(line, cmd, arg)
+
+    def process_command(self, cmd, *args, **kwargs):
+        if not self.backend_workers or cmd not in self._prepared_cmds or \
+                (self.fs is None and cmd != 'PASS') or \
+                (cmd == 'STAT' and self.data_channel is not None and
+                 self.data_channel.transfer_in_progress()):
+            return super().process_command(cmd, *args, **kwargs)
+        self._queued_lines = []
+        executor = BackendExecutor.get(self.ioloop, self.backend_workers)
+        executor.submit(self._prepare_command, self._on_command_prepared,
+                        self.fs, cmd, args, kwargs)
+
+    def _interrupt_prepared_command(self, line, cmd, arg):
+        """Handle ABOR, QUIT or STAT received while the previous
+        command is being prepared: STAT is answered right away, ABOR
+        and QUIT cancel the command first.
+        """
+        name = cmd[-4:]
+        if name == 'ABOR' and self.authenticated and \
+                self._cancelled_by is None:
+            self._cancelled_by = name
+            self.respond('426 Command aborted via ABOR.')
+        elif name == 'QUIT':
+            self._cancelled_by = name
+        # bypass the -R option handling, which belongs to the command
+        # being prepared
+        super().pre_process_command(line, cmd, arg)
+
+    def _on_command_prepared(self, exc, fs_obj, cmd, args, kwargs):
+        # errors are not reported here: the command makes the same
+        # calls again and responds as usual
+        queued, self._queued_lines = self._queued_lines, None
+        cancelled, self._cancelled_by = self._cancelled_by, None
+        try:
+            if not self._closed and cancelled is None:
+                super().process_command(cmd, *args, **kwargs)
+        finally:
+            if fs_obj is not None:
+                fs_obj.discard_precomputed()
+        if cancelled == 'QUIT':
+            return
+        for line, cmd, arg in queued:
+            if self._closed:
+                break
+            self.pre_process_command(line, cmd, arg)
+
+    _prepared_cmds = frozenset([
+        'PASS', 'LIST', 'NLST', 'MLSD', 'STAT', 'MLST', 'CWD', 'XCWD',
+        'CDUP', 'XCUP', 'SIZE', 'MDTM', 'RETR', 'STOR', 'APPE', 'DELE',
+        'MKD', 'XMKD', 'RMD', 'XRMD', 'RNFR', 'RNTO', 'SITE RMTREE',
+        'SITE MLSDR'] +
+        list(_HASH_CMDS))
+
+    def _prepare_command(self, fs, cmd, args, kwargs):
+        """Run in a worker thread: make the backend calls cmd is about
+        to make on filesystem fs, leaving their outcome in the metadata
+        cache or in the filesystem precomputed calls.
+        """
+        path = args[0]
+        if cmd == 'PASS':
+            # password hashes are slow to verify on purpose
+            prepare = getattr(self.authorizer, 'prepare_authentication',
+                              None)
+            if prepare is not None and self.username and \
+                    not self.authenticated:
+                prepare(self.username, path)
+        elif cmd == 'SITE MLSDR' or (cmd in ('LIST', 'STAT') and
+                                     self._list_recursive):
+            if fs.isdir(path):
+                fs.precompute('listtree', path)
+        elif cmd in ('LIST', 'NLST', 'MLSD', 'STAT'):
+            if fs.isdir(path):
+                fs.precompute('listdir', path)
+        elif cmd in ('MLST', 'CWD', 'XCWD', 'CDUP', 'XCUP', 'SIZE', 'MDTM',
+                     'RNFR'):
+            fs.lexists(path)
+        elif cmd == 'RETR':
+            fs.precompute('open', path, 'rb')
+        elif cmd in ('STOR', 'APPE'):
+            if self._restart_position:
+                mode = 'r+'
+            else:
+                mode = 'a' if cmd == 'APPE' else 'w'
+            fs.precompute('open', path, mode + 'b')
+        elif cmd == 'DELE':
+            fs.precompute('remove', path)
+        elif cmd in ('MKD', 'XMKD'):
+            fs.precompute('mkdir', path)
+        elif cmd in ('RMD', 'XRMD', 'SITE RMTREE'):
+            if fs.realpath(path) == fs.realpath(fs.root):
+                pass
+            elif cmd == 'SITE RMTREE' or self.recursive_rmd:
+                if self._may_remove_tree(path):
+                    fs.precompute('removetree', path)
+            else:
+                fs.precompute('rmdir', path)
+        elif cmd == 'RNTO':
+            if self._rnfr:
+                fs.precompute('rename', self._rnfr, path)
+        elif cmd in _HASH_CMDS:
+            fs.precompute('checksum', *self._checksum_args(cmd, path))
+
+    def ftp_LIST(self, path):
+        """Return a list of files in the specified directory to the
+        client, and in all the directories below it with the -R option.
+        On success return the directory path, else None.
+        """
+        if not self._list_recursive or not self.fs.isdir(path):
+            return super().ftp_LIST(path)
+        iterator = self._list_tree(path)
+        if iterator is not None:
+            producer = pyftpdlib.handlers.BufferedIteratorProducer(
+                self.fs.format_list_tree(path, iterator))
+            self.push_dtp_data(producer, isproducer=True, cmd="LIST")
+            return path
+
+    def ftp_STAT(self, path):
+        """Return statistics about current ftp session, or list a
+        directory over the command channel (with everything below it
+        with the -R option).
+        """
+        if not path or not self._list_recursive or not self.fs.isdir(path):
+            return super().ftp_STAT(path)
+        iterator = self._list_tree(path)
+        if iterator is not None:
+            producer = pyftpdlib.handlers.BufferedIteratorProducer(
+                self.fs.format_list_tree(path, iterator))
+            self.push('213-Status of "%s":\r\n' % self.fs.fs2ftp(path))
+            self.push_with_producer(producer)
+            self.respond('213 End of status.')
+            return path
+
+    def ftp_SITE_MLSDR(self, path):
+        """Return the contents of a directory and of all the
+        directories below it in the form of MLSD, named by their path
+        relative to the directory.
+        On success return the directory path, else None.
+        """
+        if not self.fs.isdir(path):
+            self.respond("501 No such directory.")
+            return
+        iterator = self._list_tree(path)
+        if iterator is not None:
+            perms = self.authorizer.get_perms(self.username)
+            producer = pyftpdlib.handlers.BufferedIteratorProducer(
+                self.fs.format_mlsx_tree(path, iterator, perms,
+                                         self._current_facts))
+            self.push_dtp_data(producer, isproducer=True, cmd="SITE MLSDR")
+            return path
+
+    def _list_tree(self, path):
+        try:
+            return self.run_as_current_user(self.fs.listtree, path)
+        except (OSError, pyftpdlib.filesystems.FilesystemError,
+                fs.errors.FSError) as err:
+            why = pyftpdlib.handlers._strerror(err)
+            self.respond('550 %s.' % why)
+            return None
+
+    def ftp_RMD(self, path):
+        """Remove the specified directory, with everything below it
+        if recursive_rmd.
+        On success return the directory path, else None.
+        """
+        if self.recursive_rmd:
+            return self._remove_tree(path)
+        try:
+            return super().ftp_RMD(path)
+        except fs.errors.FSError as err:
+            # e.g. the directory is not empty
+            self.respond('550 %s.' % pyftpdlib.handlers._strerror(err))
+
+    def ftp_SITE_RMTREE(self, path):
+        """Remove the specified directory and everything below it.
+        On success return the directory path, else None.
+        """
+        return self._remove_tree(path)
+
+    def _may_remove_tree(self, path):
+        has_tree_perm = getattr(self.authorizer, 'has_tree_perm', None)
+        return has_tree_perm is None or \
+            has_tree_perm(self.username, 'd', path)
+
+    def _remove_tree(self, path):
+        if self.fs.realpath(path) == self.fs.realpath(self.fs.root):
+            self.respond("550 Can't remove root directory.")
+            return
+        if not self._may_remove_tree(path):
+            self.respond("550 Not enough privileges.")
+            return
+        try:
+            self.run_as_current_user(self.fs.removetree, path)
+        except (OSError, pyftpdlib.filesystems.FilesystemError,
+                fs.errors.FSError) as err:
+            why = pyftpdlib.handlers._strerror(err)
+            if self._delete_progress is None:
+                self.respond('550 %s.' % why)
+            else:
+                self.respond('550 Removal stopped after %d objects: %s.' %
+                             (self._delete_progress, why))
+        else:
+            self.respond("250 Directory tree removed.")
+            return path
+        finally:
+            self._delete_progress = None
+
+    def _checksum_args(self, cmd, path):
+        """Return the arguments of the AbstractedFS.checksum() call
+        made by cmd.
+        """
+        algorithm = _HASH_CMDS[cmd] or self.hash_algorithm
+        start, end = 0, None
+        if cmd == 'HASH' and self._hash_range is not None:
+            start, end = self._hash_range
+        return path, algorithm, start, end
+
+    def _checksum(self, cmd, path):
+        args = self._checksum_args(cmd, path)
+        try:
+            return self.run_as_current_user(self.fs.checksum, *args)
+        except (OSError, pyftpdlib.filesystems.FilesystemError,
+                fs.errors.FSError) as err:
+            why = pyftpdlib.handlers._strerror(err)
+            self.respond('550 %s.' % why)
+            return None
+
+    def ftp_HASH(self, path):
+        """Return the checksum of a file computed with the algorithm
+        selected by OPTS HASH, over the byte range set by RANG if any.
+        """
+        start = self._hash_range[0] if self._hash_range is not None else 0
+        try:
+            result = self._checksum('HASH', path)
+        finally:
+            # a range applies to the next command only
+            self._hash_range = None
+        if result is not None:
+            digest, end = result
+            self.respond('213 %s %d-%d %s %s' % (
+                self.hash_algorithm, start, max(start, end - 1), digest,
+                self.fs.fs2ftp(path)))
+            return path
+
+    def _ftp_xhash(self, cmd, path):
+        result = self._checksum(cmd, path)
+        if result is not None:
+            self.respond('250 %s' % result[0])
+            return path
+
+    def ftp_XCRC(self, path):
+        """Return the CRC-32 of a file."""
+        return self._ftp_xhash('XCRC', path)
+
+    def ftp_XMD5(self, path):
+        """Return the MD5 digest of a file."""
+        return self._ftp_xhash('XMD5', path)
+
+    def ftp_XSHA(self, path):
+        """Return the SHA-1 digest of a file."""
+        return self._ftp_xhash('XSHA', path)
+
+    def ftp_XSHA1(self, path):
+        """Return the SHA-1 digest of a file."""
+        return self._ftp_xhash('XSHA1', path)
+
+    def ftp_XSHA256(self, path):
+        """Return the SHA-256 digest of a file."""
+        return self._ftp_xhash('XSHA256', path)
+
+    def ftp_XSHA512(self, path):
+        """Return the SHA-512 digest of a file."""
+        return self._ftp_xhash('XSHA512', path)
+
+    def ftp_RANG(self, line):
+        """Set the byte range (both ends included) the next HASH
+        command applies to; "RANG 1 0" resets it to the whole file.
+        """
+        try:
+            start, end = [int(x) for x in line.split()]
+            if start < 0 or end < 0:
+                raise ValueError
+        except ValueError:
+            self.respond('501 Invalid RANG format.')
+            return
+        if (start, end) == (1, 0):
+            self._hash_range = None
+            self.respond('350 Restarting at 0. Ending at EOF.')
+        elif start > end:
+            self.respond('501 Invalid RANG range.')
+        else:
+            self._hash_range = (start, end + 1)
+            self.respond('350 Restarting at %d. Ending at %d.' % (start, end))
+
+    def ftp_OPTS(self, line):
+        """Specify options for FTP commands as specified in RFC-2389;
+        "OPTS HASH [algorithm]" shows or selects the algorithm of HASH.
+        """
+        cmd, _, arg = line.strip().partition(' ')
+        if cmd.upper() != 'HASH':
+            return super().ftp_OPTS(line)
+        if arg:
+            algorithm = arg.strip().upper()
+            if algorithm not in ALGORITHMS:
+                self.respond('501 Unknown algorithm, current selection not '
+                             'changed.')
+                return
+            self.hash_algorithm = algorithm
+        self.respond('200 %s' % self.hash_algorithm)
+
+    def ftp_FEAT(self, line):
+        """List all new features supported as defined in RFC-2398."""
+        self._extra_feats = [
+            feat for feat in self._extra_feats
+            if not feat.startswith(('HASH ', 'RANG '))]
+        self._extra_feats.append('HASH ' + ''.join(
+            '%s%s;' % (name, '*' if name == self.hash_algorithm else '')
+            for name in ALGORITHMS))
+        self._extra_feats.append('RANG STREAM')
+        return super().ftp_FEAT(line)
+
+    def on_delete_progress(self, path, done):
+        """Called every DeleteEngine.progress_every objects removed
+        by SITE RMTREE (or RMD), from a worker thread when the
+        command is prepared by one (see backend_workers).
+        Progress is only logged: a reply can not start with 250 before
+        the outcome is known, and clients do not expect preliminary
+        replies to RMD.
+        """
+        self._delete_progress = done
+
+
+class FTPHandler(_FTPHandlerMixin, pyftpdlib.handlers.FTPHandler):
+    """FTPHandler serving an fstpy AbstractedFS."""
+
+    abstracted_fs = AbstractedFS
+    dtp_handler = DTPHandler
+    proto_cmds = _extend_proto_cmds(pyftpdlib.handlers.FTPHandler.proto_cmds)
+
+
+if hasattr(pyftpdlib.handlers, 'TLS_FTPHandler'):
+
+    class TLS_DTPHandler(_DTPHandlerMixin,
+                         pyftpdlib.handlers.TLS_DTPHandler):
+        """TLS_DTPHandler aborting incomplete uploads on the backend."""
+
+    class TLS_FTPHandler(_FTPHandlerMixin,
+                         pyftpdlib.handlers.TLS_FTPHandler):
+        """TLS_FTPHandler serving an fstpy AbstractedFS."""
+
+        abstracted_fs = AbstractedFS
+        dtp_handler = TLS_DTPHandler
+        proto_cmds = _extend_proto_cmds(
+            pyftpdlib.handlers.TLS_FTPHandler.proto_cmds)
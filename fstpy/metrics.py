@@ -0,0 +1,437 @@
+import os
+import json
+import time
+import errno
+import threading
+import functools
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from pyftpdlib.log import logger
+
+
+# upper bounds (seconds) of the histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0, 30.0, 60.0)
+
+# name: (type, help)
+METRICS = {
+    'fstpy_backend_call_seconds': (
+        'histogram', 'Time spent in backend calls.'),
+    'fstpy_backend_call_errors_total': (
+        'counter', 'Backend calls which raised an error.'),
+    'fstpy_backend_bytes_total': (
+        'counter', 'Bytes read from and written to the backend.'),
+    'fstpy_auth_check_seconds': (
+        'histogram', 'Time spent in authorizer checks.'),
+    'fstpy_auth_check_errors_total': (
+        'counter', 'Authorizer checks which failed or raised an error.'),
+}
+
+
+class Metrics(object):
+    """Per-process counters and histograms of the backend calls made
+    by AbstractedFS and of the authorizer checks, labeled by
+    operation and user.
+    Processes serving one session each (MultiprocessFTPServer) share
+    their figures through directory: every process writes a snapshot
+    there at most every flush_interval seconds and when its sessions
+    end, exposition() adds them up.
+    Operations lasting more than slow_threshold seconds (or
+    slow_thresholds[op]) are logged as warnings.
+     - (str) directory: where processes write their snapshots, None
+       if all sessions are served by this process.
+     - (bool) user_label: label figures with the user name.
+    """
+
+    def __init__(self, directory=None, flush_interval=5.0,
+                 slow_threshold=None, slow_thresholds=None, user_label=True):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.slow_threshold = slow_threshold
+        self.slow_thresholds = slow_thresholds or {}
+        self.user_label = user_label
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        # (name, labels): [bucket counts..., +Inf count, sum]
+        self._histograms = {}
+        # (name, labels): value
+        self._counters = {}
+        self._next_flush = time.time() + self.flush_interval
+
+    # --- Recording
+
+    def call(self, metric, op, user, func, *args, **kwargs):
+        """Call func(*args, **kwargs) recording its duration in the
+        histogram metric + "_seconds" (its failures in metric +
+        "_errors_total").
+        The positional arguments are logged if the call is slow.
+        """
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            self.inc(metric + '_errors_total', op, user)
+            raise
+        finally:
+            self.observe(metric + '_seconds', op, user,
+                         time.perf_counter() - start, args)
+
+    def observe(self, name, op, user, seconds, args=()):
+        """Record an operation of seconds seconds in histogram name,
+        args being the arguments it was called with.
+        """
+        key = (name, self._labels(op, user))
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked: the figures of the parent are its own
+                self._reset()
+            values = self._histograms.get(key)
+            if values is None:
+                values = self._histograms[key] = [0] * (len(BUCKETS) + 2)
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    break
+            else:
+                i = len(BUCKETS)
+            values[i] += 1
+            values[-1] += seconds
+        threshold = self.slow_thresholds.get(op, self.slow_threshold)
+        if threshold is not None and seconds >= threshold:
+            logger.warning('slow %s by %s: %.3f secs %s', op, user, seconds,
+                           ' '.join([repr(arg) for arg in args]))
+        if self.directory is not None and time.time() >= self._next_flush:
+            self.flush()
+
+    def inc(self, name, op, user, value=1):
+        """Add value to counter name."""
+        key = (name, self._labels(op, user))
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def _labels(self, op, user):
+        if self.user_label and user:
+            return (('op', op), ('user', user))
+        return (('op', op),)
+
+    # --- Sharing between processes
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def snapshot(self):
+        """Return the figures of this process, as JSON serializable
+        data.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            return {
+                'histograms': [[name, labels, values] for (name, labels),
+                               values in self._histograms.items()],
+                'counters': [[name, labels, value] for (name, labels),
+                             value in self._counters.items()],
+            }
+
+    def flush(self):
+        """Write the snapshot of this process to directory."""
+        if self.directory is None:
+            return
+        self._next_flush = time.time() + self.flush_interval
+        path = self._path('metrics-%d.json' % os.getpid())
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.rename(tmp, path)
+
+    def _collect(self):
+        """Return the figures of all processes, merging the snapshots
+        of the processes which are gone into an archive.
+        """
+        totals = _Totals()
+        totals.add(self.snapshot())
+        if self.directory is None:
+            return totals
+        archive = _Totals()
+        archive_path = self._path('metrics-archive.json')
+        if os.path.exists(archive_path):
+            with open(archive_path) as f:
+                archive.add(json.load(f))
+        archived = []
+        for name in os.listdir(self.directory):
+            if not (name.startswith('metrics-') and name.endswith('.json')):
+                continue
+            try:
+                pid = int(name[len('metrics-'):-len('.json')])
+            except ValueError:
+                continue
+            if pid == os.getpid():
+                continue
+            try:
+                with open(self._path(name)) as f:
+                    snapshot = json.load(f)
+            except (IOError, ValueError):
+                continue
+            if _alive(pid):
+                totals.add(snapshot)
+            else:
+                archive.add(snapshot)
+                archived.append(name)
+        if archived:
+            tmp = archive_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(archive.snapshot(), f)
+            os.rename(tmp, archive_path)
+            for name in archived:
+                os.remove(self._path(name))
+        totals.merge(archive)
+        return totals
+
+    # --- Exposition
+
+    def exposition(self):
+        """Return the figures of all processes in the Prometheus text
+        format.
+        """
+        with _collect_lock:
+            totals = self._collect()
+        lines = []
+        for name in sorted(METRICS):
+            kind, help = METRICS[name]
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            if kind == 'histogram':
+                for labels, values in sorted(
+                        totals.histograms.get(name, {}).items()):
+                    count = 0
+                    for bound, n in zip(BUCKETS + ('+Inf',), values):
+                        count += n
+                        lines.append('%s_bucket%s %d' % (
+                            name, _format_labels(labels + (('le', bound),)),
+                            count))
+                    lines.append('%s_sum%s %r' % (
+                        name, _format_labels(labels), values[-1]))
+                    lines.append('%s_count%s %d' % (
+                        name, _format_labels(labels), count))
+            else:
+                for labels, value in sorted(
+                        totals.counters.get(name, {}).items()):
+                    lines.append('%s%s %d' % (name, _format_labels(labels),
+                                              value))
+        return '\n'.join(lines) + '\n'
+
+
+# exposition() may be called by concurrent HTTP requests
+_collect_lock = threading.Lock()
+
+
+class _Totals(object):
+    """Figures added up from several snapshots."""
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+
+    def add(self, snapshot):
+        for name, labels, values in snapshot['histograms']:
+            labels = tuple(tuple(label) for label in labels)
+            current = self.histograms.setdefault(name, {}).get(labels)
+            if current is None:
+                self.histograms[name][labels] = list(values)
+            else:
+                for i, value in enumerate(values):
+                    current[i] += value
+        for name, labels, value in snapshot['counters']:
+            labels = tuple(tuple(label) for label in labels)
+            counters = self.counters.setdefault(name, {})
+            counters[labels] = counters.get(labels, 0) + value
+
+    def merge(self, other):
+        self.add(other.snapshot())
+
+    def snapshot(self):
+        return {
+            'histograms': [[name, labels, values]
+                           for name, items in self.histograms.items()
+                           for labels, values in items.items()],
+            'counters': [[name, labels, value]
+                         for name, items in self.counters.items()
+                         for labels, value in items.items()],
+        }
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', r'\\')
+                     .replace('"', r'\"').replace('\n', r'\n'))
+        for key, value in labels)
+
+
+# --- Instrumented objects
+
+class InstrumentedFS(object):
+    """Proxy of a backend filesystem recording the duration of the
+    calls in the "timed" set.
+    scandir() is timed while its result is iterated, since backends
+    list directories lazily.
+    Like the wrapper filesystems of PyFilesystem2 it has a
+    delegate_path() method, so that fstpy.streams.delegate() finds the
+    backend behind it.
+    """
+
+    timed = frozenset([
+        'getinfo', 'listdir', 'openbin', 'open', 'move', 'copy', 'remove',
+        'removedir', 'removetree', 'makedir', 'makedirs', 'setinfo',
+        'exists', 'isdir', 'isfile'])
+
+    def __init__(self, fs_obj, metrics, user):
+        self._fs = fs_obj
+        self._metrics = metrics
+        self._user = user
+
+    def delegate_path(self, path):
+        return self._fs, path
+
+    def __getattr__(self, name):
+        attr = getattr(self._fs, name)
+        if name in self.timed:
+            attr = functools.partial(self._metrics.call,
+                                     'fstpy_backend_call', name, self._user,
+                                     attr)
+        elif name == 'scandir':
+            attr = functools.partial(self._scandir, attr)
+        else:
+            return attr
+        # found in the instance dict from now on
+        self.__dict__[name] = attr
+        return attr
+
+    def _scandir(self, scandir, path, *args, **kwargs):
+        metrics = self._metrics
+        elapsed = 0.0
+        start = time.perf_counter()
+        try:
+            infos = iter(scandir(path, *args, **kwargs))
+            while True:
+                elapsed += time.perf_counter() - start
+                start = time.perf_counter()
+                try:
+                    info = next(infos)
+                except StopIteration:
+                    return
+                elapsed += time.perf_counter() - start
+                yield info
+                start = time.perf_counter()
+        except Exception:
+            metrics.inc('fstpy_backend_call_errors_total', 'scandir',
+                        self._user)
+            raise
+        finally:
+            elapsed += time.perf_counter() - start
+            metrics.observe('fstpy_backend_call_seconds', 'scandir',
+                            self._user, elapsed, (path,))
+
+
+class InstrumentedFile(object):
+    """Proxy of a file object recording the duration of reads, writes
+    and close (which commits uploads on some backends) and the bytes
+    transferred.
+    """
+
+    def __init__(self, file, metrics, user):
+        self._file = file
+        self._metrics = metrics
+        self._user = user
+
+    def read(self, *args):
+        data = self._metrics.call('fstpy_backend_call', 'read', self._user,
+                                  self._file.read, *args)
+        self._metrics.inc('fstpy_backend_bytes_total', 'read', self._user,
+                          len(data))
+        return data
+
+    def readinto(self, b):
+        # buffers are bound rather than passed, not to be logged
+        n = self._metrics.call('fstpy_backend_call', 'read', self._user,
+                               functools.partial(self._file.readinto, b))
+        self._metrics.inc('fstpy_backend_bytes_total', 'read', self._user,
+                          n or 0)
+        return n
+
+    def write(self, data):
+        n = self._metrics.call('fstpy_backend_call', 'write', self._user,
+                               functools.partial(self._file.write, data))
+        self._metrics.inc('fstpy_backend_bytes_total', 'write', self._user,
+                          len(data))
+        return n
+
+    def close(self):
+        self._metrics.call('fstpy_backend_call', 'close', self._user,
+                           self._file.close)
+
+    def __getattr__(self, attr):
+        return getattr(self._file, attr)
+
+
+# --- HTTP endpoint
+
+class MetricsServer(object):
+    """Serves Metrics.exposition() at /metrics over HTTP, from a
+    daemon thread of the process starting the FTP server.
+    """
+
+    def __init__(self, metrics, address=('127.0.0.1', 9100)):
+        self.metrics = metrics
+        self.address = address
+        self._server = None
+
+    def start(self):
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.exposition().encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = HTTPServer(self.address, Handler)
+        self.address = self._server.server_address
+        thread = threading.Thread(target=self._server.serve_forever,
+                                  name='fstpy-metrics')
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
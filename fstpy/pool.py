@@ -0,0 +1,227 @@
+import os
+import time
+import itertools
+import threading
+import collections
+
+import fs
+
+
+Capabilities = collections.namedtuple(
+    'Capabilities', ['access', 'link', 'stat', 'lstat'])
+
+INFO_NAMESPACES = ['stat', 'lstat', 'details', 'access', 'link']
+
+
+class _PoolEntry(object):
+    """A single opened filesystem and its bookkeeping."""
+
+    def __init__(self, fs_obj):
+        self.fs = fs_obj
+        self.leases = 0
+        self.last_used = time.time()
+        self.last_checked = self.last_used
+
+
+class FSPool(object):
+    """A process-wide pool of opened PyFilesystem2 instances keyed by
+    their URL.
+    Opening a remote filesystem (e.g. S3) means creating a new client
+    session, a TLS handshake and a metadata round trip; the pool makes
+    sure that a new FTP session reuses an already warm instance instead.
+    PyFilesystem2 instances serialize their own calls, hence a single
+    instance can be leased to several sessions at the same time:
+     - (int) max_size: maximum number of instances opened per URL.
+     - (int) max_leases: number of sessions sharing a single instance
+       before a new one is opened (up to max_size).
+     - (float) max_idle: seconds after which an instance without
+       leases is closed.
+     - (float) check_interval: seconds after which a leased instance
+       is health checked again before being handed out.
+    An instance failing its health check is no longer handed out; it
+    is closed once the sessions still using it release it.
+    The pool is fork aware: a child process never reuses instances
+    inherited from its parent, since their network clients are not
+    safe to share across processes.
+    """
+
+    def __init__(self, max_size=4, max_leases=32, max_idle=300.0,
+                 check_interval=60.0):
+        self.max_size = max_size
+        self.max_leases = max_leases
+        self.max_idle = max_idle
+        self.check_interval = check_interval
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.RLock()
+        # notified when an instance is done being opened
+        self._opened = threading.Condition(self._lock)
+        self._entries = collections.defaultdict(list)
+        # url: number of instances being opened
+        self._opening = collections.Counter()
+        # url: entries failing their health check, still leased
+        self._retired = collections.defaultdict(list)
+        self._capabilities = {}
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            # Drop without closing: sockets are still owned by the
+            # parent process.
+            self._reset()
+
+    # --- Public API
+
+    def acquire(self, url):
+        """Return an opened filesystem for url, leasing it to the
+        caller until release() is called.
+        Backends are opened and health checked without holding the
+        lock of the pool: a slow one only holds up its own callers.
+        """
+        self._check_fork()
+        with self._lock:
+            while True:
+                self.evict_idle()
+                entries = self._entries[url]
+                entries.sort(key=lambda e: e.leases)
+                size = len(entries) + self._opening[url]
+                if entries and (entries[0].leases < self.max_leases or
+                                size >= self.max_size):
+                    entry = entries[0]
+                    entry.leases += 1
+                    now = entry.last_used = time.time()
+                    check = now - entry.last_checked >= self.check_interval
+                    if check:
+                        # checked once, whoever asks meanwhile
+                        entry.last_checked = now
+                    break
+                if size < self.max_size:
+                    # the slot is taken while the backend is opened
+                    self._opening[url] += 1
+                    entry = None
+                    break
+                # every instance of url is still being opened
+                self._opened.wait()
+        if entry is None:
+            return self._open(url)
+        if not check or self._healthy(entry):
+            return entry.fs
+        with self._lock:
+            entries = self._entries.get(url, [])
+            if entry in entries:
+                entries.remove(entry)
+                self._retired[url].append(entry)
+        self.release(url, entry.fs)
+        return self.acquire(url)
+
+    def _open(self, url):
+        """Open a new instance for url in the slot reserved by
+        acquire(), leased to the caller.
+        """
+        try:
+            fs_obj = fs.open_fs(url)
+        except BaseException:
+            with self._lock:
+                self._free_slot(url)
+            raise
+        with self._lock:
+            entry = _PoolEntry(fs_obj)
+            entry.leases += 1
+            self._entries[url].append(entry)
+            self._free_slot(url)
+        return fs_obj
+
+    def _free_slot(self, url):
+        self._opening[url] -= 1
+        if not self._opening[url]:
+            del self._opening[url]
+        self._opened.notify_all()
+
+    def release(self, url, fs_obj):
+        """Give back a filesystem obtained by acquire()."""
+        self._check_fork()
+        with self._lock:
+            for entry in self._entries.get(url, ()):
+                if entry.fs is fs_obj:
+                    entry.leases = max(0, entry.leases - 1)
+                    entry.last_used = time.time()
+                    return
+            retired = self._retired.get(url, [])
+            for entry in retired:
+                if entry.fs is fs_obj:
+                    entry.leases -= 1
+                    if entry.leases <= 0:
+                        retired.remove(entry)
+                        self._close(entry)
+                        if not retired:
+                            del self._retired[url]
+                    return
+
+    def capabilities(self, url, fs_obj):
+        """Return the Capabilities of the filesystem at url, probing
+        fs_obj only the first time a given url is seen.
+        """
+        try:
+            return self._capabilities[url]
+        except KeyError:
+            pass
+        i = fs_obj.getinfo('/', namespaces=INFO_NAMESPACES)
+        caps = Capabilities(access=i.has_namespace('access'),
+                            link=i.has_namespace('link'),
+                            stat=i.has_namespace('stat'),
+                            lstat=i.has_namespace('lstat'))
+        self._capabilities[url] = caps
+        return caps
+
+    def evict_idle(self):
+        """Close instances having no leases for more than max_idle
+        seconds.
+        """
+        self._check_fork()
+        now = time.time()
+        with self._lock:
+            for url in list(self._entries):
+                keep = []
+                for entry in self._entries[url]:
+                    if entry.leases == 0 and \
+                            now - entry.last_used > self.max_idle:
+                        self._close(entry)
+                    else:
+                        keep.append(entry)
+                if keep:
+                    self._entries[url] = keep
+                else:
+                    del self._entries[url]
+
+    def clear(self):
+        """Close all pooled instances."""
+        self._check_fork()
+        with self._lock:
+            for entries in itertools.chain(self._entries.values(),
+                                           self._retired.values()):
+                for entry in entries:
+                    self._close(entry)
+            self._entries.clear()
+            self._retired.clear()
+            self._capabilities.clear()
+
+    # --- Internals
+
+    @staticmethod
+    def _healthy(entry):
+        try:
+            entry.fs.getinfo('/')
+        except Exception:
+            return False
+        return True
+
+    @staticmethod
+    def _close(entry):
+        try:
+            entry.fs.close()
+        except Exception:
+            pass
+
+
+default_pool = FSPool()
@@ -0,0 +1,355 @@
+import os
+import json
+import uuid
+import threading
+import concurrent.futures
+
+import fs
+import fs.errors
+import fs.path
+from pyftpdlib.log import logger
+
+from .streams import delegate, fs_s3fs
+
+
+# --- Server-side copies
+
+class _S3Copier(object):
+    """Copies S3FS objects within the bucket without the data going
+    through the server: a single CopyObject request up to
+    multipart_threshold bytes, a multipart upload whose parts are
+    copied concurrently (UploadPartCopy) above it.
+    """
+
+    # S3 does not copy objects larger than 5 GiB in a single request
+    multipart_threshold = 1024 * 1024 * 1024
+    part_size = 256 * 1024 * 1024
+    max_workers = 8
+
+    def __init__(self, fs_obj):
+        self.client = fs_obj.client
+        self.bucket = fs_obj._bucket_name
+        self.path_to_key = fs_obj._path_to_key
+        get_upload_args = getattr(fs_obj, '_get_upload_args', None)
+        self.get_upload_args = get_upload_args or (lambda key: {})
+
+    def __call__(self, src, dst, size):
+        src_key = self.path_to_key(src)
+        dst_key = self.path_to_key(dst)
+        source = {'Bucket': self.bucket, 'Key': src_key}
+        if size is None or size <= self.multipart_threshold:
+            self.client.copy_object(Bucket=self.bucket, Key=dst_key,
+                                    CopySource=source,
+                                    **self.get_upload_args(dst_key))
+            return
+        resp = self.client.create_multipart_upload(
+            Bucket=self.bucket, Key=dst_key, **self.get_upload_args(dst_key))
+        upload_id = resp['UploadId']
+
+        def copy_part(number, offset):
+            last = min(offset + self.part_size, size) - 1
+            resp = self.client.upload_part_copy(
+                Bucket=self.bucket, Key=dst_key, UploadId=upload_id,
+                PartNumber=number, CopySource=source,
+                CopySourceRange='bytes=%d-%d' % (offset, last))
+            return {'PartNumber': number,
+                    'ETag': resp['CopyPartResult']['ETag']}
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                    self.max_workers) as executor:
+                futures = [
+                    executor.submit(copy_part, number, offset)
+                    for number, offset in enumerate(
+                        range(0, size, self.part_size), 1)]
+                parts = [future.result() for future in futures]
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=dst_key, UploadId=upload_id,
+                MultipartUpload={'Parts': parts})
+        except Exception:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=dst_key, UploadId=upload_id)
+            raise
+
+
+def _s3_copier(fs_obj):
+    if fs_s3fs is None or not isinstance(fs_obj, fs_s3fs.S3FS):
+        return None
+    return _S3Copier(fs_obj)
+
+
+# Factories called with a filesystem returning a copy(src, dst, size)
+# callable copying a file within that filesystem on the server side,
+# or None if the filesystem is not supported. Append to this list to
+# support other backends.
+server_copiers = [_s3_copier]
+
+
+def move_file(fs_obj, src, dst, overwrite=False):
+    """Move the file src to dst, copying it on the server side when
+    the backend supports it rather than reading and writing it back.
+    """
+    inner, inner_src = delegate(fs_obj, src)
+    inner_dst_fs, inner_dst = delegate(fs_obj, dst)
+    if inner is inner_dst_fs:
+        for factory in server_copiers:
+            copy = factory(inner)
+            if copy is None:
+                continue
+            if not overwrite and inner.exists(inner_dst):
+                raise fs.errors.DestinationExists(dst)
+            copy(inner_src, inner_dst, inner.getinfo(
+                inner_src, namespaces=['details']).size)
+            inner.remove(inner_src)
+            return
+    fs_obj.move(src, dst, overwrite=overwrite)
+
+
+def _move_dir_natively(fs_obj, src, dst):
+    """Rename the directory src in a single call when the backend is
+    a local filesystem; return whether it was done.
+    """
+    if not (fs_obj.hassyspath(src) and fs_obj.hassyspath(dst)):
+        return False
+    os.rename(fs_obj.getsyspath(src), fs_obj.getsyspath(dst))
+    return True
+
+
+# --- Renames
+
+class RenameEngine(object):
+    """Renames files and directories on a PyFilesystem2 filesystem.
+    Files are moved with move_file(). Directories are renamed in a
+    single call on local filesystems; on the others (object stores,
+    where a directory is a key prefix) their files are moved by up to
+    workers threads, progress(src, dst, done, total) being called
+    every progress_every files.
+    When journal_dir is given every directory rename is recorded
+    there while in progress, so that one interrupted by a crash can
+    be completed or rolled back by recover().  A directory rename
+    failing on an error is rolled back before the error is raised.
+    """
+
+    progress_every = 1000
+
+    def __init__(self, workers=8, journal_dir=None, progress=None):
+        self.workers = workers
+        self.journal_dir = journal_dir
+        self.progress = progress
+
+    def rename(self, fs_obj, src, dst, url=None):
+        """Rename src to dst on fs_obj.
+        url is the one fs_obj was opened from, recorded in the journal
+        in order to open it again on recovery.
+        """
+        if not fs_obj.isdir(src):
+            move_file(fs_obj, src, dst)
+            return
+        if fs_obj.exists(dst):
+            raise fs.errors.DestinationExists(dst)
+        if _move_dir_natively(fs_obj, src, dst):
+            return
+        dirs = sorted(fs.path.relativefrom(src, path)
+                      for path in fs_obj.walk.dirs(src))
+        files = [fs.path.relativefrom(src, path)
+                 for path in fs_obj.walk.files(src)]
+        journal = None
+        if self.journal_dir is not None:
+            journal = _Journal.create(self.journal_dir, url, src, dst,
+                                      dirs, files)
+        try:
+            fs_obj.makedirs(dst)
+        except BaseException:
+            if journal is not None:
+                journal.remove()
+            raise
+        try:
+            self._complete(fs_obj, src, dst, dirs, files, journal)
+        except Exception:
+            if journal is not None:
+                journal.close()
+            try:
+                self._roll_back(fs_obj, src, dst, dirs, files)
+            except Exception:
+                # left to recover()
+                logger.exception('could not roll back the rename of %r '
+                                 'to %r', src, dst)
+            else:
+                if journal is not None:
+                    os.remove(journal.path)
+            raise
+        except BaseException:
+            if journal is not None:
+                journal.close()
+            raise
+        if journal is not None:
+            journal.remove()
+
+    def _complete(self, fs_obj, src, dst, dirs, files, journal=None,
+                  overwrite=False):
+        """Move files from src to dst, creating the directories dirs
+        of src in dst first, then remove src.
+        """
+        fs_obj.makedirs(dst, recreate=True)
+        for path in dirs:
+            fs_obj.makedirs(fs.path.join(dst, path), recreate=True)
+        self._move_files(fs_obj, src, dst, files, journal, overwrite)
+        if fs_obj.exists(src):
+            fs_obj.removetree(src)
+
+    def _roll_back(self, fs_obj, src, dst, dirs, files):
+        """Move the files already moved from src to dst back to their
+        original place, creating the directories dirs of src again,
+        then remove dst.
+        """
+        fs_obj.makedirs(src, recreate=True)
+        for path in dirs:
+            fs_obj.makedirs(fs.path.join(src, path), recreate=True)
+        for path in files:
+            src_path = fs.path.join(src, path)
+            dst_path = fs.path.join(dst, path)
+            if not fs_obj.exists(dst_path):
+                continue
+            if fs_obj.exists(src_path):
+                # the move was interrupted, the original is still in
+                # place
+                fs_obj.remove(dst_path)
+            else:
+                move_file(fs_obj, dst_path, src_path)
+        if fs_obj.exists(dst):
+            fs_obj.removetree(dst)
+
+    def _move_files(self, fs_obj, src, dst, files, journal, overwrite=False):
+        total = len(files)
+        done = [0]
+        lock = threading.Lock()
+
+        def move(path):
+            move_file(fs_obj, fs.path.join(src, path),
+                      fs.path.join(dst, path), overwrite)
+            with lock:
+                if journal is not None:
+                    journal.done(path)
+                done[0] += 1
+                if self.progress is not None and \
+                        done[0] % self.progress_every == 0:
+                    self.progress(src, dst, done[0], total)
+
+        # keep a bounded number of moves queued, stop queueing at the
+        # first error
+        window = self.workers * 4
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            pending = set()
+            for path in files:
+                if len(pending) >= window:
+                    finished, pending = concurrent.futures.wait(
+                        pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    _raise_first(finished, pending)
+                pending.add(executor.submit(move, path))
+            finished, _ = concurrent.futures.wait(pending)
+            _raise_first(finished, ())
+        if self.progress is not None and total % self.progress_every:
+            self.progress(src, dst, total, total)
+
+    def recover(self, fs_obj, journal_path, rollback=False):
+        """Complete the directory rename recorded in journal_path, or
+        roll it back moving the files already moved to their original
+        place, then remove the journal.
+        """
+        header, done = _Journal.read(journal_path)
+        src, dst, files = header['src'], header['dst'], header['files']
+        dirs = header.get('dirs')
+        if dirs is None:
+            # journals written before directories were recorded
+            dirs = sorted(set(fs.path.dirname(path) for path in files) -
+                          set(['']))
+        if rollback:
+            self._roll_back(fs_obj, src, dst, dirs, files)
+        else:
+            files = [path for path in files
+                     if path not in done and
+                     fs_obj.exists(fs.path.join(src, path))]
+            self._complete(fs_obj, src, dst, dirs, files, overwrite=True)
+        os.remove(journal_path)
+
+
+def _raise_first(finished, pending):
+    for future in finished:
+        exc = future.exception()
+        if exc is not None:
+            for other in pending:
+                other.cancel()
+            raise exc
+
+
+class _Journal(object):
+    """The journal of a directory rename: a JSON lines file whose
+    first line describes the rename (filesystem URL, src, dst, the
+    directories to create and the files to move, relative to src)
+    followed by one line per file moved.
+    """
+
+    def __init__(self, path, f):
+        self.path = path
+        self._f = f
+
+    @classmethod
+    def create(cls, journal_dir, url, src, dst, dirs, files):
+        path = os.path.join(journal_dir, 'rename-%s.journal' %
+                            uuid.uuid4().hex)
+        f = open(path, 'w')
+        f.write(json.dumps({'url': url, 'src': src, 'dst': dst,
+                            'dirs': dirs, 'files': files}) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+        return cls(path, f)
+
+    @staticmethod
+    def read(path):
+        """Return the header of the journal in path and the set of
+        files already moved.
+        """
+        with open(path) as f:
+            header = json.loads(f.readline())
+            done = set()
+            for line in f:
+                # the last line may have been cut by the crash
+                if line.endswith('\n'):
+                    done.add(json.loads(line))
+        return header, done
+
+    def done(self, path):
+        self._f.write(json.dumps(path) + '\n')
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+
+    def remove(self):
+        self._f.close()
+        os.remove(self.path)
+
+
+def recover_renames(journal_dir, rollback=False, open_fs=fs.open_fs):
+    """Complete (or roll back) the directory renames interrupted by a
+    crash, as recorded in journal_dir; to be called at startup before
+    serving any client.
+    """
+    engine = RenameEngine()
+    for name in sorted(os.listdir(journal_dir)):
+        if not name.endswith('.journal'):
+            continue
+        path = os.path.join(journal_dir, name)
+        try:
+            header, _ = _Journal.read(path)
+            logger.info('%s interrupted rename of %r to %r on %s',
+                        'rolling back' if rollback else 'completing',
+                        header['src'], header['dst'], header['url'])
+            with open_fs(header['url']) as fs_obj:
+                engine.recover(fs_obj, path, rollback)
+        except Exception:
+            # the journal is kept for the next attempt, the other
+            # renames are recovered all the same
+            logger.exception('could not recover the rename journaled '
+                             'in %s', path)
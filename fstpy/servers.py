@@ -0,0 +1,235 @@
+import os
+import sys
+import time
+import errno
+import random
+import signal
+import socket
+
+from pyftpdlib.ioloop import IOLoop
+from pyftpdlib.log import config_logging, is_logging_configured, logger
+from pyftpdlib.servers import FTPServer
+
+
+class _Stop(Exception):
+    pass
+
+
+class PreforkFTPServer(object):
+    """An FTP server made of a fixed number of worker processes,
+    forked once at startup and accepting connections from a listening
+    socket they share; each one serves its sessions with its own IO
+    loop, as FTPServer does.
+    The parent process only binds the socket and supervises the
+    workers, replacing those that exit: it never opens a backend.  A
+    worker runs on_worker_start() right after fork(), before accepting
+    any connection: that is where backend clients, credential stores
+    and caches are to be opened, so that no network client is shared
+    across processes and the first sessions find them warm.
+    Server-wide background work (e.g. recovering from a crash,
+    refreshing an index) is done by on_maintenance_start() in a
+    process of its own which serves no client, forked before the
+    workers: they are only forked once it returns, and it is kept
+    running (daemon threads included) until the server stops.
+     - (tuple|socket) address_or_socket: the address to listen on, or
+       an already listening socket.
+     - (class) handler: the FTPHandler class serving the sessions.
+     - (int) workers: number of worker processes, the number of CPUs
+       if None.
+     - (callable) on_worker_start: called with no arguments in every
+       worker process before it starts serving.
+     - (callable) on_maintenance_start: called with no arguments in
+       the maintenance process, again if that process is replaced.
+    """
+
+    # limits applied by every worker to its own sessions
+    max_cons = 512
+    max_cons_per_ip = 0
+    # seconds a worker must survive not to be considered crashing at
+    # startup; crashing workers are respawned after a delay
+    min_worker_uptime = 1.0
+    respawn_delay = 5.0
+
+    def __init__(self, address_or_socket, handler, workers=None,
+                 on_worker_start=None, backlog=100,
+                 on_maintenance_start=None):
+        self.handler = handler
+        self.workers = workers or os.cpu_count() or 1
+        self.on_worker_start = on_worker_start
+        self.on_maintenance_start = on_maintenance_start
+        self.backlog = backlog
+        if isinstance(address_or_socket, socket.socket):
+            self.socket = address_or_socket
+        else:
+            self.socket = self._bind(address_or_socket)
+        self.address = self.socket.getsockname()[:2]
+        self._children = {}
+        self._maintenance_pid = None
+
+    def _bind(self, address):
+        host, port = address
+        err = None
+        for res in socket.getaddrinfo(host or None, port, socket.AF_UNSPEC,
+                                      socket.SOCK_STREAM, 0,
+                                      socket.AI_PASSIVE):
+            af, socktype, proto, _, sa = res
+            sock = None
+            try:
+                sock = socket.socket(af, socktype, proto)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                sock.bind(sa)
+                sock.listen(self.backlog)
+            except socket.error as e:
+                err = e
+                if sock is not None:
+                    sock.close()
+                continue
+            # accept() of the workers must not block when another
+            # worker took the connection first
+            sock.setblocking(False)
+            return sock
+        raise err or socket.error('getaddrinfo returned an empty list')
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self._children[pid] = time.time()
+            return
+        code = 0
+        try:
+            self._run_worker()
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 0
+        except BaseException:
+            logger.exception('worker %d failed', os.getpid())
+            code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def _spawn_maintenance(self, wait):
+        """Fork the maintenance process; with wait, return once
+        on_maintenance_start() returned in it.
+        """
+        r, w = os.pipe() if wait else (None, None)
+        pid = os.fork()
+        if pid:
+            self._children[pid] = time.time()
+            self._maintenance_pid = pid
+            if not wait:
+                return
+            os.close(w)
+            try:
+                if not os.read(r, 1):
+                    raise RuntimeError('maintenance process failed to '
+                                       'start')
+            finally:
+                os.close(r)
+            return
+        code = 0
+        try:
+            self._init_child()
+            self.socket.close()
+            self.on_maintenance_start()
+            if wait:
+                os.close(r)
+                os.write(w, b'1')
+                os.close(w)
+            logger.info('maintenance process %d running', os.getpid())
+            while True:
+                signal.pause()
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 0
+        except BaseException:
+            logger.exception('maintenance process %d failed', os.getpid())
+            code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def _init_child(self):
+        def terminate(signum, frame):
+            raise SystemExit(0)
+        signal.signal(signal.SIGTERM, terminate)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        # e.g. passive ports are picked at random
+        random.seed()
+
+    def _run_worker(self):
+        self._init_child()
+        ioloop = IOLoop()
+        if self.on_worker_start is not None:
+            self.on_worker_start()
+        server = FTPServer(self.socket, self.handler, ioloop=ioloop)
+        server.max_cons = self.max_cons
+        server.max_cons_per_ip = self.max_cons_per_ip
+        logger.info('worker %d serving', os.getpid())
+        server.serve_forever(handle_exit=True)
+
+    def _stop(self, signum, frame):
+        # raised rather than flagged: os.wait() is retried after a
+        # signal handler returns
+        raise _Stop()
+
+    def serve_forever(self):
+        """Start the workers and keep them running until SIGTERM or
+        SIGINT, which are passed on to them.
+        """
+        if not is_logging_configured():
+            config_logging()
+        logger.info('>>> starting FTP server on %s:%s, %d workers <<<',
+                    self.address[0], self.address[1], self.workers)
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        try:
+            if self.on_maintenance_start is not None:
+                self._spawn_maintenance(wait=True)
+            for _ in range(self.workers):
+                self._spawn()
+            while True:
+                try:
+                    pid, status = os.wait()
+                except OSError as e:
+                    if e.errno == errno.ECHILD:
+                        break
+                    raise
+                started = self._children.pop(pid, None)
+                if started is None:
+                    continue
+                maintenance = pid == self._maintenance_pid
+                logger.warning('%s %d exited with status %d, starting a '
+                               'new one', 'maintenance process'
+                               if maintenance else 'worker', pid, status)
+                if time.time() - started < self.min_worker_uptime:
+                    time.sleep(self.respawn_delay)
+                if maintenance:
+                    self._spawn_maintenance(wait=False)
+                else:
+                    self._spawn()
+        except _Stop:
+            pass
+        finally:
+            self.close_all()
+
+    def close_all(self):
+        """Terminate the workers, waiting for them, and stop
+        listening.
+        """
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                self._children.pop(pid, None)
+        for pid in list(self._children):
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+            self._children.pop(pid, None)
+        self.socket.close()
+        logger.info('>>> shutting down FTP server, %d workers <<<',
+                    self.workers)
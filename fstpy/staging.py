@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import uuid
+import threading
+import concurrent.futures
+
+from pyftpdlib.log import logger
+
+from .pool import default_pool
+
+
+class _StagedFile(object):
+    """A file being uploaded to the local spool of an UploadStager.
+    Once closed it is durable on local disk and queued for commit;
+    committed is a concurrent.futures.Future completed by the commit
+    to the backend (its exception set if every attempt failed).
+    """
+
+    def __init__(self, stager, entry):
+        self.name = entry['path']
+        self.committed = concurrent.futures.Future()
+        self._stager = stager
+        self._entry = entry
+        self._f = open(stager._data_path(entry), 'wb')
+
+    @property
+    def closed(self):
+        return self._f.closed
+
+    def write(self, data):
+        return self._f.write(data)
+
+    def close(self):
+        if self._f.closed:
+            return
+        try:
+            self._f.flush()
+            os.fsync(self._f.fileno())
+            self._f.close()
+            self._stager._journal(self._entry)
+        except BaseException as err:
+            self._f.close()
+            self._stager._discard(self._entry)
+            self.committed.set_exception(err)
+            raise
+        self._stager._submit(self._entry, self.committed)
+
+    def abort(self):
+        """Discard the upload (the transfer did not complete)."""
+        if not self._f.closed:
+            self._f.close()
+            self._stager._discard(self._entry)
+            self.committed.cancel()
+
+    def __getattr__(self, attr):
+        return getattr(self._f, attr)
+
+
+class UploadStager(object):
+    """Uploads files to a local spool directory and commits them to
+    their backend in background, so that clients get their reply as
+    soon as a file is safe on local disk rather than once the backend
+    has stored it.
+    Every staged file is a <id>.data file plus, once completely
+    received and synced to disk, a <id>.json journal entry telling
+    where it goes: entries still in the spool after a crash are
+    committed again by recover(), partial uploads are discarded.
+    Files staged again for the same path before being committed are
+    committed in order, or skipped if superseded.
+     - (str) directory: the spool directory.
+     - (int) workers: files committed concurrently.
+     - (int) retries: attempts made again after a failed commit, with
+       an exponential backoff starting at retry_delay seconds; a file
+       still failing stays in the spool until the next recover().
+     - (instance) pool: the FSPool backends are acquired from.
+    """
+
+    def __init__(self, directory, workers=4, retries=5, retry_delay=1.0,
+                 pool=default_pool):
+        self.directory = directory
+        self.workers = workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.pool = pool
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._pid = None
+        self._check_fork()
+
+    def _check_fork(self):
+        # worker threads and locks are not inherited by forked children
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+            self._executor = None
+            # (url, path): id of the last file staged for it
+            self._latest = {}
+            # (url, path): [lock, number of commits using it]
+            self._key_locks = {}
+
+    # --- Public API
+
+    def stage(self, url, path, user=None):
+        """Return a _StagedFile for writing path of the filesystem at
+        url.
+        """
+        self._check_fork()
+        entry = {
+            # ids sort in staging order
+            'id': '%016x-%s' % (int(time.time() * 1e6), uuid.uuid4().hex),
+            'url': url, 'path': path, 'user': user,
+        }
+        return _StagedFile(self, entry)
+
+    def pending(self, url, path):
+        """Return the local path of the content last staged for path
+        and not committed yet, or None.
+        """
+        self._check_fork()
+        with self._lock:
+            id = self._latest.get((url, path))
+        if id is None:
+            return None
+        return os.path.join(self.directory, id + '.data')
+
+    def recover(self):
+        """Discard partial uploads and queue the staged files left
+        behind by a previous run; to be called at startup.
+        """
+        self._check_fork()
+        names = sorted(os.listdir(self.directory))
+        journaled = set(name[:-5] for name in names if name.endswith('.json'))
+        futures = []
+        for name in names:
+            base, ext = os.path.splitext(name)
+            if ext == '.json':
+                with open(os.path.join(self.directory, name)) as f:
+                    entry = json.load(f)
+                logger.info('committing %r staged for %s',
+                            entry['path'], entry['url'])
+                future = concurrent.futures.Future()
+                self._submit(entry, future)
+                futures.append(future)
+            elif ext == '.tmp' or ext == '.data' and base not in journaled:
+                os.remove(os.path.join(self.directory, name))
+        return futures
+
+    # --- Internals
+
+    def _data_path(self, entry):
+        return os.path.join(self.directory, entry['id'] + '.data')
+
+    def _journal_path(self, entry):
+        return os.path.join(self.directory, entry['id'] + '.json')
+
+    def _journal(self, entry):
+        path = self._journal_path(entry)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(entry, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+        if hasattr(os, 'O_DIRECTORY'):
+            # make the rename itself durable
+            fd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _discard(self, entry):
+        for path in (self._journal_path(entry), self._data_path(entry)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _submit(self, entry, future):
+        key = (entry['url'], entry['path'])
+        with self._lock:
+            self._latest[key] = entry['id']
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    self.workers)
+            self._executor.submit(self._commit, entry, future)
+
+    def _commit(self, entry, future):
+        key = (entry['url'], entry['path'])
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            key_lock[1] += 1
+        try:
+            with key_lock[0]:
+                self._commit_entry(key, entry, future)
+        finally:
+            with self._lock:
+                key_lock[1] -= 1
+                if not key_lock[1]:
+                    del self._key_locks[key]
+
+    def _commit_entry(self, key, entry, future):
+        with self._lock:
+            superseded = self._latest.get(key) != entry['id']
+        if not superseded:
+            for attempt in range(self.retries + 1):
+                try:
+                    self._upload(entry)
+                    break
+                except Exception as err:
+                    if attempt == self.retries:
+                        logger.error('could not commit %r to %s: %r, it '
+                                     'stays in %s', entry['path'],
+                                     entry['url'], err, self.directory)
+                        future.set_exception(err)
+                        return
+                    time.sleep(self.retry_delay * 2 ** attempt)
+        with self._lock:
+            if self._latest.get(key) == entry['id']:
+                del self._latest[key]
+        self._discard(entry)
+        future.set_result(None)
+
+    def _upload(self, entry):
+        fs_obj = self.pool.acquire(entry['url'])
+        try:
+            with open(self._data_path(entry), 'rb') as f:
+                fs_obj.upload(entry['path'], f)
+        finally:
+            self.pool.release(entry['url'], fs_obj)
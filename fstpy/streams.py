@@ -0,0 +1,445 @@
+import io
+import threading
+import concurrent.futures
+
+try:
+    import fs_s3fs
+except ImportError:
+    fs_s3fs = None
+
+
+def delegate(fs_obj, path):
+    """Resolve wrapper filesystems (e.g. SubFS) returning the
+    innermost filesystem and the path on it.
+    """
+    while hasattr(fs_obj, 'delegate_path'):
+        fs_obj, path = fs_obj.delegate_path(path)
+    return fs_obj, path
+
+
+def syspath(fs_obj, path):
+    """Return the path of path on the local disk if the filesystem
+    (once unwrapped) stores it there (e.g. OSFS), else None.
+    """
+    fs_obj, path = delegate(fs_obj, path)
+    try:
+        if fs_obj.hassyspath(path):
+            return fs_obj.getsyspath(path)
+    except Exception:
+        pass
+    return None
+
+
+# --- Ranged reads
+
+def _s3_range_fetcher(fs_obj, path):
+    if fs_s3fs is None or not isinstance(fs_obj, fs_s3fs.S3FS):
+        return None
+    # S3FS hands out a client per thread, the reader must reuse the
+    # one of the opening thread from its background thread
+    client = fs_obj.client
+    bucket = fs_obj._bucket_name
+    key = fs_obj._path_to_key(path)
+
+    def fetch(offset, length):
+        resp = client.get_object(
+            Bucket=bucket, Key=key,
+            Range='bytes=%d-%d' % (offset, offset + length - 1))
+        return resp['Body'].read()
+    return fetch
+
+
+# Factories called with (fs, path) returning a fetch(offset, length)
+# callable reading a byte range of path, or None if the filesystem is
+# not supported. Append to this list to support other backends.
+range_fetchers = [_s3_range_fetcher]
+
+
+def range_fetcher(fs_obj, path):
+    """Return a fetch(offset, length) callable for path, or None if
+    the backend can not read byte ranges.
+    """
+    fs_obj, path = delegate(fs_obj, path)
+    for factory in range_fetchers:
+        fetch = factory(fs_obj, path)
+        if fetch is not None:
+            return fetch
+    return None
+
+
+class ByteBudget(object):
+    """A number of bytes which downloads may have fetched ahead of
+    what they sent, shared by the downloads of a session or of a
+    whole process.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self, n):
+        """Reserve n bytes if available, return whether it did."""
+        with self._lock:
+            if self.used + n > self.max_bytes:
+                return False
+            self.used += n
+            return True
+
+    def acquire(self, n):
+        """Reserve n bytes even beyond max_bytes."""
+        with self._lock:
+            self.used += n
+
+    def release(self, n):
+        with self._lock:
+            self.used -= n
+
+
+# caps the bytes fetched ahead by all the downloads of the process
+default_read_budget = ByteBudget(512 * 1024 * 1024)
+
+
+class RangedReader(io.RawIOBase):
+    """A read-only binary file object reading a remote file in
+    chunks of chunk_size bytes through ranged requests.
+    Chunks following the one being read are fetched in background, up
+    to read_ahead of them concurrently: the reader starts prefetching
+    a single chunk and doubles the number every time it has to wait
+    for one, so that slow consumers do not cost more memory and fast
+    ones get as many parallel requests as needed.
+    Prefetched chunks are accounted in budgets (ByteBudget instances,
+    e.g. one for the session and one for the process) until they are
+    read; a chunk is only prefetched if all of them can afford it.
+    The chunk being read is fetched regardless, so that a download
+    always makes progress.
+    seek() is cheap: it only moves the position, so a REST offset
+    results in the first request starting right there.
+     - (callable) fetch: fetch(offset, length) returning bytes.
+     - (int) size: the size of the file.
+     - (str) name: the name of the file.
+    """
+
+    def __init__(self, fetch, size, name, chunk_size=8 * 1024 * 1024,
+                 read_ahead=1, budgets=()):
+        io.RawIOBase.__init__(self)
+        self.name = name
+        self.mode = 'rb'
+        self.chunk_size = chunk_size
+        self.read_ahead = read_ahead
+        self.budgets = budgets
+        self._fetch = fetch
+        self._size = size
+        self._pos = 0
+        # index: (future, bytes reserved in budgets)
+        self._chunks = {}
+        self._window = min(1, read_ahead)
+        self._executor = None
+        if read_ahead:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                read_ahead)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self._size + offset
+        else:
+            raise ValueError('invalid whence (%r)' % whence)
+        if pos < 0:
+            raise ValueError('negative seek position %r' % pos)
+        self._pos = pos
+        return pos
+
+    def _chunk_length(self, index):
+        return min(self.chunk_size, self._size - index * self.chunk_size)
+
+    def _fetch_chunk(self, index):
+        return self._fetch(index * self.chunk_size, self._chunk_length(index))
+
+    def _submit(self, index, length):
+        if self._executor is not None:
+            future = self._executor.submit(self._fetch_chunk, index)
+        else:
+            future = concurrent.futures.Future()
+            future.set_result(self._fetch_chunk(index))
+        self._chunks[index] = (future, length)
+
+    def _reserve(self, length):
+        """Reserve length bytes in all the budgets, or none."""
+        reserved = []
+        for budget in self.budgets:
+            if not budget.try_acquire(length):
+                for budget in reserved:
+                    budget.release(length)
+                return False
+            reserved.append(budget)
+        return True
+
+    def _drop(self, index):
+        future, length = self._chunks.pop(index)
+        future.cancel()
+        for budget in self.budgets:
+            budget.release(length)
+
+    def _get_chunk(self, index):
+        # drop what is behind us, schedule what is ahead
+        for i in [i for i in self._chunks if i < index]:
+            self._drop(i)
+        if index not in self._chunks:
+            length = self._chunk_length(index)
+            for budget in self.budgets:
+                budget.acquire(length)
+            self._submit(index, length)
+        future = self._chunks[index][0]
+        if not future.done() and self._window < self.read_ahead:
+            # we are faster than the backend: fetch more in parallel
+            self._window = min(self._window * 2, self.read_ahead)
+        last = (self._size - 1) // self.chunk_size
+        for i in range(index + 1, min(index + self._window, last) + 1):
+            if i not in self._chunks:
+                length = self._chunk_length(i)
+                if not self._reserve(length):
+                    break
+                self._submit(i, length)
+        return future.result()
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        if size is None or size < 0:
+            size = self._size - self._pos
+        size = min(size, self._size - self._pos)
+        if size <= 0:
+            return b''
+        parts = []
+        while size > 0:
+            index, start = divmod(self._pos, self.chunk_size)
+            chunk = self._get_chunk(index)
+            data = chunk[start:start + size]
+            if not data:
+                # the remote file is shorter than expected
+                break
+            parts.append(data)
+            self._pos += len(data)
+            size -= len(data)
+        return b''.join(parts)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            for index in list(self._chunks):
+                self._drop(index)
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+        io.RawIOBase.close(self)
+
+
+# --- Multipart uploads
+
+class _S3MultipartUpload(object):
+    """Multipart upload of a single S3FS object."""
+
+    min_part_size = 5 * 1024 * 1024
+
+    def __init__(self, fs_obj, path):
+        self.client = fs_obj.client
+        self.bucket = fs_obj._bucket_name
+        self.key = fs_obj._path_to_key(path)
+        get_upload_args = getattr(fs_obj, '_get_upload_args', None)
+        self.upload_args = get_upload_args(self.key) if get_upload_args \
+            else {}
+        self.upload_id = None
+
+    def start(self):
+        resp = self.client.create_multipart_upload(
+            Bucket=self.bucket, Key=self.key, **self.upload_args)
+        self.upload_id = resp['UploadId']
+
+    def upload_part(self, number, data):
+        resp = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=number, Body=data)
+        return {'PartNumber': number, 'ETag': resp['ETag']}
+
+    def copy_part(self, number):
+        """Upload the current content of the object as a part."""
+        resp = self.client.upload_part_copy(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            PartNumber=number,
+            CopySource={'Bucket': self.bucket, 'Key': self.key})
+        return {'PartNumber': number,
+                'ETag': resp['CopyPartResult']['ETag']}
+
+    def read(self):
+        """Return the current content of the object."""
+        resp = self.client.get_object(Bucket=self.bucket, Key=self.key)
+        return resp['Body'].read()
+
+    def complete(self, parts):
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': parts})
+
+    def put(self, data):
+        """Upload data as the whole object, without multipart."""
+        self.client.put_object(Bucket=self.bucket, Key=self.key, Body=data,
+                               **self.upload_args)
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+
+
+def _s3_multipart_upload(fs_obj, path):
+    if fs_s3fs is None or not isinstance(fs_obj, fs_s3fs.S3FS):
+        return None
+    return _S3MultipartUpload(fs_obj, path)
+
+
+# Factories called with (fs, path) returning an upload object (see
+# _S3MultipartUpload) for path, or None if the filesystem is not
+# supported. Append to this list to support other backends.
+multipart_uploaders = [_s3_multipart_upload]
+
+
+def multipart_upload(fs_obj, path):
+    """Return a multipart upload object for path, or None if the
+    backend does not support multipart uploads.
+    """
+    fs_obj, path = delegate(fs_obj, path)
+    for factory in multipart_uploaders:
+        upload = factory(fs_obj, path)
+        if upload is not None:
+            return upload
+    return None
+
+
+class MultipartWriter(io.RawIOBase):
+    """A write-only binary file object streaming data to the backend
+    as parts of part_size bytes while it is being written.
+    Up to max_in_flight parts are uploaded concurrently; once the
+    limit is reached write() waits for the oldest part, which in turn
+    slows down the data channel, hence memory is bounded by
+    (max_in_flight + 1) * part_size bytes.
+    Files smaller than a part are uploaded with a single request on
+    close().  abort() discards the upload instead of completing it.
+     - (instance) upload: the multipart upload object.
+     - (str) name: the name of the file.
+     - (int) append_size: the current size of the file when appending
+       to it; the existing content is kept, copied server side when
+       large enough to be a part.
+    """
+
+    def __init__(self, upload, name, part_size=8 * 1024 * 1024,
+                 max_in_flight=4, append_size=0):
+        io.RawIOBase.__init__(self)
+        self.name = name
+        self.mode = 'ab' if append_size else 'wb'
+        self.part_size = max(part_size, upload.min_part_size)
+        self.max_in_flight = max_in_flight
+        self._upload = upload
+        self._buffer = bytearray()
+        self._parts = []
+        self._pending = []
+        self._pos = 0
+        self._started = False
+        self._aborted = False
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max(1, max_in_flight))
+        if append_size:
+            self._pos = append_size
+            if append_size >= upload.min_part_size:
+                self._start()
+                self._submit(upload.copy_part)
+            else:
+                self._buffer += upload.read()
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def _start(self):
+        if not self._started:
+            self._upload.start()
+            self._started = True
+
+    def _submit(self, func, *args):
+        number = len(self._parts) + len(self._pending) + 1
+        self._pending.append(self._executor.submit(func, number, *args))
+        while len(self._pending) > self.max_in_flight:
+            self._parts.append(self._pending.pop(0).result())
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        try:
+            self._buffer += data
+            self._pos += len(data)
+            while len(self._buffer) >= self.part_size:
+                self._start()
+                part = bytes(self._buffer[:self.part_size])
+                del self._buffer[:self.part_size]
+                self._submit(self._upload.upload_part, part)
+        except Exception:
+            self.abort()
+            raise
+        return len(data)
+
+    def abort(self):
+        """Discard the upload, leaving the remote file untouched."""
+        if self._aborted or self.closed:
+            return
+        self._aborted = True
+        for future in self._pending:
+            future.cancel()
+        concurrent.futures.wait(self._pending)
+        self._pending = []
+        self._buffer = bytearray()
+        try:
+            self._upload.abort()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if not self._aborted:
+                try:
+                    if not self._started:
+                        self._upload.put(bytes(self._buffer))
+                    else:
+                        if self._buffer:
+                            self._submit(self._upload.upload_part,
+                                         bytes(self._buffer))
+                        for future in self._pending:
+                            self._parts.append(future.result())
+                        self._pending = []
+                        self._upload.complete(self._parts)
+                except Exception:
+                    self._aborted = True
+                    self._upload.abort()
+                    raise
+        finally:
+            self._executor.shutdown(wait=False)
+            io.RawIOBase.close(self)
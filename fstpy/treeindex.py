@@ -0,0 +1,396 @@
+import os
+import io
+import mmap
+import json
+import math
+import time
+import struct
+import threading
+
+import fs
+import fs.errors
+import fs.path
+from fs.info import Info
+from fs.enums import ResourceType
+from pyftpdlib.log import logger
+
+from . import vpath
+
+
+MAGIC = b'FSTPYIX1'
+# magic, number of entries, offset of the path strings, build time
+_HEADER = struct.Struct('<8sQQd')
+# path offset and length, length of the parent path, is_dir, size,
+# modified (NaN if unknown), first child and number of children
+_ENTRY = struct.Struct('<QIIBqdII')
+
+
+def _key(path):
+    """The (parent, name) sort key of path; children of a directory
+    sort next to each other.
+    """
+    if path == '/':
+        return ('', '')
+    i = path.rindex('/')
+    return (path[:i] or '/', path[i + 1:])
+
+
+def write_snapshot(filename, records, built=None):
+    """Write a snapshot of the records, a dict of path: (is_dir, size,
+    modified) including the root "/", to filename, atomically.
+    """
+    paths = sorted(records, key=_key)
+    index = dict((path, i) for i, path in enumerate(paths))
+    children = [[0, 0] for _ in paths]
+    for i, path in enumerate(paths):
+        if path == '/':
+            continue
+        parent = children[index[_key(path)[0]]]
+        if not parent[1]:
+            parent[0] = i
+        parent[1] += 1
+    strings = io.BytesIO()
+    entries = io.BytesIO()
+    for i, path in enumerate(paths):
+        is_dir, size, modified = records[path]
+        encoded = path.encode('utf8')
+        parent_len = len(_key(path)[0].encode('utf8'))
+        entries.write(_ENTRY.pack(
+            strings.tell(), len(encoded), parent_len, bool(is_dir),
+            size or 0, float('nan') if modified is None else modified,
+            children[i][0], children[i][1]))
+        strings.write(encoded)
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, len(paths),
+                             _HEADER.size + entries.tell(),
+                             time.time() if built is None else built))
+        f.write(entries.getvalue())
+        f.write(strings.getvalue())
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, filename)
+
+
+class TreeSnapshot(object):
+    """A read-only, memory-mapped snapshot of a directory tree written
+    by write_snapshot(): paths, types, sizes and modification times.
+    The pages of the file are shared by all the processes mapping it.
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.entries, self._strings, self.built = \
+            _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            self._mm.close()
+            raise ValueError('%r is not a tree index' % filename)
+
+    def close(self):
+        self._mm.close()
+
+    def _entry(self, i):
+        return _ENTRY.unpack_from(self._mm, _HEADER.size + i * _ENTRY.size)
+
+    def _path(self, entry):
+        start = self._strings + entry[0]
+        return self._mm[start:start + entry[1]].decode('utf8')
+
+    def _find(self, path):
+        key = _key(path)
+        lo, hi = 0, self.entries
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = self._entry(mid)
+            if _key(self._path(entry)) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.entries:
+            entry = self._entry(lo)
+            if self._path(entry) == path:
+                return entry
+        raise fs.errors.ResourceNotFound(path)
+
+    def _info(self, entry, path=None):
+        if path is None:
+            path = self._path(entry)
+        name = path[entry[2]:].lstrip('/')
+        modified = entry[5]
+        return Info({
+            'basic': {'name': name, 'is_dir': bool(entry[3])},
+            'details': {
+                'size': entry[4],
+                'modified': None if math.isnan(modified) else modified,
+                'type': int(ResourceType.directory if entry[3]
+                            else ResourceType.file)},
+        })
+
+    def getinfo(self, path):
+        """Return the Info of path (with the basic and details
+        namespaces).
+        """
+        return self._info(self._find(path), path)
+
+    def scandir(self, path):
+        """Return the Info of the entries of directory path."""
+        entry = self._find(path)
+        if not entry[3]:
+            raise fs.errors.DirectoryExpected(path)
+        first = entry[6]
+        return [self._info(self._entry(i))
+                for i in range(first, first + entry[7])]
+
+    def records(self):
+        """Return all the entries as a dict of path: (is_dir, size,
+        modified), as taken by write_snapshot().
+        """
+        records = {}
+        for i in range(self.entries):
+            entry = self._entry(i)
+            modified = entry[5]
+            records[self._path(entry)] = (
+                bool(entry[3]), entry[4],
+                None if math.isnan(modified) else modified)
+        return records
+
+
+class SubtreeView(object):
+    """A directory of a TreeSnapshot seen as the root of its own tree
+    (e.g. the home of a user below the indexed filesystem).
+    """
+
+    def __init__(self, snapshot, root):
+        self.snapshot = snapshot
+        self.root = root
+
+    def _path(self, path):
+        return vpath.join(self.root, path.lstrip('/'))
+
+    def getinfo(self, path):
+        """Return the Info of path (see TreeSnapshot.getinfo())."""
+        try:
+            return self.snapshot.getinfo(self._path(path))
+        except fs.errors.ResourceNotFound:
+            raise fs.errors.ResourceNotFound(path)
+
+    def scandir(self, path):
+        """Return the Info of the entries of directory path."""
+        try:
+            return self.snapshot.scandir(self._path(path))
+        except fs.errors.ResourceNotFound:
+            raise fs.errors.ResourceNotFound(path)
+        except fs.errors.DirectoryExpected:
+            raise fs.errors.DirectoryExpected(path)
+
+
+def _record(info):
+    return (info.is_dir, info.get('details', 'size'),
+            info.get('details', 'modified'))
+
+
+def _walk(fs_obj, path, records):
+    """Add path and everything below it to records."""
+    records[path] = _record(fs_obj.getinfo(path, namespaces=['details']))
+    if records[path][0]:
+        for sub, info in fs_obj.walk.info(path, namespaces=['details']):
+            records[sub] = _record(info)
+
+
+class TreeIndex(object):
+    """A tree snapshot of the filesystem at url kept in filename, for
+    sessions to answer listings and stats without calling the
+    backend.
+    build() walks the whole backend; write events are recorded by
+    mark_dirty() (from any process) and refresh() applies them by
+    listing again the directories concerned only.  Readers pick up a
+    new snapshot at most check_interval seconds after it is written.
+     - (str) filename: where the snapshot is stored.
+     - (str) url: the URL of the indexed filesystem.
+    """
+
+    def __init__(self, filename, url, check_interval=5.0):
+        self.filename = filename
+        self.url = url
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._stat = None
+        self._checked = 0
+
+    def locate(self, url):
+        """Return the path on the indexed filesystem of the root of
+        the filesystem at url (e.g. "/alice" for "<url>/alice"), or
+        None if url is not the indexed filesystem or a directory of
+        it.
+        """
+        base = self.url.rstrip('/')
+        url = url.rstrip('/')
+        if url == base:
+            return '/'
+        if url.startswith(base + '/'):
+            return vpath.normpath(url[len(base):])
+        return None
+
+    def serves(self, url):
+        """Whether url is the indexed filesystem or a directory of
+        it.
+        """
+        return self.locate(url) is not None
+
+    @property
+    def dirty_filename(self):
+        return self.filename + '.dirty'
+
+    def snapshot(self):
+        """Return the current TreeSnapshot, or None if the index was
+        not built yet.
+        """
+        now = time.time()
+        if now - self._checked < self.check_interval:
+            return self._snapshot
+        with self._lock:
+            self._checked = now
+            try:
+                st = os.stat(self.filename)
+            except OSError:
+                return self._snapshot
+            stat = (st.st_ino, st.st_mtime, st.st_size)
+            if stat != self._stat:
+                # the previous snapshot is unmapped once the readers
+                # still using it are done
+                self._snapshot = TreeSnapshot(self.filename)
+                self._stat = stat
+            return self._snapshot
+
+    def mark_dirty(self, path, recursive=False):
+        """Record that path changed: its entries are listed again by
+        the next refresh(), recursively if recursive.
+        """
+        line = json.dumps([path, recursive]) + '\n'
+        # O_APPEND writes are not interleaved between processes
+        fd = os.open(self.dirty_filename,
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode('utf8'))
+        finally:
+            os.close(fd)
+
+    def build(self, fs_obj):
+        """Walk the whole fs_obj and write a new snapshot."""
+        started = time.time()
+        # marks made from now on are applied by the next refresh()
+        self._take_dirty()
+        records = {}
+        _walk(fs_obj, '/', records)
+        write_snapshot(self.filename, records, started)
+        logger.info('tree index of %s built: %d entries in %.1fs',
+                    self.url, len(records), time.time() - started)
+
+    def refresh(self, fs_obj):
+        """Apply the changes recorded by mark_dirty() since the last
+        build() or refresh(), building the index if there is none.
+        """
+        if not os.path.exists(self.filename):
+            return self.build(fs_obj)
+        dirty = self._take_dirty()
+        if not dirty:
+            return
+        snapshot = TreeSnapshot(self.filename)
+        try:
+            records = snapshot.records()
+        finally:
+            snapshot.close()
+        started = time.time()
+        for path, recursive in sorted(dirty):
+            self._update(fs_obj, records, path, recursive)
+        write_snapshot(self.filename, records, started)
+        logger.info('tree index of %s refreshed: %d paths listed again',
+                    self.url, len(dirty))
+
+    def schedule(self, interval, rebuild_interval=None, open_fs=fs.open_fs):
+        """Refresh the index every interval seconds in a daemon
+        thread, opening the filesystem with open_fs(url); with
+        rebuild_interval build it again from scratch that often, to
+        pick up the changes not made through the server.
+        """
+        def run():
+            fs_obj = open_fs(self.url)
+            built = time.time()
+            while True:
+                try:
+                    if rebuild_interval and \
+                            time.time() - built >= rebuild_interval:
+                        self.build(fs_obj)
+                        built = time.time()
+                    else:
+                        self.refresh(fs_obj)
+                except Exception:
+                    logger.exception('could not refresh the tree index '
+                                     'of %s', self.url)
+                time.sleep(interval)
+        thread = threading.Thread(target=run, name='tree-index')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _take_dirty(self):
+        """Return and forget the marks recorded so far."""
+        taken = '%s.%d' % (self.dirty_filename, os.getpid())
+        try:
+            os.rename(self.dirty_filename, taken)
+        except OSError:
+            return set()
+        dirty = set()
+        with open(taken) as f:
+            for line in f:
+                # the last line may have been cut by a crash
+                if line.endswith('\n'):
+                    path, recursive = json.loads(line)
+                    dirty.add((vpath.normpath(path), recursive))
+        os.remove(taken)
+        return dirty
+
+    def _update(self, fs_obj, records, path, recursive):
+        prefix = path.rstrip('/') + '/'
+        try:
+            info = fs_obj.getinfo(path, namespaces=['details'])
+        except fs.errors.ResourceNotFound:
+            info = None
+        old = records.get(path)
+        if info is None or recursive or old is None or \
+                old[0] != info.is_dir:
+            # gone, replaced or to be walked again: drop its subtree
+            for sub in [p for p in records if p.startswith(prefix)]:
+                del records[sub]
+            records.pop(path, None)
+            if info is not None:
+                _walk(fs_obj, path, records)
+                self._add_parents(fs_obj, records, path)
+            return
+        records[path] = _record(info)
+        if not info.is_dir:
+            return
+        # list the directory again, new subdirectories are walked
+        current = set()
+        for entry in fs_obj.scandir(path, namespaces=['details']):
+            sub = fs.path.join(path, entry.name)
+            current.add(sub)
+            known = records.get(sub)
+            if known is None or known[0] != entry.is_dir:
+                self._update(fs_obj, records, sub, True)
+            else:
+                records[sub] = _record(entry)
+        for sub in [p for p in records
+                    if p.startswith(prefix) and p not in current and
+                    '/' not in p[len(prefix):]]:
+            self._update(fs_obj, records, sub, True)
+
+    def _add_parents(self, fs_obj, records, path):
+        """Make sure the ancestors of a path in records are there."""
+        while path != '/':
+            path = fs.path.dirname(path)
+            if path in records:
+                return
+            _walk(fs_obj, path, records)
@@ -0,0 +1,66 @@
+"""Virtual path helpers.
+
+FTP paths and the paths of PyFilesystem2 backends are both virtual,
+"/" separated paths: they are normalized here as plain strings, never
+looking at (nor resolving the symlinks of) the local filesystem.
+"""
+
+
+def normpath(path):
+    """Normalize an absolute virtual path: collapse redundant
+    separators, "." and ".." components (".." never going above
+    "/") and drop the trailing separator.
+    >>> normpath('/a//b/./c/../d/')
+    '/a/b/d'
+    """
+    # most paths are normalized already
+    if '//' not in path and '/.' not in path and path[-1:] != '/':
+        return path
+    parts = []
+    for part in path.split('/'):
+        if part == '..':
+            if parts:
+                parts.pop()
+        elif part and part != '.':
+            parts.append(part)
+    return '/' + '/'.join(parts)
+
+
+def join(base, path):
+    """Normalize path relative to the absolute path base."""
+    if path[:1] == '/':
+        return normpath(path)
+    if not path:
+        return normpath(base)
+    return normpath(base + '/' + path)
+
+
+def is_within(root, path):
+    """Whether the normalized path root contains the normalized path
+    path (root itself included).
+    """
+    if root == '/':
+        return path[:1] == '/'
+    return path == root or path.startswith(root + '/')
+
+
+class PathMemo(object):
+    """A bounded memo of normalized paths, e.g. the paths of the
+    commands of a session relative to its current directory.
+     - (int) max_size: the memo is cleared once that large.
+    """
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._paths = {}
+
+    def join(self, base, path):
+        key = (base, path)
+        try:
+            return self._paths[key]
+        except KeyError:
+            pass
+        if len(self._paths) >= self.max_size:
+            self._paths.clear()
+        p = self._paths[key] = join(base, path)
+        return p
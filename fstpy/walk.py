@@ -0,0 +1,244 @@
+import queue
+import threading
+import collections
+import concurrent.futures
+
+import fs
+import fs.errors
+from fs.info import Info
+from fs.enums import ResourceType
+
+from .streams import delegate, fs_s3fs
+
+
+def _join(path, rel):
+    if not rel:
+        return path
+    return path.rstrip('/') + '/' + rel
+
+
+def _info(name, is_dir, size, modified):
+    return Info({
+        'basic': {'name': name, 'is_dir': is_dir},
+        'details': {
+            'size': size,
+            'modified': modified,
+            'type': int(ResourceType.directory if is_dir
+                        else ResourceType.file)},
+    })
+
+
+# --- Flat listings
+
+class _S3TreeLister(object):
+    """Lists everything below an S3FS directory with ListObjectsV2
+    requests without a delimiter: one request per page_size objects
+    whatever the shape of the tree, instead of one (or more) per
+    directory.  Keys come sorted, so the keys below a directory are
+    listed in a row: a directory is complete, and handed out, as soon
+    as a key out of it shows up.
+    """
+
+    page_size = 1000
+
+    def __init__(self, fs_obj):
+        self.client = fs_obj.client
+        self.bucket = fs_obj._bucket_name
+        self.path_to_dir_key = fs_obj._path_to_dir_key
+
+    def walk(self, path):
+        """Yield (dirpath, infos) for path and every directory below
+        it, dirpath relative to path ("" for path itself); directories
+        without a marker object are made up from the keys below them.
+        """
+        prefix = self.path_to_dir_key(path)
+        if prefix == '/':
+            prefix = ''
+        # the directories being listed, from path down to the one of
+        # the last key: [name, {name: info}]
+        stack = [[None, {}]]
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(
+                Bucket=self.bucket, Prefix=prefix,
+                PaginationConfig={'PageSize': self.page_size}):
+            for obj in page.get('Contents', ()):
+                rel = obj['Key'][len(prefix):]
+                if not rel:
+                    continue
+                parts = rel.split('/')
+                dirs, name = parts[:-1], parts[-1]
+                modified = obj['LastModified'].timestamp()
+                depth = 1
+                while depth < len(stack) and depth <= len(dirs) and \
+                        stack[depth][0] == dirs[depth - 1]:
+                    depth += 1
+                while len(stack) > depth:
+                    yield self._pop(stack)
+                for i in range(depth - 1, len(dirs)):
+                    entries = stack[-1][1]
+                    if dirs[i] not in entries:
+                        # the modification time of a directory is that
+                        # of its marker, if any
+                        entries[dirs[i]] = _info(
+                            dirs[i], True, 0,
+                            modified if i == len(dirs) - 1 and not name
+                            else None)
+                    stack.append([dirs[i], {}])
+                if name:
+                    stack[-1][1][name] = _info(name, False, obj['Size'],
+                                               modified)
+        while stack:
+            yield self._pop(stack)
+
+    def _pop(self, stack):
+        rel = '/'.join(name for name, _ in stack[1:])
+        entries = stack.pop()[1]
+        return rel, sorted(entries.values(), key=lambda info: info.name)
+
+
+def _s3_tree_lister(fs_obj):
+    if fs_s3fs is None or not isinstance(fs_obj, fs_s3fs.S3FS):
+        return None
+    return _S3TreeLister(fs_obj)
+
+
+# Factories called with a filesystem returning a tree lister (see
+# _S3TreeLister) for it, or None if the filesystem has no flat
+# listing. Append to this list to support other backends.
+tree_listers = [_s3_tree_lister]
+
+
+# --- Recursive listings
+
+class _TreeListing(object):
+    """The iterator returned by TreeWalker.walk(), yielding (dirpath,
+    infos) while the tree is still being listed by a background
+    thread, at most prefetch directories ahead.
+    The first directory is listed by the constructor, which raises the
+    errors of the backend (e.g. missing directory).
+    """
+
+    def __init__(self, walk, prefetch):
+        self._dirs = queue.Queue(max(prefetch, 1))
+        self._stop = threading.Event()
+        thread = threading.Thread(target=self._list, args=(walk,),
+                                  name='fstpy-walk')
+        thread.daemon = True
+        thread.start()
+        self.first = self._next()
+
+    def _next(self):
+        item = self._dirs.get()
+        if isinstance(item, Exception):
+            self.close()
+            raise item
+        return item
+
+    def close(self):
+        """Stop listing the backend."""
+        self._stop.set()
+
+    def __iter__(self):
+        try:
+            item = self.first
+            while item is not None:
+                yield item
+                item = self._next()
+        finally:
+            # the client may go away before the end of the listing
+            self.close()
+
+    def _list(self, walk):
+        def put(item):
+            while not self._stop.is_set():
+                try:
+                    self._dirs.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    pass
+
+        walker = walk()
+        try:
+            for item in walker:
+                if self._stop.is_set():
+                    return
+                put(item)
+            put(None)
+        except Exception as err:
+            put(err)
+        finally:
+            walker.close()
+
+
+class TreeWalker(object):
+    """Lists directory trees of a PyFilesystem2 filesystem, for
+    recursive listings.  Backends having a flat listing (see
+    tree_listers) list the whole tree at once; the others are walked
+    a directory at a time, up to workers directories being listed
+    concurrently.  Directories are handed out in no particular order,
+    each one as soon as it is listed, prefetch of them at most kept
+    ready ahead of the consumer.
+    """
+
+    def __init__(self, workers=8, prefetch=32):
+        self.workers = workers
+        self.prefetch = prefetch
+
+    def walk(self, fs_obj, path, namespaces=None, scandir=None):
+        """Return an iterator of (dirpath, infos) for the directory
+        path and every directory below it, dirpath relative to path
+        ("" for path itself) and infos the sorted fs.info.Info objects
+        of its entries; it has a close() method stopping the walk.
+         - (FS) fs_obj: the filesystem.
+         - (str) path: the directory.
+         - (list) namespaces: the info namespaces asked to scandir().
+         - (callable) scandir: lists a directory instead of
+           fs_obj.scandir() (e.g. TreeSnapshot.scandir).
+        """
+        if scandir is None:
+            if not fs_obj.getinfo(path).is_dir:
+                raise fs.errors.DirectoryExpected(path)
+            inner, inner_path = delegate(fs_obj, path)
+            for factory in tree_listers:
+                lister = factory(inner)
+                if lister is not None:
+                    return _TreeListing(
+                        lambda: lister.walk(inner_path), self.prefetch)
+
+            def scandir(path):
+                return fs_obj.scandir(path, namespaces=namespaces)
+        return _TreeListing(lambda: self._walk(scandir, path),
+                            self.prefetch)
+
+    def _walk(self, scandir, path):
+        todo = collections.deque([''])
+        # future: directory being listed
+        pending = {}
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            try:
+                while todo or pending:
+                    while todo and len(pending) < self.workers:
+                        rel = todo.popleft()
+                        pending[executor.submit(
+                            lambda rel: list(scandir(_join(path, rel))),
+                            rel)] = rel
+                    finished, _ = concurrent.futures.wait(
+                        pending,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in finished:
+                        rel = pending.pop(future)
+                        try:
+                            infos = future.result()
+                        except fs.errors.ResourceNotFound:
+                            # removed since its parent was listed
+                            if not rel:
+                                raise
+                            continue
+                        infos.sort(key=lambda info: info.name)
+                        todo.extend(rel + '/' + info.name if rel
+                                    else info.name
+                                    for info in infos if info.is_dir)
+                        yield rel, infos
+            finally:
+                for future in pending:
+                    future.cancel()
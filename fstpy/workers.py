@@ -0,0 +1,149 @@
+import socket
+import threading
+import collections
+import concurrent.futures
+
+
+class _Waker(object):
+    """A socket pair registered with an IOLoop, used by worker threads
+    to have callbacks run by the thread serving the IOLoop.
+    """
+
+    def __init__(self, ioloop):
+        self.ioloop = ioloop
+        self._reader, self._writer = socket.socketpair()
+        self._reader.setblocking(False)
+        self._writer.setblocking(False)
+        self._callbacks = collections.deque()
+        self._fileno = self._reader.fileno()
+        ioloop.register(self._fileno, self, ioloop.READ)
+
+    def call_soon(self, callback, *args):
+        """Schedule callback(*args); safe to call from any thread."""
+        self._callbacks.append((callback, args))
+        try:
+            self._writer.send(b'x')
+        except (BlockingIOError, OSError):
+            # the buffer is full: the IOLoop already has a wake up
+            # pending
+            pass
+
+    # --- IOLoop interface
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read_event(self):
+        try:
+            while self._reader.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+        while self._callbacks:
+            callback, args = self._callbacks.popleft()
+            callback(*args)
+
+    def handle_write_event(self):
+        pass
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        raise
+
+    def close(self):
+        self.ioloop.unregister(self._fileno)
+        self._reader.close()
+        self._writer.close()
+
+
+class BackendExecutor(object):
+    """Runs blocking backend calls on a bounded thread pool and hands
+    their outcome back to the thread serving an IOLoop, so that a slow
+    call (e.g. an S3 listing) does not stall the other sessions served
+    by the same IOLoop.
+    Use BackendExecutor.get() to obtain the executor of an IOLoop.
+    """
+
+    _instances = {}
+    _lock = threading.Lock()
+
+    def __init__(self, ioloop, max_workers):
+        self.ioloop = ioloop
+        self.max_workers = max_workers
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self._waker = _Waker(ioloop)
+
+    @classmethod
+    def get(cls, ioloop, max_workers):
+        """Return the executor of ioloop, creating it if needed."""
+        with cls._lock:
+            executor = cls._instances.get(ioloop)
+            if executor is None:
+                executor = cls(ioloop, max_workers)
+                cls._instances[ioloop] = executor
+            return executor
+
+    def submit(self, func, callback, *args):
+        """Run func(*args) in a worker thread, then callback(exc,
+        *args) in the IOLoop thread, exc being the exception raised by
+        func or None.
+        """
+        def run():
+            try:
+                func(*args)
+            except Exception as err:
+                exc = err
+            else:
+                exc = None
+            self._waker.call_soon(callback, exc, *args)
+        return self._executor.submit(run)
+
+    def shutdown(self):
+        with self._lock:
+            self._instances.pop(self.ioloop, None)
+        self._executor.shutdown(wait=False)
+        self._waker.close()
+
+
+class PendingCall(object):
+    """A callback a worker thread will have run by the thread serving
+    an IOLoop, e.g. once a background job started by a session is
+    done.  Until it ran the IOLoop keeps a socket registered, so that
+    a per-connection IOLoop (threaded and multiprocess servers) does
+    not stop before, even if its connection was closed.
+    """
+
+    # ioloop: [_Waker, number of pending calls]
+    _wakers = {}
+    _lock = threading.Lock()
+
+    def __init__(self, ioloop):
+        self.ioloop = ioloop
+        with self._lock:
+            waker = self._wakers.get(ioloop)
+            if waker is None:
+                waker = self._wakers[ioloop] = [_Waker(ioloop), 0]
+            waker[1] += 1
+        self._waker = waker[0]
+
+    def __call__(self, callback, *args):
+        """Have callback(*args) run in the IOLoop thread; to be called
+        once, from any thread.
+        """
+        self._waker.call_soon(self._run, callback, args)
+
+    def _run(self, callback, args):
+        try:
+            callback(*args)
+        finally:
+            with self._lock:
+                waker = self._wakers[self.ioloop]
+                waker[1] -= 1
+                if not waker[1]:
+                    del self._wakers[self.ioloop]
+                    waker[0].close()
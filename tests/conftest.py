@@ -0,0 +1,55 @@
+import ftplib
+import threading
+
+import pytest
+from pyftpdlib.servers import FTPServer
+
+from fstpy.authorizers import DummyAuthorizer
+from fstpy.handlers import FTPHandler
+
+
+@pytest.fixture(params=[0, 4], ids=['inline', 'backend_workers'])
+def ftp_server(request, tmp_path):
+    """Start a server on a local directory; yield a function taking
+    handler attributes and returning a logged in ftplib.FTP client.
+    """
+    root = tmp_path / 'root'
+    root.mkdir()
+    servers = []
+    clients = []
+    stop = threading.Event()
+
+    def serve(server):
+        # the IOLoop is closed by the thread serving it, not while it
+        # polls
+        while not stop.is_set():
+            server.serve_forever(timeout=0.1, blocking=False,
+                                 handle_exit=False)
+        server.close_all()
+
+    def connect(**attrs):
+        authorizer = DummyAuthorizer('osfs://%s' % root)
+        authorizer.add_user('user', 'pass', '/', perm='elradfmwMT')
+        attrs.setdefault('backend_workers', request.param)
+        handler = type('Handler', (FTPHandler,),
+                       dict(attrs, authorizer=authorizer))
+        server = FTPServer(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=serve, args=(server,),
+                                  name='ftp-server')
+        thread.daemon = True
+        thread.start()
+        servers.append((server, thread))
+        client = ftplib.FTP(timeout=10)
+        client.connect(*server.address)
+        client.login('user', 'pass')
+        clients.append(client)
+        return client
+
+    connect.root = root
+    connect.backend_workers = request.param
+    yield connect
+    for client in clients:
+        client.close()
+    stop.set()
+    for server, thread in servers:
+        thread.join(5)
@@ -0,0 +1,156 @@
+import os
+import time
+
+import pytest
+from pyftpdlib.authorizers import AuthenticationFailed
+
+from fstpy.authorizers import DummyAuthorizer
+
+
+@pytest.fixture
+def authorizer(tmp_path):
+    (tmp_path / 'incoming' / 'sub').mkdir(parents=True)
+    (tmp_path / 'incoming' / 'file.txt').write_text('x')
+    (tmp_path / 'tree' / 'sub').mkdir(parents=True)
+    authorizer = DummyAuthorizer('osfs://%s' % tmp_path)
+    authorizer.add_user('user', 'pass', '/', perm='elr')
+    return authorizer
+
+
+@pytest.mark.parametrize('perm', 'dflw')
+def test_non_recursive_override_applies_to_files(authorizer, perm):
+    authorizer.override_perm('user', '/incoming', 'elrdfw', recursive=False)
+    assert authorizer.has_perm('user', perm, '/incoming')
+    assert authorizer.has_perm('user', perm, '/incoming/file.txt')
+    # files about to be created are not directories either
+    assert authorizer.has_perm('user', perm, '/incoming/new.txt')
+
+
+@pytest.mark.parametrize('perm', 'dflw')
+def test_non_recursive_override_skips_subdirectories(authorizer, perm):
+    authorizer.override_perm('user', '/incoming', 'elrdfw', recursive=False)
+    expected = perm in 'elr'
+    assert authorizer.has_perm('user', perm, '/incoming/sub') == expected
+    assert authorizer.has_perm('user', perm,
+                               '/incoming/sub/file.txt') == expected
+
+
+@pytest.mark.parametrize('perm', 'dflw')
+def test_non_recursive_override_can_take_perms_away(authorizer, perm):
+    authorizer.override_perm('user', '/incoming', 'e', recursive=False)
+    assert not authorizer.has_perm('user', perm, '/incoming/file.txt')
+    assert authorizer.has_perm('user', perm, '/incoming/sub') == \
+        (perm in 'elr')
+
+
+def test_non_recursive_override_follows_type_changes(authorizer, tmp_path):
+    authorizer.override_perm('user', '/incoming', 'elrd', recursive=False)
+    assert not authorizer.has_perm('user', 'd', '/incoming/sub')
+    (tmp_path / 'incoming' / 'sub').rmdir()
+    (tmp_path / 'incoming' / 'sub').write_text('x')
+    # as sessions do once they wrote to a path
+    authorizer.invalidate_path('user', '/incoming/sub')
+    assert authorizer.has_perm('user', 'd', '/incoming/sub')
+
+
+def test_non_recursive_override_remembers_types(authorizer, monkeypatch):
+    authorizer.override_perm('user', '/incoming', 'elrd', recursive=False)
+    calls = []
+    isdir = authorizer.fs.isdir
+
+    def counting_isdir(path):
+        calls.append(path)
+        return isdir(path)
+
+    monkeypatch.setattr(authorizer.fs, 'isdir', counting_isdir)
+    for perm in 'dlw':
+        authorizer.has_perm('user', perm, '/incoming/file.txt')
+        authorizer.has_perm('user', perm, '/incoming/sub')
+    assert sorted(calls) == ['/incoming/file.txt', '/incoming/sub']
+    # expired
+    now = time.time()
+    monkeypatch.setattr(time, 'time',
+                        lambda: now + authorizer.isdir_ttl + 1)
+    authorizer.has_perm('user', 'd', '/incoming/sub')
+    assert len(calls) == 3
+
+
+@pytest.mark.parametrize('perm', 'dflw')
+def test_recursive_override(authorizer, perm):
+    authorizer.override_perm('user', '/tree', 'elrdfw', recursive=True)
+    assert authorizer.has_perm('user', perm, '/tree/sub')
+    assert authorizer.has_perm('user', perm, '/tree/sub/deep/file.txt')
+    assert authorizer.has_perm('user', perm, '/other') == (perm in 'elr')
+
+
+def test_first_override_wins(authorizer):
+    authorizer.override_perm('user', '/tree', 'elr', recursive=True)
+    authorizer.override_perm('user', '/tree/sub', 'elrdw', recursive=True)
+    assert not authorizer.has_perm('user', 'd', '/tree/sub/file.txt')
+
+
+def test_has_tree_perm(authorizer):
+    authorizer.override_perm('user', '/tree', 'elrd', recursive=True)
+    authorizer.override_perm('user', '/tree/sub', 'elr', recursive=True)
+    assert authorizer.has_perm('user', 'd', '/tree')
+    assert not authorizer.has_tree_perm('user', 'd', '/tree')
+
+
+def test_has_tree_perm_of_non_recursive_override(authorizer):
+    authorizer.override_perm('user', '/incoming', 'elrd', recursive=False)
+    assert authorizer.has_perm('user', 'd', '/incoming')
+    assert not authorizer.has_perm('user', 'd', '/incoming/sub/file.txt')
+    assert not authorizer.has_tree_perm('user', 'd', '/incoming')
+
+
+def test_has_tree_perm_below_non_recursive_override(authorizer):
+    authorizer.override_perm('user', '/incoming', 'elrd', recursive=False)
+    authorizer.override_perm('user', '/incoming/sub', 'elrd',
+                             recursive=True)
+    # other subdirectories of /incoming only have the user's perms
+    assert not authorizer.has_tree_perm('user', 'd', '/incoming')
+    assert authorizer.has_tree_perm('user', 'd', '/incoming/sub')
+    assert not authorizer.has_tree_perm('user', 'd', '/tree')
+
+
+def test_has_tree_perm_of_recursive_override(authorizer):
+    authorizer.override_perm('user', '/tree', 'elrd', recursive=True)
+    assert authorizer.has_tree_perm('user', 'd', '/tree')
+    assert authorizer.has_tree_perm('user', 'd', '/tree/sub')
+    assert not authorizer.has_tree_perm('user', 'd', '/')
+
+
+def test_has_tree_perm_override_taking_perm_away_below(authorizer):
+    authorizer.add_user('writer', 'pass', '/', perm='elrd')
+    authorizer.override_perm('writer', '/tree/sub', 'elr', recursive=False)
+    assert authorizer.has_tree_perm('writer', 'd', '/incoming')
+    assert not authorizer.has_tree_perm('writer', 'd', '/tree')
+    assert not authorizer.has_tree_perm('writer', 'd', '/')
+
+
+def test_user_removed_from_the_store_is_revoked(tmp_path):
+    (tmp_path / 'home').mkdir()
+    credentials = tmp_path / 'credentials.txt'
+    credentials.write_text('alice;secret;/home;elrw\n')
+    authorizer = DummyAuthorizer('osfs://%s' % tmp_path,
+                                 str(credentials))
+    authorizer.store.reload_interval = 0
+    authorizer.validate_authentication('alice', 'secret', None)
+    assert authorizer.has_perm('alice', 'w', '/file')
+
+    credentials.write_text('bob;secret;/home\n')
+    os.utime(str(credentials), (2000, 2000))
+    with pytest.raises(AuthenticationFailed):
+        authorizer.validate_authentication('alice', 'secret', None)
+    # the sessions still open are denied everything
+    assert not authorizer.has_user('alice')
+    assert not authorizer.has_perm('alice', 'r', '/file')
+    assert not authorizer.has_perm('alice', 'r')
+    assert authorizer.get_perms('alice') == ''
+    assert authorizer.is_read_only('alice')
+
+    credentials.write_text('alice;secret;/home;elr\n')
+    os.utime(str(credentials), (3000, 3000))
+    authorizer.validate_authentication('alice', 'secret', None)
+    assert authorizer.has_perm('alice', 'r', '/file')
+    assert not authorizer.has_perm('alice', 'w', '/file')
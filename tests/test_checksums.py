@@ -0,0 +1,44 @@
+import io
+import hashlib
+import threading
+
+import pytest
+
+from fstpy.checksums import ChecksumIndex
+from fstpy.filesystems import AbstractedFS
+
+
+@pytest.fixture
+def checksum_index(tmp_path, monkeypatch):
+    index = ChecksumIndex(str(tmp_path / 'checksums.db'))
+    forgotten = []
+    forget = index.forget
+
+    def recording_forget(url, path, tree=False):
+        forgotten.append((path, threading.current_thread().name))
+        forget(url, path, tree)
+
+    monkeypatch.setattr(index, 'forget', recording_forget)
+    monkeypatch.setattr(AbstractedFS, 'checksum_index', index)
+    index.forgotten = forgotten
+    return index
+
+
+def test_uploads_are_hashed_and_forgotten_off_the_ioloop(ftp_server,
+                                                         checksum_index):
+    client = ftp_server()
+    data = b'x' * 100000
+    for _ in range(2):
+        client.storbinary('STOR file.bin', io.BytesIO(data))
+        resp = client.sendcmd('HASH file.bin')
+        assert hashlib.sha256(data).hexdigest() in resp.lower()
+    data = b'y' * 10
+    client.storbinary('STOR file.bin', io.BytesIO(data))
+    resp = client.sendcmd('HASH file.bin')
+    assert hashlib.sha256(data).hexdigest() in resp.lower()
+    threads = set(name for path, name in checksum_index.forgotten
+                  if path == '/file.bin')
+    if ftp_server.backend_workers:
+        assert threads and 'ftp-server' not in threads
+    else:
+        assert threads == set(['ftp-server'])
@@ -0,0 +1,206 @@
+import threading
+
+import pytest
+
+from fstpy.authorizers import DummyAuthorizer
+from fstpy.filesystems import AbstractedFS
+from fstpy.handlers import FTPHandler
+
+
+class Channel(object):
+
+    def __init__(self, authorizer, username):
+        self.authorizer = authorizer
+        self.username = username
+
+
+@pytest.fixture
+def session(tmp_path):
+    root = tmp_path / 'root'
+    root.mkdir()
+    (root / 'file.bin').write_bytes(b'data')
+    authorizer = DummyAuthorizer('osfs://%s' % root)
+    authorizer.add_user('user', 'pass', '/', perm='elradfmw')
+    fs_obj = AbstractedFS(authorizer.get_home_dir('user'),
+                          Channel(authorizer, 'user'))
+    fs_obj.root_dir = root
+    return fs_obj
+
+
+def test_precomputed_outcome_used_once(session, monkeypatch):
+    path = session.ftp2fs('/file.bin')
+    session.precompute('open', path, 'rb')
+    opened = []
+    original = AbstractedFS._open_for_reading
+    monkeypatch.setattr(AbstractedFS, '_open_for_reading',
+                        lambda self, *args: opened.append(args) or
+                        original(self, *args))
+    f = session.open(path, 'rb')
+    assert f.read() == b'data'
+    f.close()
+    assert opened == []
+    # only the first call gets the precomputed file
+    f = session.open(path, 'rb')
+    assert f.read() == b'data'
+    f.close()
+    assert opened == [(path, 'rb')]
+
+
+def test_precomputed_error(session):
+    path = session.ftp2fs('/missing')
+    session.precompute('remove', path)
+    (session.root_dir / 'missing').write_bytes(b'')
+    # the outcome of the call made in advance
+    with pytest.raises(Exception):
+        session.remove(path)
+    assert (session.root_dir / 'missing').exists()
+    session.remove(path)
+    assert not (session.root_dir / 'missing').exists()
+
+
+def test_discard_precomputed(session):
+    path = session.ftp2fs('/file.bin')
+    session.precompute('open', path, 'rb')
+    f = session._precomputed[('open', path, 'rb')][0]
+    session.precompute('mkdir', session.ftp2fs('/new'))
+    session.discard_precomputed()
+    assert f.closed
+    assert session._precomputed == {}
+    # done is done: the directory was made
+    assert (session.root_dir / 'new').is_dir()
+
+
+class Gate(object):
+    """Holds the commands prepared by the backend workers until
+    allowed, recording them.
+    """
+
+    def __init__(self):
+        self.prepared = []
+        self.entered = threading.Event()
+        self.allowed = threading.Event()
+        self.allowed.set()
+
+    def close(self):
+        self.entered.clear()
+        self.allowed.clear()
+
+
+@pytest.fixture
+def gate(ftp_server, monkeypatch):
+    gate = Gate()
+    original = FTPHandler._prepare_command
+
+    def _prepare_command(self, fs, cmd, args, kwargs):
+        gate.prepared.append((cmd, threading.current_thread().name))
+        gate.entered.set()
+        gate.allowed.wait(5)
+        return original(self, fs, cmd, args, kwargs)
+    monkeypatch.setattr(FTPHandler, '_prepare_command', _prepare_command)
+    (ftp_server.root / 'file.bin').write_bytes(b'data')
+    yield gate
+    gate.allowed.set()
+
+
+def send(client, *lines):
+    client.sock.sendall(''.join(line + '\r\n' for line in lines).encode())
+
+
+def preparing(ftp_server):
+    if not ftp_server.backend_workers:
+        pytest.skip('commands are only prepared by backend workers')
+
+
+def test_commands_prepared_by_workers(ftp_server, gate):
+    client = ftp_server()
+    client.voidcmd('TYPE I')
+    assert client.size('file.bin') == 4
+    if ftp_server.backend_workers:
+        assert [cmd for cmd, thread in gate.prepared] == ['PASS', 'SIZE']
+        assert 'ftp-server' not in [thread for cmd, thread in gate.prepared]
+    else:
+        assert gate.prepared == []
+
+
+def test_queued_commands_keep_their_order(ftp_server, gate):
+    client = ftp_server()
+    client.voidcmd('TYPE I')
+    gate.close()
+    send(client, 'SIZE file.bin', 'NOOP', 'PWD', 'SIZE missing', 'TYPE A')
+    if ftp_server.backend_workers:
+        assert gate.entered.wait(5)
+    gate.allowed.set()
+    assert client.getline() == '213 4'
+    assert client.getline().startswith('200 ')
+    assert client.getline().startswith('257 "/"')
+    assert client.getline().startswith('550 ')
+    assert client.getline().startswith('200 ')
+
+
+def test_abor_while_preparing(ftp_server, gate, monkeypatch):
+    preparing(ftp_server)
+    discarded = []
+    original = AbstractedFS.discard_precomputed
+
+    def discard_precomputed(self):
+        discarded.extend(self._precomputed)
+        original(self)
+    monkeypatch.setattr(AbstractedFS, 'discard_precomputed',
+                        discard_precomputed)
+    client = ftp_server()
+    client.makepasv()
+    gate.close()
+    send(client, 'RETR file.bin')
+    assert gate.entered.wait(5)
+    send(client, 'ABOR')
+    # answered while RETR is still being prepared
+    assert client.getline() == '426 Command aborted via ABOR.'
+    assert client.getline().startswith('225 ')
+    gate.allowed.set()
+    # RETR was not run and the file opened for it was closed
+    assert client.voidcmd('NOOP').startswith('200 ')
+    assert discarded == [('open', '/file.bin', 'rb')]
+
+
+def test_quit_while_preparing(ftp_server, gate):
+    preparing(ftp_server)
+    client = ftp_server()
+    client.voidcmd('TYPE I')
+    gate.close()
+    send(client, 'SIZE file.bin', 'NOOP')
+    assert gate.entered.wait(5)
+    send(client, 'QUIT')
+    assert client.getline().startswith('221 ')
+    gate.allowed.set()
+    # neither SIZE nor NOOP are answered
+    assert client.file.readline() == ''
+
+
+def test_stat_while_preparing(ftp_server, gate):
+    preparing(ftp_server)
+    client = ftp_server()
+    client.voidcmd('TYPE I')
+    gate.close()
+    send(client, 'SIZE file.bin')
+    assert gate.entered.wait(5)
+    send(client, 'STAT')
+    assert client.getmultiline().startswith('211-')
+    gate.allowed.set()
+    assert client.getline() == '213 4'
+
+
+def test_stat_during_transfer(ftp_server, gate):
+    with open(str(ftp_server.root / 'big.bin'), 'wb') as f:
+        f.truncate(64 * 1024 * 1024)
+    client = ftp_server()
+    client.voidcmd('TYPE I')
+    conn = client.transfercmd('RETR big.bin')
+    try:
+        assert conn.recv(65536)
+        del gate.prepared[:]
+        send(client, 'STAT /')
+        assert client.getmultiline().startswith('213-')
+        assert gate.prepared == []
+    finally:
+        conn.close()
+    assert client.getline()[:3] in ('226', '426')
@@ -0,0 +1,83 @@
+import os
+
+import pytest
+
+from fstpy.credentials import (SQLiteCredentialStore, TextCredentialStore,
+                               hash_password, open_store, verify_password)
+
+
+def write(path, text, mtime):
+    path.write_text(text)
+    os.utime(str(path), (mtime, mtime))
+
+
+@pytest.fixture
+def store(tmp_path):
+    path = tmp_path / 'credentials.txt'
+    write(path, 'alice;secret;/alice;elrw\n'
+                '# comment\n'
+                '\n'
+                'bob;pw;/bob\n', 1000)
+    store = TextCredentialStore(str(path))
+    store.reload_interval = 0
+    store.path_obj = path
+    return store
+
+
+def test_parse(store):
+    alice = store.get('alice')
+    assert (alice.password, alice.homedir, alice.perm) == \
+        ('secret', '/alice', 'elrw')
+    # optional fields
+    assert store.get('bob').perm == 'elr'
+    assert store.get('carol') is None
+
+
+def test_reload_on_change(store):
+    write(store.path_obj, 'carol;pw;/carol\n', 2000)
+    assert store.get('carol') is not None
+    assert store.get('alice') is None
+
+
+@pytest.mark.parametrize('line', [
+    'mallory', 'mallory;pw', 'mallory;pw;/m;elr;hi;bye;extra', ';pw;/m'])
+def test_malformed_lines_are_skipped(store, line):
+    write(store.path_obj, 'alice;secret;/alice\n%s\nbob;pw;/bob\n' % line,
+          2000)
+    assert store.get('alice') is not None
+    assert store.get('bob') is not None
+    assert store.get('mallory') is None
+
+
+def test_malformed_file_at_startup(tmp_path):
+    path = tmp_path / 'credentials.txt'
+    path.write_text('nonsense\nalice;secret;/alice\n')
+    assert TextCredentialStore(str(path)).get('alice') is not None
+
+
+def test_unreadable_file_keeps_the_last_version(store):
+    store.path_obj.write_bytes(b'alice;\xff\xfe;/alice\n')
+    os.utime(str(store.path_obj), (2000, 2000))
+    assert store.get('alice').password == 'secret'
+    store.path_obj.unlink()
+    assert store.get('bob') is not None
+
+
+def test_sqlite_store(tmp_path):
+    store = open_store(str(tmp_path / 'users.db'))
+    assert isinstance(store, SQLiteCredentialStore)
+    text = tmp_path / 'credentials.txt'
+    text.write_text('alice;secret;/alice\nbroken\n')
+    store.import_text(str(text))
+    assert store.get('alice').homedir == '/alice'
+    store.delete('alice')
+    assert store.get('alice') is None
+
+
+def test_passwords():
+    stored = hash_password('secret', n=2 ** 4)
+    assert verify_password('secret', stored)
+    assert not verify_password('wrong', stored)
+    assert verify_password('secret', 'secret')
+    assert verify_password('secret', '5ebe2294ecd0e0f08eab7690d2a6ee69',
+                           legacy='md5')
@@ -0,0 +1,200 @@
+import io
+import threading
+import time
+
+import pytest
+
+from fstpy import filesystems, streams
+from fstpy.filesystems import AbstractedFS
+from fstpy.streams import ByteBudget, RangedReader
+
+
+CONTENT = bytes(bytearray(i % 251 for i in range(10500)))
+
+
+@pytest.fixture
+def fetches(ftp_server, monkeypatch):
+    """Serve files through RangedReader reading 1000 bytes chunks of
+    the local files; return the list of (offset, length) fetched.
+    """
+    fetches = []
+    lock = threading.Lock()
+
+    def factory(fs_obj, path):
+        def fetch(offset, length):
+            with lock:
+                fetches.append((offset, length))
+            with fs_obj.openbin(path) as f:
+                f.seek(offset)
+                return f.read(length)
+        return fetch
+
+    # not a sendfile() of the local file
+    monkeypatch.setattr(filesystems, 'syspath', lambda fs_obj, path: None)
+    monkeypatch.setattr(streams, 'range_fetchers', [factory])
+    monkeypatch.setattr(AbstractedFS, 'read_chunk_size', 1000)
+    (ftp_server.root / 'file.bin').write_bytes(CONTENT)
+    return fetches
+
+
+def retr(client, rest=None):
+    buf = io.BytesIO()
+    client.retrbinary('RETR file.bin', buf.write, rest=rest)
+    return buf.getvalue()
+
+
+def test_retr(ftp_server, fetches):
+    client = ftp_server()
+    assert retr(client) == CONTENT
+    assert sorted(fetches) == [(i * 1000, 1000) for i in range(10)] + \
+        [(10000, 500)]
+
+
+@pytest.mark.parametrize('rest', [5500, 6000, 10499])
+def test_retr_rest(ftp_server, fetches, rest):
+    client = ftp_server()
+    assert retr(client, rest) == CONTENT[rest:]
+    # the first request starts with the chunk holding the offset, and
+    # nothing before it is read
+    first = rest // 1000 * 1000
+    assert fetches[0][0] == first
+    assert min(offset for offset, length in fetches) == first
+    assert sum(length for offset, length in fetches) == len(CONTENT) - first
+
+
+def test_retr_rest_at_end(ftp_server, fetches):
+    client = ftp_server()
+    assert retr(client, len(CONTENT)) == b''
+    assert fetches == []
+
+
+def test_retr_after_rest_reset(ftp_server, fetches):
+    client = ftp_server()
+    assert retr(client, 8000) == CONTENT[8000:]
+    del fetches[:]
+    # the REST offset only applies to the next transfer
+    assert retr(client) == CONTENT
+    assert fetches[0] == (0, 1000)
+
+
+def test_ranged_reads_disabled(ftp_server, fetches, monkeypatch):
+    monkeypatch.setattr(AbstractedFS, 'ranged_reads', False)
+    client = ftp_server()
+    assert retr(client, 5500) == CONTENT[5500:]
+    assert fetches == []
+
+
+def reader(fetches, read_ahead=0, size=len(CONTENT), data=CONTENT):
+    def fetch(offset, length):
+        fetches.append((offset, length))
+        return data[offset:offset + length]
+    return RangedReader(fetch, size, '/file.bin', 1000, read_ahead)
+
+
+def test_seek_does_not_fetch():
+    fetches = []
+    f = reader(fetches)
+    assert f.seek(4321) == 4321
+    assert f.seek(-500, io.SEEK_END) == 10000
+    assert f.seek(-1, io.SEEK_CUR) == 9999
+    assert fetches == []
+    assert f.read(3) == CONTENT[9999:10002]
+    assert fetches == [(9000, 1000), (10000, 500)]
+    with pytest.raises(ValueError):
+        f.seek(-1)
+    f.close()
+
+
+def test_read_across_chunks():
+    fetches = []
+    f = reader(fetches)
+    f.seek(999)
+    assert f.read(1002) == CONTENT[999:2001]
+    assert f.read() == CONTENT[2001:]
+    assert f.read() == b''
+    assert fetches == [(i * 1000, 1000) for i in range(10)] + [(10000, 500)]
+    f.close()
+    with pytest.raises(ValueError):
+        f.read()
+
+
+def test_read_shorter_file():
+    # the remote file is shorter than the size it was opened with
+    fetches = []
+    f = reader(fetches, data=CONTENT[:1500])
+    assert f.read() == CONTENT[:1500]
+    f.close()
+
+
+def test_byte_budget():
+    budget = ByteBudget(1000)
+    assert budget.try_acquire(600)
+    assert not budget.try_acquire(600)
+    budget.acquire(600)
+    assert budget.used == 1200
+    budget.release(1200)
+    assert budget.try_acquire(1000)
+
+
+def gated_reader(fetches, budgets):
+    """A reader with read_ahead 4 whose first request only completes
+    once the reader has waited for it.
+    """
+    gate = threading.Event()
+
+    def fetch(offset, length):
+        fetches.append((offset, length))
+        if offset == 0:
+            gate.wait(5)
+        return CONTENT[offset:offset + length]
+    threading.Timer(0.2, gate.set).start()
+    return RangedReader(fetch, len(CONTENT), '/file.bin', 1000, 4, budgets)
+
+
+def test_prefetch_within_budgets():
+    fetches = []
+    session, process = ByteBudget(10000), ByteBudget(10000)
+    f = gated_reader(fetches, (session, process))
+    assert f.read(10) == CONTENT[:10]
+    # the reader had to wait: the window grew to two chunks ahead
+    assert sorted(fetches) == [(0, 1000), (1000, 1000), (2000, 1000)]
+    assert session.used == process.used == 3000
+    f.close()
+    assert session.used == process.used == 0
+
+
+def test_prefetch_over_budget():
+    fetches = []
+    session, process = ByteBudget(1500), ByteBudget(10000)
+    f = gated_reader(fetches, (session, process))
+    # the chunk read is fetched regardless, the next one is not
+    # affordable in the session budget, nor reserved in the other
+    assert f.read(10) == CONTENT[:10]
+    assert fetches == [(0, 1000)]
+    assert session.used == process.used == 1000
+    f.close()
+    assert session.used == process.used == 0
+
+
+def test_read_without_budget():
+    fetches = []
+    budget = ByteBudget(0)
+    f = gated_reader(fetches, (budget,))
+    assert f.read() == CONTENT
+    assert fetches == [(i * 1000, 1000) for i in range(10)] + [(10000, 500)]
+    assert budget.used == 500
+    f.close()
+    assert budget.used == 0
+
+
+def test_budget_released_after_retr(ftp_server, fetches, monkeypatch):
+    budget = ByteBudget(3000)
+    monkeypatch.setattr(AbstractedFS, 'read_budget', budget)
+    client = ftp_server()
+    assert retr(client) == CONTENT
+    assert retr(client, 2500) == CONTENT[2500:]
+    client.voidcmd('NOOP')
+    deadline = time.time() + 5
+    while budget.used and time.time() < deadline:
+        time.sleep(0.01)
+    assert budget.used == 0
@@ -0,0 +1,182 @@
+import io
+import os
+import queue
+import socket
+import threading
+
+import pytest
+
+from fstpy.events import EventPublisher, ZMQForwarder, format_event
+
+
+class Sender(object):
+    """A send(messages) callable recording the batches sent, each call
+    blocking until allowed.
+    """
+
+    def __init__(self):
+        self.batches = []
+        self.entered = queue.Queue()
+        self.allowed = threading.Semaphore(0)
+
+    def __call__(self, messages):
+        self.batches.append(list(messages))
+        self.entered.put(messages)
+        assert self.allowed.acquire(timeout=5)
+
+    @property
+    def messages(self):
+        return [m for batch in self.batches for m in batch]
+
+
+def publisher(tmp_path, overflow, max_queue=2):
+    sender = Sender()
+    pub = EventPublisher(sender, max_queue=max_queue, overflow=overflow,
+                         spill_dir=str(tmp_path),
+                         formatter=lambda event, fields: event)
+    return pub, sender
+
+
+def close(pub, sender):
+    sender.allowed.release(100)
+    pub.close()
+
+
+def test_format_event():
+    assert format_event('received', {'file': '/chan/a/b.txt'}) == \
+        'chan /chan/a/b.txt'
+    assert format_event('login', {'user': 'u', 'ip': '1.2.3.4'}) == \
+        'fstpy.login {"ip": "1.2.3.4", "user": "u"}'
+
+
+def test_invalid_overflow():
+    with pytest.raises(ValueError):
+        EventPublisher(lambda messages: None, overflow='block')
+
+
+def test_overflow_drop(tmp_path):
+    pub, sender = publisher(tmp_path, 'drop')
+    pub.publish('0')
+    sender.entered.get(timeout=5)
+    # '0' is being sent: '1' and '2' fill the queue
+    for i in range(1, 5):
+        pub.publish(str(i))
+    assert pub.dropped == 2
+    close(pub, sender)
+    assert sender.messages == ['0', '1', '2']
+    assert not os.path.exists(pub.spill_path)
+
+
+def test_overflow_spill_replayed_in_order(tmp_path):
+    pub, sender = publisher(tmp_path, 'spill')
+    pub.publish('0')
+    sender.entered.get(timeout=5)
+    for i in range(1, 5):
+        pub.publish(str(i))
+    assert pub.spilled == 2
+    assert os.path.exists(pub.spill_path)
+    # the queue drains while '3' and '4' are still spilled: newer
+    # events must not be published before them
+    sender.allowed.release()
+    assert sender.entered.get(timeout=5) == ['1', '2']
+    pub.publish('5')
+    pub.publish('6')
+    close(pub, sender)
+    assert sender.messages == ['0', '1', '2', '3', '4', '5', '6']
+    assert pub.spilled == 4
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_publishing_resumes_after_replay(tmp_path):
+    pub, sender = publisher(tmp_path, 'spill')
+    pub.publish('0')
+    sender.entered.get(timeout=5)
+    for i in range(1, 4):
+        pub.publish(str(i))
+    sender.allowed.release(2)
+    # '1' '2', then the replayed '3'
+    assert sender.entered.get(timeout=5) == ['1', '2']
+    assert sender.entered.get(timeout=5) == ['3']
+    pub.publish('4')
+    close(pub, sender)
+    assert sender.messages == ['0', '1', '2', '3', '4']
+    assert pub.spilled == 1
+
+
+def test_send_errors_are_logged(tmp_path):
+    sent = []
+
+    def send(messages):
+        sent.extend(messages)
+        if messages == ['bad']:
+            raise IOError('unreachable')
+
+    pub = EventPublisher(send, formatter=lambda event, fields: event)
+    pub.publish('bad')
+    pub.close()
+    pub.publish('good')
+    pub.close()
+    assert sent == ['bad', 'good']
+
+
+def test_file_events(ftp_server, tmp_path):
+    sender = Sender()
+    sender.allowed.release(100)
+    pub = EventPublisher(sender, spill_dir=str(tmp_path))
+
+    def on_file_received(self, file):
+        pub.publish('received', user=self.username, file=file)
+
+    client = ftp_server(on_file_received=on_file_received)
+    client.mkd('chan')
+    client.storbinary('STOR chan/a.txt', io.BytesIO(b'data'))
+    client.voidcmd('NOOP')
+    pub.close()
+    assert sender.messages == ['chan /chan/a.txt']
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_zmq_forwarder(tmp_path):
+    zmq = pytest.importorskip('zmq')
+    address = 'tcp://127.0.0.1:%d' % free_port()
+    forwarder = ZMQForwarder(
+        address, collect_address='ipc://%s' % (tmp_path / 'collect.ipc'))
+    forwarder.start()
+    sub = zmq.Context.instance().socket(zmq.SUB)
+    sub.setsockopt_string(zmq.SUBSCRIBE, '')
+    sub.setsockopt(zmq.RCVTIMEO, 100)
+    sub.connect(address)
+    pub = EventPublisher(forwarder.sender(), max_queue=2, overflow='spill',
+                         spill_dir=str(tmp_path),
+                         formatter=lambda event, fields: event)
+    try:
+        # PUB drops messages until the subscription is propagated
+        for _ in range(50):
+            pub.publish('ping')
+            try:
+                sub.recv_string()
+                break
+            except zmq.Again:
+                pass
+        else:
+            pytest.fail('no message forwarded')
+        while True:
+            try:
+                sub.recv_string()
+            except zmq.Again:
+                break
+        sub.setsockopt(zmq.RCVTIMEO, 5000)
+        expected = [str(i) for i in range(200)]
+        for message in expected:
+            pub.publish(message)
+        assert [sub.recv_string() for _ in expected] == expected
+    finally:
+        pub.close()
+        sub.close()
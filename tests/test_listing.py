@@ -0,0 +1,155 @@
+import ftplib
+
+import pytest
+
+from fstpy import filesystems
+
+
+@pytest.fixture
+def tree(ftp_server):
+    root = ftp_server.root
+    for i in range(3):
+        for j in range(2):
+            sub = root / ('d%d' % i) / ('e%d' % j)
+            sub.mkdir(parents=True)
+            (sub / 'file').write_text('x' * j)
+    (root / 'top.txt').write_text('y')
+    (root / 'empty').mkdir()
+    files = set(['top.txt'] + ['d%d/e%d/file' % (i, j)
+                               for i in range(3) for j in range(2)])
+    dirs = set(['empty'] + ['d%d' % i for i in range(3)] +
+               ['d%d/e%d' % (i, j) for i in range(3) for j in range(2)])
+    return files, dirs
+
+
+def parse_ls_r(lines):
+    """Return the files and directories of an "ls -lR" listing."""
+    files, dirs, sections = set(), set(), []
+    current = None
+    for line in lines:
+        if not line:
+            continue
+        if line.endswith(':') and line.startswith('.'):
+            current = line[:-1]
+            sections.append(current)
+            continue
+        name = line.split(None, 8)[-1]
+        path = name if current == '.' else current[2:] + '/' + name
+        (dirs if line.startswith('d') else files).add(path)
+    return files, dirs, sections
+
+
+def retrlines(client, cmd):
+    lines = []
+    client.retrlines(cmd, lines.append)
+    return lines
+
+
+@pytest.mark.parametrize('cmd', ['LIST -R', 'LIST -lR', 'LIST -laR /'])
+def test_list_recursive(ftp_server, tree, cmd):
+    client = ftp_server()
+    files, dirs, sections = parse_ls_r(retrlines(client, cmd))
+    assert (files, dirs) == tree
+    assert len(sections) == len(tree[1]) + 1
+    assert '.' in sections
+
+
+def test_list_recursive_of_a_directory(ftp_server, tree):
+    client = ftp_server()
+    files, dirs, _ = parse_ls_r(retrlines(client, 'LIST -R d1'))
+    assert files == set(['e0/file', 'e1/file'])
+    assert dirs == set(['e0', 'e1'])
+
+
+def test_list_recursive_is_relative_to_the_cwd(ftp_server, tree):
+    client = ftp_server()
+    client.cwd('d2')
+    files, dirs, _ = parse_ls_r(retrlines(client, 'LIST -R'))
+    assert files == set(['e0/file', 'e1/file'])
+
+
+@pytest.mark.parametrize('cmd', ['LIST', 'LIST -la', 'LIST d0'])
+def test_list_is_not_recursive_without_r(ftp_server, tree, cmd):
+    client = ftp_server()
+    lines = retrlines(client, cmd)
+    assert not any(line.endswith(':') for line in lines)
+
+
+def test_list_after_list_recursive(ftp_server, tree):
+    client = ftp_server()
+    retrlines(client, 'LIST -R')
+    assert len(retrlines(client, 'LIST')) == 5
+
+
+def test_stat_recursive(ftp_server, tree):
+    client = ftp_server()
+    lines = client.sendcmd('STAT -R d0').splitlines()
+    assert lines[0] == '213-Status of "/d0":'
+    assert lines[-1] == '213 End of status.'
+    files, _, _ = parse_ls_r(lines[1:-1])
+    assert files == set(['e0/file', 'e1/file'])
+
+
+def test_stat_recursive_without_path_lists_the_cwd(ftp_server, tree):
+    client = ftp_server()
+    client.cwd('d1')
+    lines = client.sendcmd('STAT -R').splitlines()
+    assert lines[0] == '213-Status of "/d1":'
+    files, _, _ = parse_ls_r(lines[1:-1])
+    assert files == set(['e0/file', 'e1/file'])
+
+
+def test_stat_without_argument_is_the_server_status(ftp_server, tree):
+    client = ftp_server()
+    assert client.sendcmd('STAT').startswith('211-')
+
+
+def test_site_mlsdr(ftp_server, tree):
+    client = ftp_server()
+    lines = retrlines(client, 'SITE MLSDR')
+    files = set(line.split(' ', 1)[1] for line in lines
+                if 'type=file;' in line)
+    dirs = set(line.split(' ', 1)[1] for line in lines
+               if 'type=dir;' in line)
+    assert (files, dirs) == tree
+
+
+def test_site_mlsdr_of_missing_directory(ftp_server, tree):
+    client = ftp_server()
+    with pytest.raises(ftplib.error_perm, match='^501'):
+        retrlines(client, 'SITE MLSDR missing')
+
+
+@pytest.fixture
+def streamed(monkeypatch):
+    streamed = []
+    listing = filesystems._StreamedListing
+
+    def counting(*args):
+        streamed.append(listing(*args))
+        return streamed[-1]
+
+    monkeypatch.setattr(filesystems, '_StreamedListing', counting)
+    monkeypatch.setattr(filesystems.AbstractedFS, 'listing_page_size', 5)
+    return streamed
+
+
+@pytest.mark.parametrize('count', [0, 4])
+def test_small_directories_are_listed_inline(ftp_server, streamed, count):
+    for i in range(count):
+        (ftp_server.root / ('f%d' % i)).write_text('x')
+    client = ftp_server()
+    assert sorted(client.nlst()) == ['f%d' % i for i in range(count)]
+    assert len(retrlines(client, 'LIST')) == count
+    assert streamed == []
+
+
+@pytest.mark.parametrize('count', [5, 12])
+def test_large_directories_are_streamed(ftp_server, streamed, count):
+    for i in range(count):
+        (ftp_server.root / ('f%02d' % i)).write_text('x')
+    client = ftp_server()
+    assert sorted(client.nlst()) == ['f%02d' % i for i in range(count)]
+    names = [line.split()[-1] for line in retrlines(client, 'LIST')]
+    assert sorted(names) == ['f%02d' % i for i in range(count)]
+    assert len(streamed) == 2
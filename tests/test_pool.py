@@ -0,0 +1,231 @@
+import time
+import threading
+
+import fs
+import pytest
+
+from fstpy.filesystems import AbstractedFS
+from fstpy.pool import FSPool
+
+
+class FakeFS(object):
+    """Stands for a remote filesystem whose health can be toggled."""
+
+    def __init__(self, url):
+        self.url = url
+        self.healthy = True
+        self.closed = False
+
+    def getinfo(self, path, namespaces=None):
+        if not self.healthy:
+            raise fs.errors.RemoteConnectionError(msg='down')
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def opened(monkeypatch):
+    opened = []
+
+    def open_fs(url):
+        opened.append(FakeFS(url))
+        return opened[-1]
+
+    monkeypatch.setattr(fs, 'open_fs', open_fs)
+    return opened
+
+
+def test_instances_are_shared_up_to_max_leases(opened):
+    pool = FSPool(max_size=2, max_leases=2)
+    leased = [pool.acquire('mem://') for _ in range(5)]
+    assert len(opened) == 2
+    # beyond max_size the least leased instance is shared anyway
+    assert leased[:4].count(opened[0]) == 2
+    assert leased[:4].count(opened[1]) == 2
+
+
+def test_released_instances_are_reused(opened):
+    pool = FSPool()
+    first = pool.acquire('mem://')
+    pool.release('mem://', first)
+    assert pool.acquire('mem://') is first
+    assert len(opened) == 1
+
+
+def test_urls_are_pooled_separately(opened):
+    pool = FSPool()
+    assert pool.acquire('mem://a') is not pool.acquire('mem://b')
+
+
+def test_idle_instances_are_evicted(opened):
+    pool = FSPool(max_idle=0)
+    first = pool.acquire('mem://')
+    pool.release('mem://', first)
+    first.last_used = 0
+    pool.evict_idle()
+    assert first.closed
+    assert pool.acquire('mem://') is not first
+
+
+def test_unhealthy_idle_instance_is_closed(opened):
+    pool = FSPool(check_interval=0)
+    first = pool.acquire('mem://')
+    pool.release('mem://', first)
+    first.healthy = False
+    second = pool.acquire('mem://')
+    assert second is not first
+    assert first.closed
+
+
+def test_unhealthy_leased_instance_is_closed_on_last_release(opened):
+    pool = FSPool(check_interval=0)
+    first = pool.acquire('mem://')
+    also_first = pool.acquire('mem://')
+    assert also_first is first
+    first.healthy = False
+    second = pool.acquire('mem://')
+    assert second is not first
+    # still used by two sessions
+    assert not first.closed
+    # and no longer handed out
+    assert pool.acquire('mem://') is second
+    pool.release('mem://', first)
+    assert not first.closed
+    pool.release('mem://', first)
+    assert first.closed
+
+
+def test_clear_closes_retired_instances(opened):
+    pool = FSPool(check_interval=0)
+    first = pool.acquire('mem://')
+    first.healthy = False
+    pool.acquire('mem://')
+    pool.clear()
+    assert all(fs_obj.closed for fs_obj in opened)
+
+
+def test_slow_open_does_not_block_other_urls(monkeypatch):
+    opening = threading.Event()
+    proceed = threading.Event()
+
+    def open_fs(url):
+        if url == 'mem://slow':
+            opening.set()
+            proceed.wait(5)
+        return FakeFS(url)
+
+    monkeypatch.setattr(fs, 'open_fs', open_fs)
+    pool = FSPool(max_size=1)
+    slow = []
+    thread = threading.Thread(
+        target=lambda: slow.append(pool.acquire('mem://slow')))
+    thread.start()
+    assert opening.wait(5)
+    # a second session of the slow url waits for the slot
+    waiter = threading.Thread(
+        target=lambda: slow.append(pool.acquire('mem://slow')))
+    waiter.start()
+    try:
+        fast = pool.acquire('mem://fast')
+        pool.release('mem://fast', fast)
+        assert not slow
+    finally:
+        proceed.set()
+        thread.join(5)
+        waiter.join(5)
+    assert len(slow) == 2 and slow[0] is slow[1]
+
+
+def test_failed_open_frees_its_slot(monkeypatch):
+    failures = [fs.errors.CreateFailed('down')]
+
+    def open_fs(url):
+        if failures:
+            raise failures.pop()
+        return FakeFS(url)
+
+    monkeypatch.setattr(fs, 'open_fs', open_fs)
+    pool = FSPool(max_size=1)
+    with pytest.raises(fs.errors.CreateFailed):
+        pool.acquire('mem://')
+    assert pool.acquire('mem://').url == 'mem://'
+
+
+def test_hung_health_check_does_not_block_other_urls(opened):
+    pool = FSPool(check_interval=0)
+    hung = pool.acquire('mem://hung')
+    pool.release('mem://hung', hung)
+    checking = threading.Event()
+    proceed = threading.Event()
+
+    def getinfo(path, namespaces=None):
+        checking.set()
+        proceed.wait(5)
+        raise fs.errors.RemoteConnectionError(msg='down')
+
+    hung.getinfo = getinfo
+    leased = []
+    thread = threading.Thread(
+        target=lambda: leased.append(pool.acquire('mem://hung')))
+    thread.start()
+    try:
+        assert checking.wait(5)
+        other = pool.acquire('mem://other')
+        pool.release('mem://other', other)
+    finally:
+        proceed.set()
+        thread.join(5)
+    # the unhealthy instance was replaced
+    assert leased[0] is not hung
+    assert hung.closed
+
+
+def leases(pool, client):
+    # the 230 reply is sent before the filesystem of the session is
+    # made: wait for the server to be done with the login
+    client.voidcmd('NOOP')
+    return sum(entry.leases for entries in pool._entries.values()
+               for entry in entries)
+
+
+@pytest.fixture
+def session_pool(monkeypatch):
+    pool = FSPool()
+    monkeypatch.setattr(AbstractedFS, 'pool', pool)
+    yield pool
+    pool.clear()
+
+
+def test_login_again_releases_the_previous_lease(ftp_server, session_pool):
+    client = ftp_server()
+    assert leases(session_pool, client) == 1
+    for _ in range(3):
+        client.login('user', 'pass')
+        assert leases(session_pool, client) == 1
+    client.sendcmd('REIN')
+    assert leases(session_pool, client) == 0
+    client.login('user', 'pass')
+    assert leases(session_pool, client) == 1
+    client.quit()
+
+
+def test_login_during_a_transfer_releases_once_it_is_over(ftp_server,
+                                                          session_pool):
+    client = ftp_server()
+    conn = client.transfercmd('STOR file.bin')
+    # pyftpdlib lets a transfer finish once some data went through
+    conn.sendall(b'x' * 100000)
+    target = ftp_server.root / 'file.bin'
+    deadline = time.time() + 5
+    while not (target.exists() and target.stat().st_size) and \
+            time.time() < deadline:
+        time.sleep(0.01)
+    assert client.sendcmd('REIN').startswith('230')
+    # the upload still writes through the previous filesystem
+    assert leases(session_pool, client) == 1
+    conn.sendall(b'x' * 1000)
+    conn.close()
+    assert client.voidresp().startswith('226')
+    assert leases(session_pool, client) == 0
+    assert target.read_bytes() == b'x' * 101000
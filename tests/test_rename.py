@@ -0,0 +1,128 @@
+import os
+
+import fs.errors
+import fs.path
+import pytest
+from fs.memoryfs import MemoryFS
+
+from fstpy import rename
+from fstpy.rename import RenameEngine, _Journal, recover_renames
+
+
+@pytest.fixture
+def mem():
+    mem = MemoryFS()
+    mem.makedirs('/src/sub/deep')
+    mem.makedirs('/src/empty')
+    mem.writetext('/src/a.txt', 'a')
+    mem.writetext('/src/sub/b.txt', 'b')
+    mem.writetext('/src/sub/deep/c.txt', 'c')
+    return mem
+
+
+DIRS = ['empty', 'sub', 'sub/deep']
+FILES = ['a.txt', 'sub/b.txt', 'sub/deep/c.txt']
+
+
+def tree(mem, root):
+    return sorted(fs.path.relativefrom(root, path)
+                  for path in mem.walk.files(root)), \
+        sorted(fs.path.relativefrom(root, path)
+               for path in mem.walk.dirs(root))
+
+
+@pytest.fixture
+def journal_dir(tmp_path):
+    return str(tmp_path)
+
+
+def test_rename_directory(mem, journal_dir):
+    RenameEngine(journal_dir=journal_dir).rename(mem, '/src', '/dst')
+    assert not mem.exists('/src')
+    assert tree(mem, '/dst') == (FILES, DIRS)
+    assert mem.readtext('/dst/sub/deep/c.txt') == 'c'
+    assert os.listdir(journal_dir) == []
+
+
+def test_rename_to_existing_destination(mem, journal_dir):
+    mem.makedir('/dst')
+    with pytest.raises(fs.errors.DestinationExists):
+        RenameEngine(journal_dir=journal_dir).rename(mem, '/src', '/dst')
+    assert tree(mem, '/src') == (FILES, DIRS)
+
+
+def test_failed_rename_is_rolled_back(mem, journal_dir, monkeypatch):
+    move_file = rename.move_file
+
+    def failing_move_file(fs_obj, src, dst, overwrite=False):
+        if dst == '/dst/sub/b.txt':
+            raise fs.errors.OperationFailed(dst, msg='backend down')
+        move_file(fs_obj, src, dst, overwrite)
+
+    monkeypatch.setattr(rename, 'move_file', failing_move_file)
+    with pytest.raises(fs.errors.OperationFailed):
+        RenameEngine(workers=1, journal_dir=journal_dir).rename(
+            mem, '/src', '/dst')
+    assert not mem.exists('/dst')
+    assert tree(mem, '/src') == (FILES, DIRS)
+    assert os.listdir(journal_dir) == []
+
+
+def test_recover_rename_interrupted_before_creating_directories(
+        mem, journal_dir):
+    journal = _Journal.create(journal_dir, 'mem://', '/src', '/dst',
+                              DIRS, FILES)
+    journal.close()
+    RenameEngine().recover(mem, journal.path)
+    assert not mem.exists('/src')
+    assert tree(mem, '/dst') == (FILES, DIRS)
+    assert os.listdir(journal_dir) == []
+
+
+def test_recover_rename_interrupted_halfway(mem, journal_dir):
+    journal = _Journal.create(journal_dir, 'mem://', '/src', '/dst',
+                              DIRS, FILES)
+    mem.makedirs('/dst/sub')
+    mem.move('/src/sub/b.txt', '/dst/sub/b.txt')
+    journal.done('sub/b.txt')
+    # copied, not removed from the source yet
+    mem.copy('/src/a.txt', '/dst/a.txt')
+    journal.close()
+    RenameEngine().recover(mem, journal.path)
+    assert not mem.exists('/src')
+    assert tree(mem, '/dst') == (FILES, DIRS)
+    assert mem.readtext('/dst/sub/b.txt') == 'b'
+
+
+def test_roll_back_rename_interrupted_halfway(mem, journal_dir):
+    journal = _Journal.create(journal_dir, 'mem://', '/src', '/dst',
+                              DIRS, FILES)
+    mem.makedirs('/dst/sub/deep')
+    mem.move('/src/sub/deep/c.txt', '/dst/sub/deep/c.txt')
+    journal.done('sub/deep/c.txt')
+    mem.removetree('/src/empty')
+    journal.close()
+    RenameEngine().recover(mem, journal.path, rollback=True)
+    assert not mem.exists('/dst')
+    assert tree(mem, '/src') == (FILES, DIRS)
+    assert mem.readtext('/src/sub/deep/c.txt') == 'c'
+
+
+def test_recover_renames_keeps_going_after_a_failure(mem, journal_dir):
+    broken = os.path.join(journal_dir, 'rename-0.journal')
+    with open(broken, 'w') as f:
+        f.write('not json\n')
+    journal = _Journal.create(journal_dir, 'mem://', '/src', '/dst',
+                              DIRS, FILES)
+    journal.close()
+
+    class Unclosed(object):
+        def __enter__(self):
+            return mem
+
+        def __exit__(self, *exc_info):
+            pass
+
+    recover_renames(journal_dir, open_fs=lambda url: Unclosed())
+    assert tree(mem, '/dst') == (FILES, DIRS)
+    assert os.listdir(journal_dir) == ['rename-0.journal']
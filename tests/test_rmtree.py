@@ -0,0 +1,97 @@
+import ftplib
+
+import fs.errors
+import pytest
+
+from fstpy.authorizers import DummyAuthorizer
+from fstpy.filesystems import AbstractedFS
+
+
+def make_tree(root):
+    for i in range(3):
+        sub = root / 'tree' / ('d%d' % i)
+        sub.mkdir(parents=True)
+        (sub / 'file').write_text('x')
+
+
+def test_site_rmtree(ftp_server):
+    client = ftp_server(site_rmtree=True)
+    make_tree(ftp_server.root)
+    assert client.sendcmd('SITE RMTREE tree') == \
+        '250 Directory tree removed.'
+    assert not (ftp_server.root / 'tree').exists()
+
+
+def test_site_rmtree_of_missing_directory(ftp_server):
+    client = ftp_server(site_rmtree=True)
+    with pytest.raises(ftplib.error_perm, match='^550'):
+        client.sendcmd('SITE RMTREE missing')
+
+
+def test_site_rmtree_of_root(ftp_server):
+    client = ftp_server(site_rmtree=True)
+    make_tree(ftp_server.root)
+    with pytest.raises(ftplib.error_perm,
+                       match="^550 Can't remove root directory"):
+        client.sendcmd('SITE RMTREE /')
+    assert (ftp_server.root / 'tree').exists()
+
+
+def test_site_rmtree_needs_d_over_the_tree(ftp_server, monkeypatch):
+    monkeypatch.setattr(DummyAuthorizer, 'has_tree_perm',
+                        lambda self, username, perm, path: False)
+    client = ftp_server(site_rmtree=True)
+    make_tree(ftp_server.root)
+    with pytest.raises(ftplib.error_perm,
+                       match='^550 Not enough privileges'):
+        client.sendcmd('SITE RMTREE tree')
+    assert (ftp_server.root / 'tree' / 'd0' / 'file').exists()
+
+
+def test_site_rmtree_disabled(ftp_server):
+    client = ftp_server()
+    make_tree(ftp_server.root)
+    with pytest.raises(ftplib.error_perm, match='^500'):
+        client.sendcmd('SITE RMTREE tree')
+
+
+def test_rmd_is_not_recursive_by_default(ftp_server):
+    client = ftp_server(site_rmtree=True)
+    make_tree(ftp_server.root)
+    with pytest.raises(ftplib.error_perm, match='^550'):
+        client.sendcmd('RMD tree')
+    assert (ftp_server.root / 'tree').exists()
+
+
+def test_recursive_rmd(ftp_server):
+    client = ftp_server(recursive_rmd=True)
+    make_tree(ftp_server.root)
+    assert client.sendcmd('RMD tree').startswith('250 ')
+    assert not (ftp_server.root / 'tree').exists()
+
+
+def test_failed_removal_is_a_550(ftp_server, monkeypatch):
+    def removetree(self, path):
+        self._on_delete_progress(path, 1000)
+        raise fs.errors.OperationFailed(path, msg='backend down')
+
+    monkeypatch.setattr(AbstractedFS, 'removetree', removetree)
+    client = ftp_server(site_rmtree=True)
+    make_tree(ftp_server.root)
+    with pytest.raises(ftplib.error_perm) as excinfo:
+        client.sendcmd('SITE RMTREE tree')
+    assert str(excinfo.value).startswith(
+        '550 Removal stopped after 1000 objects')
+    # the control connection is still in sync
+    assert client.sendcmd('NOOP').startswith('200')
+
+
+def test_failed_removal_without_progress(ftp_server, monkeypatch):
+    def removetree(self, path):
+        raise fs.errors.OperationFailed(path, msg='backend down')
+
+    monkeypatch.setattr(AbstractedFS, 'removetree', removetree)
+    client = ftp_server(recursive_rmd=True)
+    make_tree(ftp_server.root)
+    with pytest.raises(ftplib.error_perm, match='^550 backend down'):
+        client.sendcmd('RMD tree')
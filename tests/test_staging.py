@@ -0,0 +1,123 @@
+import io
+import os
+import json
+import threading
+
+import pytest
+
+from fstpy.filesystems import AbstractedFS
+from fstpy.staging import UploadStager
+
+
+@pytest.fixture
+def stager(tmp_path, monkeypatch):
+    stager = UploadStager(str(tmp_path / 'spool'), retries=1,
+                          retry_delay=0.01)
+    # commits wait for the gate to open
+    stager.gate = threading.Event()
+    stager.gate.set()
+    upload = stager._upload
+
+    def gated_upload(entry):
+        assert stager.gate.wait(5)
+        upload(entry)
+
+    monkeypatch.setattr(stager, '_upload', gated_upload)
+    monkeypatch.setattr(AbstractedFS, 'stager', stager)
+    return stager
+
+
+def spool(stager):
+    return sorted(os.listdir(stager.directory))
+
+
+def wait_committed(stager, url, path):
+    key = (url, path)
+    for _ in range(500):
+        if key not in stager._latest and not stager._key_locks:
+            return
+        threading.Event().wait(0.01)
+    raise AssertionError('%r not committed' % (key,))
+
+
+def test_upload_is_committed_in_background(ftp_server, stager):
+    stager.gate.clear()
+    client = ftp_server()
+    client.storbinary('STOR file.bin', io.BytesIO(b'staged'))
+    # answered before the backend has the file...
+    assert not (ftp_server.root / 'file.bin').exists()
+    assert [name[-5:] for name in spool(stager)] == ['.data', '.json']
+    # ...which can already be read back
+    data = []
+    client.retrbinary('RETR file.bin', data.append)
+    assert b''.join(data) == b'staged'
+    stager.gate.set()
+    wait_committed(stager, 'osfs://%s/' % ftp_server.root, '/file.bin')
+    assert (ftp_server.root / 'file.bin').read_bytes() == b'staged'
+    assert spool(stager) == []
+
+
+def test_superseded_upload_is_skipped(ftp_server, stager, monkeypatch):
+    stager.gate.clear()
+    uploaded = []
+    upload = stager._upload
+    monkeypatch.setattr(stager, '_upload', lambda entry: (
+        uploaded.append(entry['id']), upload(entry)))
+    client = ftp_server()
+    for data in (b'first', b'second', b'third'):
+        client.storbinary('STOR file.bin', io.BytesIO(data))
+    first, second, third = [name[:-5] for name in spool(stager)
+                            if name.endswith('.data')]
+    stager.gate.set()
+    wait_committed(stager, 'osfs://%s/' % ftp_server.root, '/file.bin')
+    assert (ftp_server.root / 'file.bin').read_bytes() == b'third'
+    # the second one waited for the first commit to be done, by then
+    # the third one was staged
+    assert uploaded == [first, third]
+    assert spool(stager) == []
+
+
+def test_failed_commit_stays_in_the_spool(tmp_path):
+    stager = UploadStager(str(tmp_path / 'spool'), retries=1,
+                          retry_delay=0.01)
+    file = stager.stage('osfs://%s' % tmp_path, '/missing/dir/file.bin')
+    file.write(b'data')
+    file.close()
+    with pytest.raises(Exception):
+        file.committed.result(5)
+    assert len(spool(stager)) == 2
+
+
+def test_aborted_upload_is_discarded(tmp_path):
+    stager = UploadStager(str(tmp_path / 'spool'))
+    file = stager.stage('osfs://%s' % tmp_path, '/file.bin')
+    file.write(b'partial')
+    file.abort()
+    assert file.committed.cancelled()
+    assert spool(stager) == []
+    assert not (tmp_path / 'file.bin').exists()
+
+
+def test_recover(tmp_path):
+    backend = tmp_path / 'backend'
+    backend.mkdir()
+    directory = tmp_path / 'spool'
+    directory.mkdir()
+    url = 'osfs://%s' % backend
+    for id, path, data in [('01', '/file.bin', b'old'),
+                           ('02', '/file.bin', b'new'),
+                           ('03', '/other.bin', b'other')]:
+        (directory / (id + '.data')).write_bytes(data)
+        (directory / (id + '.json')).write_text(json.dumps(
+            {'id': id, 'url': url, 'path': path, 'user': None}))
+    # received partially, or crashed while being journaled
+    (directory / '04.data').write_bytes(b'partial')
+    (directory / '05.data').write_bytes(b'partial')
+    (directory / '05.json.tmp').write_text('{')
+    stager = UploadStager(str(directory))
+    for future in stager.recover():
+        future.result(5)
+    # committed in staging order
+    assert (backend / 'file.bin').read_bytes() == b'new'
+    assert (backend / 'other.bin').read_bytes() == b'other'
+    assert spool(stager) == []
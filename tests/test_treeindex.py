@@ -0,0 +1,72 @@
+import json
+
+import fs
+import pytest
+
+from fstpy.authorizers import DummyAuthorizer
+from fstpy.filesystems import AbstractedFS
+from fstpy.treeindex import TreeIndex
+
+
+class Channel(object):
+
+    def __init__(self, authorizer, username):
+        self.authorizer = authorizer
+        self.username = username
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    root = tmp_path / 'root'
+    (root / 'alice' / 'docs').mkdir(parents=True)
+    (root / 'alice' / 'docs' / 'a.txt').write_text('a')
+    url = 'osfs://%s' % root
+    index = TreeIndex(str(tmp_path / 'index'), url, check_interval=0)
+    with fs.open_fs(url) as fs_obj:
+        index.build(fs_obj)
+    monkeypatch.setattr(AbstractedFS, 'tree_index', index)
+    authorizer = DummyAuthorizer(url)
+    authorizer.add_user('writer', 'pass', '/alice', perm='elradfmw')
+    authorizer.add_user('reader', 'pass', '/alice', perm='elr')
+    index.authorizer = authorizer
+    return index
+
+
+def session(index, username):
+    home = index.authorizer.get_home_dir(username)
+    return AbstractedFS(home, Channel(index.authorizer, username))
+
+
+def dirty(index):
+    with open(index.dirty_filename) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_locate(index):
+    assert index.locate(index.url) == '/'
+    assert index.locate(index.url + '/') == '/'
+    assert index.locate(index.url + '/alice/') == '/alice'
+    assert index.locate(index.url + 'x/alice') is None
+    assert index.locate('osfs:///elsewhere') is None
+
+
+def test_changes_below_the_index_root_are_keyed_on_its_paths(index):
+    afs = session(index, 'writer')
+    try:
+        afs.mkdir('/new')
+        afs.remove('/docs/a.txt')
+    finally:
+        afs.close()
+    assert dirty(index) == [['/alice', False], ['/alice/docs', False]]
+
+
+def test_sessions_below_the_index_root_read_from_it(index):
+    afs = session(index, 'reader')
+    try:
+        assert afs._index is index
+        assert afs.listdir('/docs') == ['a.txt']
+        assert afs.isdir('/docs')
+        assert afs.getsize('/docs/a.txt') == 1
+        assert not afs.lexists('/a.txt')
+    finally:
+        afs.close()
@@ -0,0 +1,151 @@
+import io
+import time
+import threading
+
+import pytest
+from fs.osfs import OSFS
+
+from fstpy import streams
+from fstpy.filesystems import AbstractedFS
+from fstpy.streams import MultipartWriter
+
+
+class FakeUpload(object):
+    """A multipart upload writing the object to a local filesystem
+    once completed, recording the calls made.
+    """
+
+    min_part_size = 100
+
+    def __init__(self, fs_obj, path, gate=None):
+        self.fs = fs_obj
+        self.path = path
+        self.gate = gate
+        self.calls = []
+        self.parts = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.calls.append('start')
+
+    def upload_part(self, number, data):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.gate is not None:
+                self.gate.wait(5)
+            else:
+                time.sleep(0.005)
+            self.parts[number] = bytes(data)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        return {'PartNumber': number}
+
+    def copy_part(self, number):
+        self.calls.append('copy')
+        self.parts[number] = self.fs.readbytes(self.path)
+        return {'PartNumber': number}
+
+    def read(self):
+        self.calls.append('read')
+        return self.fs.readbytes(self.path)
+
+    def complete(self, parts):
+        self.calls.append('complete')
+        self.fs.writebytes(self.path, b''.join(
+            self.parts[part['PartNumber']] for part in parts))
+
+    def put(self, data):
+        self.calls.append('put')
+        self.fs.writebytes(self.path, data)
+
+    def abort(self):
+        self.calls.append('abort')
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    uploads = []
+
+    def factory(fs_obj, path):
+        if not isinstance(fs_obj, OSFS):
+            return None
+        uploads.append(FakeUpload(fs_obj, path))
+        return uploads[-1]
+
+    monkeypatch.setattr(streams, 'multipart_uploaders', [factory])
+    monkeypatch.setattr(AbstractedFS, 'upload_part_size', 100)
+    monkeypatch.setattr(AbstractedFS, 'upload_max_in_flight', 2)
+    return uploads
+
+
+def test_large_upload_is_sent_in_parts(ftp_server, uploads):
+    client = ftp_server()
+    data = bytes(bytearray(range(256))) * 10
+    client.storbinary('STOR file.bin', io.BytesIO(data), blocksize=64)
+    assert (ftp_server.root / 'file.bin').read_bytes() == data
+    upload, = uploads
+    assert upload.calls == ['start', 'complete']
+    assert len(upload.parts) == 26
+    assert upload.max_in_flight <= 2
+
+
+def test_small_upload_is_a_single_request(ftp_server, uploads):
+    client = ftp_server()
+    client.storbinary('STOR file.bin', io.BytesIO(b'small'))
+    assert (ftp_server.root / 'file.bin').read_bytes() == b'small'
+    assert uploads[0].calls == ['put']
+
+
+@pytest.mark.parametrize('existing', [b'x' * 10, b'x' * 150])
+def test_append_keeps_the_existing_content(ftp_server, uploads, existing):
+    (ftp_server.root / 'file.bin').write_bytes(existing)
+    client = ftp_server()
+    client.storbinary('APPE file.bin', io.BytesIO(b'y' * 250))
+    assert (ftp_server.root / 'file.bin').read_bytes() == \
+        existing + b'y' * 250
+    # copied on the server side once large enough to be a part
+    assert ('copy' in uploads[0].calls) == (len(existing) >= 100)
+    assert ('read' in uploads[0].calls) == (len(existing) < 100)
+
+
+def test_aborted_upload_is_discarded(ftp_server, uploads):
+    (ftp_server.root / 'file.bin').write_bytes(b'original')
+    client = ftp_server()
+    conn = client.transfercmd('STOR file.bin')
+    conn.sendall(b'z' * 1000)
+    deadline = time.time() + 5
+    while not uploads[0].parts and time.time() < deadline:
+        time.sleep(0.01)
+    client.abort()
+    conn.close()
+    # the 226 or 426 reply of the transfer, then that of ABOR
+    client.sendcmd('NOOP')
+    assert uploads[0].calls[-1] == 'abort'
+    assert 'complete' not in uploads[0].calls
+    assert (ftp_server.root / 'file.bin').read_bytes() == b'original'
+
+
+def test_writes_wait_for_parts_in_flight(tmp_path):
+    gate = threading.Event()
+    upload = FakeUpload(OSFS(str(tmp_path)), '/file.bin', gate)
+    writer = MultipartWriter(upload, 'file.bin', part_size=100,
+                             max_in_flight=2)
+    thread = threading.Thread(target=writer.write, args=(b'w' * 1000,))
+    thread.start()
+    try:
+        time.sleep(0.2)
+        # the third part waits for the first one to be uploaded
+        assert thread.is_alive()
+        assert upload.in_flight == 2
+        assert len(writer._buffer) == 700
+    finally:
+        gate.set()
+        thread.join(5)
+    writer.close()
+    assert (tmp_path / 'file.bin').read_bytes() == b'w' * 1000
+    assert upload.max_in_flight == 2